@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+"""
+Measure the memory used by the port attributes of a full ports tree.
+
+The attributes of every port are loaded (using the attr queue) and the size of
+the PortAttr records is compared to the size of the equivalent (uninterned)
+dictionaries.
+
+Usage: attr_memory.py [PORTSDIR]
+"""
+
+from __future__ import absolute_import
+
+import glob
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", ".."))
+
+from libpb import env, event, mk
+
+
+def sizeof(obj, seen):
+    """The size of obj, and all objects it references, not already seen."""
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(sizeof(k, seen) + sizeof(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set)):
+        size += sum(sizeof(i, seen) for i in obj)
+    elif isinstance(obj, mk.PortAttr):
+        size += sum(sizeof(v, seen) for k, v in obj.items())
+    return size
+
+
+def main():
+    """Load all ports and report on their memory usage."""
+    if len(sys.argv) > 1:
+        env.env["PORTSDIR"] = sys.argv[1]
+    mk.bootstrap_master()
+    mk.clean()
+    mk.cache()
+
+    portsdir = env.env["PORTSDIR"]
+    origins = [os.path.dirname(i)[len(portsdir) + 1:]
+               for i in glob.glob(os.path.join(portsdir, "*", "*", "Makefile"))]
+
+    attrs = []
+
+    def collect(_origin, attr):
+        """Collect the loaded attributes."""
+        if attr is not None:
+            attrs.append(attr)
+
+    start = time.time()
+    for origin in origins:
+        mk.attr(origin).connect(collect)
+    event.run()
+    elapsed = time.time() - start
+
+    seen = set()
+    records = sum(sizeof(i, seen) for i in attrs)
+    # Without interning each port holds its own copy of every value
+    dicts = sum(sizeof(dict(i.items()), set()) for i in attrs)
+
+    print "ports:   %i (of %i) in %.1fs" % (len(attrs), len(origins), elapsed)
+    print "dict:    %.1f MiB (%i bytes/port)" % (dicts / 2.0**20,
+                                                 dicts // max(1, len(attrs)))
+    print "records: %.1f MiB (%i bytes/port)" % (records / 2.0**20,
+                                                 records // max(1, len(attrs)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+"""
+Benchmark the transitive closure index.
+
+A random (acyclic) graph is built, and the transitive dependencies and the
+transitive dependants are queried for a sample of ports, by walking the graph
+and by using the closure index.  The time to create the index (in bulk) and to
+apply a few new dependencies to it (incrementally) is also measured.
+
+Usage: closure.py [NODES [EDGES [QUERIES]]]
+"""
+
+from __future__ import absolute_import
+
+import collections
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", ".."))
+
+from libpb.port import graph
+
+
+def walk(edges, port):
+    """The ports reachable from port, by walking the edges."""
+    seen = set()
+    queue = collections.deque(edges(port))
+    while queue:
+        port = queue.popleft()
+        if port not in seen:
+            seen.add(port)
+            queue.extend(edges(port))
+    return seen
+
+
+def timed(func, *args):
+    """Call func, returns its result and the time taken."""
+    start = time.time()
+    result = func(*args)
+    return result, time.time() - start
+
+
+def main():
+    """Time walking the graph and using the closure index."""
+    nodes = int(sys.argv[1]) if len(sys.argv) > 1 else 30000
+    edges = int(sys.argv[2]) if len(sys.argv) > 2 else 200000
+    queries = int(sys.argv[3]) if len(sys.argv) > 3 else 1000
+    rand = random.Random(0)
+    pairs = set()
+    while len(pairs) < edges:
+        port = rand.randrange(1, nodes)
+        pairs.add((port, int(port * rand.random() ** 4)))
+    pairs = sorted(pairs, key=lambda x: -x[0])
+    sample = [rand.randrange(nodes) for _ in range(queries)]
+
+    def build():
+        """Build the graph."""
+        dgraph = graph.DependGraph()
+        for port in range(nodes):
+            dgraph.add(port)
+        for port, depend in pairs:
+            dgraph.add_edge(port, depend, 0)
+        return dgraph
+
+    def extend(count=16):
+        """Add new dependencies, querying the index after each."""
+        for _ in range(count):
+            port = rand.randrange(1, nodes)
+            dgraph.add_edge(port, rand.randrange(port), 1)
+            index.depends(port)
+
+    dgraph, build_time = timed(build)
+    index, bulk_time = timed(dgraph.closure)
+    _, incremental_time = timed(extend)
+    print "graph:         %i nodes, %i edges" % (nodes, edges)
+    print "build:         %.3fs" % build_time
+    print "index (bulk):  %.3fs" % bulk_time
+    print "index (16 new dependencies): %.3fs" % incremental_time
+
+    depends = lambda x: dgraph.depends(x)
+    dependants = lambda x: dgraph.dependants(x)
+    queries = (
+            ("depends", lambda x: walk(depends, x),
+                        lambda x: index.ports(index.depends(x))),
+            ("dependants", lambda x: walk(dependants, x),
+                           lambda x: index.ports(index.dependants(x))),
+        )
+    for name, walker, lookup in queries:
+        walked, walk_time = timed(lambda: [walker(i) for i in sample])
+        looked, index_time = timed(lambda: [lookup(i) for i in sample])
+        for i, j in zip(walked, looked):
+            assert i == j or set(i) == set(j)
+        print "%-14s walk %.3fs, index %.3fs" % (name + ":", walk_time,
+                                                 index_time)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+"""
+Benchmark the dependency graph.
+
+A random (acyclic) graph is built and then every port is resolved, bottom up,
+checking the unresolved dependency counts are maintained.
+
+Usage: depend_graph.py [NODES [EDGES]]
+"""
+
+from __future__ import absolute_import
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", ".."))
+
+from libpb.port import graph
+
+
+class Node(object):
+    """A stand-in for a port."""
+
+    def __init__(self, idx):
+        self.idx = idx
+
+    def __repr__(self):
+        return "<Node(%i)>" % self.idx
+
+
+def main():
+    """Time building and resolving a graph."""
+    nodes = int(sys.argv[1]) if len(sys.argv) > 1 else 30000
+    edges = int(sys.argv[2]) if len(sys.argv) > 2 else 200000
+    rand = random.Random(0)
+    ports = [Node(i) for i in range(nodes)]
+    # A skewed distribution, so a few `hub' ports have many dependants
+    pairs = []
+    for _ in range(edges):
+        port = rand.randrange(1, nodes)
+        depend = int(port * rand.random() ** 4)
+        pairs.append((ports[port], ports[depend], rand.randrange(graph.TYPES)))
+
+    dgraph = graph.DependGraph()
+    start = time.time()
+    for port in ports:
+        dgraph.add(port)
+    for port, depend, typ in pairs:
+        dgraph.add_edge(port, depend, typ)
+    built = time.time()
+
+    for port in ports:
+        assert dgraph.unresolved(port) == 0
+        dgraph.set_resolved(port, True)
+    resolved = time.time()
+
+    hub = max(ports, key=lambda x: len(dgraph.dependants(x)))
+    print "graph:    %i nodes, %i edges (hub with %i dependants)" % (
+            len(dgraph), dgraph.edges, len(dgraph.dependants(hub)))
+    print "build:    %.3fs" % (built - start)
+    print "resolve:  %.3fs" % (resolved - built)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+"""
+Benchmark (and test) fetching distfiles natively.
+
+Local HTTP servers (HTTP/1.1, with persistent connections and Range requests,
+delaying each response to model distant mirrors) serve a set of distfiles,
+each distfile from one of the mirrors (and every tenth distfile is first
+requested from a mirror without it).  The distfiles are downloaded one at a
+time, over a new connection each (as fetch(1) does), and concurrently by
+fetch.Download (resuming partially downloaded files and replacing corrupted
+files), and checked against their size and SHA256 checksum.
+
+Usage: fetch.py [FILES [SIZE [LATENCY [MIRRORS]]]]
+"""
+
+from __future__ import absolute_import, with_statement
+
+import BaseHTTPServer
+import SocketServer
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import urllib2
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", ".."))
+
+from libpb import env, event, fetch, job, queue
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves the distfiles, resuming from the requested range."""
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    files = {}       #: The contents of the distfiles
+    latency = 0.     #: The delay (in seconds) of each response
+    connections = 0  #: The connections accepted
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        Handler.connections += 1
+
+    def do_GET(self):
+        """Serve a distfile (or the remainder of it)."""
+        time.sleep(self.latency)
+        data = self.files.get(self.path.lstrip("/"))
+        if data is None:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        first = 0
+        if self.headers.get("Range", "").startswith("bytes="):
+            first = int(self.headers["Range"][6:].split("-", 1)[0])
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %i-%i/%i" %
+                                 (first, len(data) - 1, len(data)))
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(data) - first))
+        self.end_headers()
+        self.wfile.write(data[first:])
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """A HTTP server, with a thread per connection."""
+
+    daemon_threads = True
+
+
+class FetchJob(job.Job):
+    """Downloads the distfiles natively."""
+
+    def __init__(self, sites, distdir):
+        job.Job.__init__(self)
+        self.failed = 0
+        self.downloads = [
+                fetch.Download(name, os.path.join(distdir, name),
+                               len(Handler.files[name]),
+                               hashlib.sha256(Handler.files[name]).hexdigest(),
+                               urls, self.downloaded)
+                for name, urls in sites]
+        self._pending = len(self.downloads)
+
+    def work(self):
+        for download in self.downloads:
+            download.start()
+
+    def downloaded(self, _download, status):
+        """Count the finished downloads."""
+        self.failed += not status
+        self._pending -= 1
+        if not self._pending:
+            self.done()
+
+
+def verify(path, data):
+    """Check a downloaded file has the contents of a distfile."""
+    if not os.path.isfile(path):
+        return False
+    with open(path, "rb") as distfile:
+        return distfile.read() == data
+
+
+def sequential(sites, distdir):
+    """Download the distfiles one at a time, over a new connection each."""
+    for name, urls in sites:
+        for url in urls:
+            try:
+                response = urllib2.urlopen(url)
+            except urllib2.HTTPError:
+                continue
+            with open(os.path.join(distdir, name), "wb") as distfile:
+                shutil.copyfileobj(response, distfile)
+            break
+
+
+def native(sites, distdir):
+    """Download the distfiles concurrently, returns the number that
+    failed."""
+    for idx, (name, _urls) in enumerate(sites):
+        data = Handler.files[name]
+        if idx % 3 == 0:
+            # Partially downloaded
+            with open(os.path.join(distdir, name), "wb") as distfile:
+                distfile.write(data[:len(data) // 2])
+        elif idx % 3 == 1:
+            # Corrupted
+            with open(os.path.join(distdir, name), "wb") as distfile:
+                distfile.write(data[:-1] + chr(ord(data[-1]) ^ 1))
+    fetch_job = FetchJob(sites, distdir)
+    queue.fetch.add(fetch_job)
+    event.run()
+    return fetch_job.failed
+
+
+def main():
+    """Time downloading the distfiles, both ways."""
+    files = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    size = int(sys.argv[2]) if len(sys.argv) > 2 else 64 * 1024
+    Handler.latency = float(sys.argv[3]) if len(sys.argv) > 3 else 0.05
+    mirrors = int(sys.argv[4]) if len(sys.argv) > 4 else 4
+    env.flags["debug"] = False
+    for i in range(files):
+        Handler.files["distfile%i.tar.gz" % i] = os.urandom(size)
+
+    servers = []
+    for _ in range(mirrors):
+        server = Server(("127.0.0.1", 0), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        servers.append("http://127.0.0.1:%i/" % server.server_address[1])
+    sites = []
+    for i, name in enumerate(sorted(Handler.files)):
+        urls = [servers[i % mirrors] + name]
+        if i % 10 == 0:
+            urls.insert(0, servers[(i + 1) % mirrors] + "missing/" + name)
+        sites.append((name, urls))
+
+    print "distfiles:  %i (%i bytes, %i mirrors, %.0fms latency)" % (
+            files, size, mirrors, Handler.latency * 1000)
+    for name, func in (("sequential", sequential), ("native", native)):
+        distdir = tempfile.mkdtemp()
+        try:
+            connections = Handler.connections
+            start = time.time()
+            failed = func(sites, distdir)
+            duration = time.time() - start
+            bad = sum(1 for i, j in Handler.files.items()
+                      if not verify(os.path.join(distdir, i), j))
+            print "%-11s %.3fs (%i connections, %i failed, %i bad)" % (
+                    name + ":", duration, Handler.connections - connections,
+                    failed or 0, bad)
+        finally:
+            shutil.rmtree(distdir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+"""
+Benchmark the preparation of make commands.
+
+The make arguments are built for a series of stages, by merging the
+environment with the stage's variables for each command (as portbuilder used
+to) and by make.make_args() (with the constant part cached per generation of
+the environment), and checked to agree.
+
+Usage: make_args.py [COMMANDS [VARIABLES]]
+"""
+
+from __future__ import absolute_import
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", ".."))
+
+from libpb import env, make
+
+#: The targets and variables of the stages
+STAGES = (
+        (("checksum",), dict(BATCH=True, NO_DEPENDS=True,
+                             DISABLE_CONFLICTS=True, FETCH_REGET=0)),
+        (("all",), dict(BATCH=True, NO_DEPENDS=True)),
+        (("install",), dict(BATCH=True, NO_DEPENDS=True,
+                            INSTALLS_DEPENDS=True)),
+        (("package",), dict(BATCH=True, NO_DEPENDS=True)),
+        (("-V", "PKGNAME"), dict()),
+    )
+
+
+def legacy_args(origin, targets, kwargs):
+    """The make arguments, merging the environment for each command."""
+    environ = {}
+    environ.update(env.env)
+    environ.update(kwargs)
+
+    args = ("make", "-C", os.path.join(environ["PORTSDIR"], origin)) + targets
+    for key, value in env.master.items():
+        # Remove default environment variables
+        if environ[key] == value:
+            del environ[key]
+    args += tuple(make.env2args(environ))
+
+    if env.flags["chroot"]:
+        args = ("chroot", env.flags["chroot"]) + args
+    return args
+
+
+def timed(func, commands):
+    """Time building the arguments of commands with func."""
+    start = time.time()
+    for origin, targets, kwargs in commands:
+        func(origin, targets, kwargs)
+    return time.time() - start
+
+
+def main():
+    """Time building the make arguments, both ways."""
+    commands = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    variables = int(sys.argv[2]) if len(sys.argv) > 2 else 40
+    for key, value in env.master.items():
+        env.env[key] = value
+    for i in range(variables):
+        # Half of the variables have their default value
+        env.master["VAR%i" % i] = "default"
+        env.env["VAR%i" % i] = "default" if i % 2 else "value%i" % i
+    env.env["WITH_PKGNG"] = True
+
+    commands = [("category/port%i" % (i % 1000),) + STAGES[i % len(STAGES)]
+                for i in range(commands)]
+    for origin, targets, kwargs in commands[:len(STAGES)]:
+        assert (sorted(legacy_args(origin, targets, kwargs)) ==
+                sorted(make.make_args(origin, targets, kwargs)))
+
+    legacy = timed(legacy_args, commands)
+    cached = timed(make.make_args, commands)
+    print "commands: %i (%i variables)" % (len(commands), len(env.env))
+    print "legacy:   %.3fs (%.1fus per command)" % (
+            legacy, 1e6 * legacy / len(commands))
+    print "cached:   %.3fs (%.1fus per command)" % (
+            cached, 1e6 * cached / len(commands))
+
+
+if __name__ == "__main__":
+    main()
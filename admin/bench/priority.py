@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+"""
+Benchmark the priority propagation during the load phase.
+
+Random (acyclic) graphs, of increasing size, are loaded top down (as the ports
+are loaded by portbuilder).  The time taken by the previous (breadth first
+walk per loaded port) and current (pending changes propagated in a single pass
+once the ports have loaded) methods are compared, and checked to agree where
+the graph is a tree.
+
+Usage: priority.py [NODES...]
+"""
+
+from __future__ import absolute_import
+
+import collections
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", ".."))
+
+from libpb.port import graph
+
+
+def make_graph(nodes, degree=7, seed=0):
+    """Make a random graph, returns the dependencies and weight of nodes."""
+    rand = random.Random(seed)
+    depends = [set() for _ in range(nodes)]
+    for node in range(1, nodes):
+        for _ in range(rand.randrange(2 * degree)):
+            depends[node].add(int(node * rand.random() ** 4))
+    weight = [rand.randrange(1 << 20) for _ in range(nodes)]
+    return depends, weight
+
+
+def make_tree(nodes, seed=0):
+    """Make a random tree, returns the dependencies and weight of nodes."""
+    rand = random.Random(seed)
+    depends = [set() for _ in range(nodes)]
+    for node in range(1, nodes):
+        depends[rand.randrange(node)].add(node)
+    weight = [rand.randrange(1 << 20) for _ in range(nodes)]
+    return depends, weight
+
+
+def load_order(depends):
+    """The order ports are loaded in (top down, from the top level ports)."""
+    leaves = set(range(len(depends)))
+    for i in depends:
+        leaves.difference_update(i)
+    queue = collections.deque(sorted(leaves, reverse=True))
+    seen = set(queue)
+    while queue:
+        node = queue.popleft()
+        yield node
+        for depend in depends[node]:
+            if depend not in seen:
+                seen.add(depend)
+                queue.append(depend)
+
+
+def bfs(depends, weight, order):
+    """The previous method: walk all dependencies of each loaded port."""
+    priority = {}
+    loaded = {}
+    for node in order:
+        priority.setdefault(node, 0)
+        priority[node] += weight[node]
+        loaded[node] = depends[node]
+        for depend in depends[node]:
+            priority.setdefault(depend, 0)
+        update_list = collections.deque(depends[node])
+        updated = set()
+        while update_list:
+            port = update_list.popleft()
+            if port not in updated:
+                priority[port] += priority[node]
+                update_list.extend(loaded.get(port, ()))
+                updated.add(port)
+    return priority
+
+
+def wave(depends, weight, order, size=None):
+    """The current method: propagate changes after each wave of ports."""
+    dgraph = graph.DependGraph()
+    for count, node in enumerate(order):
+        if node not in dgraph:
+            dgraph.add(node)
+        dgraph.set_weight(node, weight[node])
+        for depend in depends[node]:
+            if depend not in dgraph:
+                dgraph.add(depend)
+            dgraph.add_edge(node, depend, 0)
+        if size and count % size == 0:
+            dgraph.propagate()
+    dgraph.propagate()
+    return dict((i, dgraph.priority(i)) for i in dgraph)
+
+
+def main():
+    """Time both methods for graphs of increasing size."""
+    sizes = [int(i) for i in sys.argv[1:]] or [5000, 10000, 20000, 40000]
+    depends, weight = make_tree(sizes[0])
+    order = list(load_order(depends))
+    assert bfs(depends, weight, order) == wave(depends, weight, order, 16)
+
+    print "%8s %8s %10s %10s" % ("nodes", "edges", "bfs", "wave")
+    for nodes in sizes:
+        depends, weight = make_graph(nodes)
+        order = list(load_order(depends))
+        times = []
+        for method in (bfs, wave):
+            start = time.time()
+            method(depends, weight, order)
+            times.append(time.time() - start)
+        print "%8i %8i %9.3fs %9.3fs" % (
+                nodes, sum(len(i) for i in depends), times[0], times[1])
+
+
+if __name__ == "__main__":
+    main()
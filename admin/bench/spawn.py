@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+"""
+Benchmark the rate subprocesses are spawned.
+
+true(1) is run repeatedly (with its standard streams piped, as the attribute
+fetches are) using subprocess.Popen (with close_fds and setsid, as
+portbuilder used to) and using posix_spawn, for each of the given descriptor
+limits (the soft RLIMIT_NOFILE, by default the current and hard limits).
+
+Usage: spawn.py [SPAWNS [LIMIT...]]
+"""
+
+from __future__ import absolute_import
+
+import imp
+import os
+import resource
+import subprocess
+import sys
+import time
+
+# NOTE: load the spawn module on its own, as importing libpb requires kqueue
+spawn = imp.load_source("spawn", os.path.join(os.path.dirname(__file__),
+                                              "..", "..", "libpb", "spawn.py"))
+
+
+def run_subprocess():
+    """Run true(1) using subprocess."""
+    proc = subprocess.Popen(("true",), stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            close_fds=True, preexec_fn=os.setsid)
+    proc.communicate()
+
+
+def run_spawn():
+    """Run true(1) using posix_spawn."""
+    proc = spawn.Process(("true",), spawn.PIPE, spawn.PIPE, spawn.PIPE)
+    proc.stdin.close()
+    proc.wait()
+    proc.stdout.close()
+    proc.stderr.close()
+
+
+def rate(func, spawns):
+    """The number of subprocesses run by func per second."""
+    start = time.time()
+    for _ in range(spawns):
+        func()
+    return spawns / (time.time() - start)
+
+
+def main():
+    """Time spawning subprocesses under each descriptor limit."""
+    spawns = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if len(sys.argv) > 2:
+        limits = [int(i) for i in sys.argv[2:]]
+    else:
+        limits = sorted(set((soft, hard if hard != resource.RLIM_INFINITY
+                                     else soft)))
+
+    if not spawn.available:
+        print "posix_spawn: not available (posix_spawn_file_actions_" \
+              "addclosefrom_np required)"
+    print "%10s %14s %14s" % ("limit", "subprocess/s", "posix_spawn/s")
+    for limit in limits:
+        if hard != resource.RLIM_INFINITY:
+            limit = min(limit, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (limit, hard))
+        print "%10i %14.1f %14s" % (
+                limit, rate(run_subprocess, spawns),
+                "%.1f" % rate(run_spawn, spawns) if spawn.available else "-")
+    resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+
+
+if __name__ == "__main__":
+    main()
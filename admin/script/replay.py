@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+"""
+Replay a scheduling trace (see libpb/trace.py).
+
+The timeline of the traced build is rebuilt: the length of the build, and for
+each queue the number of jobs run, its utilisation and the time jobs waited to
+start.  The build is then simulated under each of the given policies (and
+queue loads), using the recorded duration of each job.
+
+In the simulation a job is ready once the port's previous job has finished
+and, for stages that require the port's dependencies to be installed, once all
+the jobs of its dependencies have finished.  The first job of each port is
+ready at the time it was added in the trace (as the time taken to load a port
+is not under the control of the scheduler).  Attribute jobs are not simulated.
+
+The policies order the ready jobs of a queue by:
+    priority - the (recorded) priority of the port, highest first
+    fifo     - the time the job became ready
+    longest  - the recorded duration of the job, longest first
+    shortest - the recorded duration of the job, shortest first
+
+Usage: replay.py [-j QUEUE=LOAD,...] [-p POLICY,...] TRACE
+"""
+
+from __future__ import absolute_import
+
+import collections
+import heapq
+import json
+import optparse
+
+#: The policies, the key used to order the ready jobs
+POLICIES = collections.OrderedDict((
+        ("priority", lambda job, ready: (-job.priority, ready)),
+        ("fifo",     lambda job, ready: (ready,)),
+        ("longest",  lambda job, ready: (-job.duration, ready)),
+        ("shortest", lambda job, ready: (job.duration, ready)),
+    ))
+
+#: The stages that require a port's dependencies
+DEPEND_STAGES = ("Build", "Install", "Package", "PkgInstall", "RepoInstall")
+
+
+class Job(object):
+    """A job run from the trace."""
+
+    def __init__(self, queue, name, origin, priority, load, added):
+        self.queue = queue
+        self.name = name
+        self.origin = origin
+        self.priority = priority
+        self.load = load
+        self.added = added
+        self.started = None
+        self.finished = None
+
+    @property
+    def duration(self):
+        """The (recorded) duration of the job."""
+        return self.finished - self.started
+
+
+def load(path):
+    """Load a trace, returns the queue loads, the completed jobs (in order
+    added) and the dependencies of each port."""
+    loads = {}
+    jobs = []
+    depends = {}
+    queued = {}  #: Jobs not yet finished, by (queue, name, origin)
+    for line in open(path):
+        if not line.endswith("\n"):
+            # Partially written record
+            break
+        record = json.loads(line)
+        time, kind = record[:2]
+        if kind == "loads":
+            loads = record[2]
+        elif kind == "add":
+            queue, name, origin, priority, load_ = record[2:]
+            job = Job(queue, name, origin, priority, load_, time)
+            queued[(queue, name, origin)] = job
+            jobs.append(job)
+        elif kind == "start":
+            job = queued.get(tuple(record[2:5]))
+            if job is not None:
+                job.started = time
+                job.priority = record[5]
+        elif kind == "stall":
+            job = queued.get(tuple(record[2:5]))
+            if job is not None:
+                job.started = None
+        elif kind == "done":
+            job = queued.pop(tuple(record[2:5]), None)
+            if job is not None and job.started is not None:
+                job.finished = time
+        elif kind == "depends":
+            depends[record[2]] = record[3]
+    jobs = [i for i in jobs if i.finished is not None]
+    return loads, jobs, depends
+
+
+def timeline(loads, jobs):
+    """Print the timeline of the traced build."""
+    start = min(i.added for i in jobs)
+    end = max(i.finished for i in jobs)
+    print "Traced:\t%.1fs (%i jobs)" % (end - start, len(jobs))
+    print "%10s %6s %5s %7s %9s %9s" % (
+            "queue", "load", "jobs", "util", "mean wait", "max wait")
+    by_queue = collections.defaultdict(list)
+    for job in jobs:
+        by_queue[job.queue].append(job)
+    for queue in sorted(by_queue):
+        run = by_queue[queue]
+        busy = sum(i.duration * i.load for i in run)
+        waits = [i.started - i.added for i in run]
+        capacity = loads.get(queue, 1) * max(end - start, 1e-9)
+        print "%10s %6s %5i %6.1f%% %8.1fs %8.1fs" % (
+                queue, loads.get(queue, "?"), len(run), 100 * busy / capacity,
+                sum(waits) / len(waits), max(waits))
+
+
+def simulate(loads, jobs, depends, policy):
+    """Simulate the build under policy, returns its length and the number of
+    jobs run."""
+    key = POLICIES[policy]
+    jobs = [i for i in jobs if i.name != "attr"]
+    by_port = collections.defaultdict(list)
+    for job in jobs:
+        by_port[job.origin].append(job)
+    dependants = collections.defaultdict(list)
+    for origin, ports in depends.iteritems():
+        for depend in ports:
+            if depend in by_port:
+                dependants[depend].append(origin)
+
+    # The number of unfinished prerequisites of each job
+    waiting = {}
+    for origin, run in by_port.iteritems():
+        deps = sum(1 for i in depends.get(origin, ()) if i in by_port)
+        for idx, job in enumerate(run):
+            waiting[job] = (1 if idx else 0) + (
+                    deps if job.name in DEPEND_STAGES else 0)
+    remaining = dict((i, len(j)) for i, j in by_port.iteritems())
+
+    ready = collections.defaultdict(list)
+    active = collections.defaultdict(int)
+    finish = []  #: Heap of (time, sequence, job)
+    release = []  #: Heap of (time, sequence, job), the first job of ports
+    seq = [0]
+
+    def make_ready(job, time):
+        """Add a job to its queue's ready jobs."""
+        seq[0] += 1
+        heapq.heappush(ready[job.queue], (key(job, time), seq[0], job))
+
+    def prerequisite_done(job, time):
+        """A prerequisite of job has finished."""
+        waiting[job] -= 1
+        if not waiting[job]:
+            make_ready(job, time)
+
+    for run in by_port.itervalues():
+        if not waiting[run[0]]:
+            seq[0] += 1
+            heapq.heappush(release, (run[0].added, seq[0], run[0]))
+
+    time = min(i.added for i in jobs)
+    started = 0
+    while release or finish or any(ready.itervalues()):
+        # Start all the jobs that may run
+        for queue, jobs_ready in ready.iteritems():
+            load = loads.get(queue, 1)
+            while jobs_ready and active[queue] < load:
+                if jobs_ready[0][2].load <= load - active[queue]:
+                    job = heapq.heappop(jobs_ready)[2]
+                else:
+                    # As QueueManager: the first job that fits, otherwise
+                    # the job with the least load
+                    items = sorted(jobs_ready)
+                    fits = [i for i in items
+                            if i[2].load <= load - active[queue]]
+                    item = fits[0] if fits else min(
+                            items, key=lambda x: (x[2].load, x))
+                    jobs_ready.remove(item)
+                    heapq.heapify(jobs_ready)
+                    job = item[2]
+                active[queue] += job.load
+                started += 1
+                seq[0] += 1
+                heapq.heappush(finish, (time + job.duration, seq[0], job))
+
+        # Advance to the next event
+        if release and (not finish or release[0][0] <= finish[0][0]):
+            released, _, job = heapq.heappop(release)
+            time = max(time, released)
+            make_ready(job, time)
+            continue
+        if not finish:
+            break
+        time, _, job = heapq.heappop(finish)
+        active[job.queue] -= job.load
+        run = by_port[job.origin]
+        idx = run.index(job)
+        if idx + 1 < len(run):
+            prerequisite_done(run[idx + 1], time)
+        remaining[job.origin] -= 1
+        if not remaining[job.origin]:
+            for dependant in dependants[job.origin]:
+                for i in by_port[dependant]:
+                    if i.name in DEPEND_STAGES:
+                        prerequisite_done(i, time)
+    return time - min(i.added for i in jobs), started
+
+
+def main():
+    """Rebuild the timeline of a trace and simulate the given policies."""
+    parser = optparse.OptionParser("%prog [-j QUEUE=LOAD,...] "
+                                   "[-p POLICY,...] TRACE")
+    parser.add_option("-j", dest="loads", default="",
+                      help="Override the queue loads")
+    parser.add_option("-p", dest="policies", default=",".join(POLICIES),
+                      help="The policies simulated (%s)" % ", ".join(POLICIES))
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error("a single trace is required")
+
+    loads, jobs, depends = load(args[0])
+    if not jobs:
+        parser.error("no completed jobs in trace")
+    timeline(loads, jobs)
+
+    loads = dict(loads)
+    for item in filter(None, options.loads.split(",")):
+        queue, _, load_ = item.partition("=")
+        try:
+            loads[queue] = int(load_)
+        except ValueError:
+            parser.error("unknown load for queue '%s'" % queue)
+    for policy in options.policies.split(","):
+        if policy not in POLICIES:
+            parser.error("unknown policy '%s'" % policy)
+        length, started = simulate(loads, jobs, depends, policy)
+        print "Simulated (%s):\t%.1fs (%i jobs)" % (policy, length, started)
+
+
+if __name__ == "__main__":
+    main()
@@ -21,7 +21,6 @@ database.
 
 from __future__ import absolute_import
 
-import bisect
 import collections
 import os
 
@@ -30,6 +29,85 @@ from libpb import builder, event, queue
 __all__ = ["event", "state", "stop"]
 
 
+def _priority(port):
+    """The sort key of a port, the highest priority first."""
+    return -port.dependent.priority
+
+
+class PortList(object):
+    """
+    A list of ports with constant time membership, addition and removal.
+
+    Removed ports are left in the list, and the list only compacted, when
+    next read (or once the removed ports outnumber those present).  If the
+    list is ordered, by key, it is sorted when next read after a port has been
+    added (or resort() called), ports of equal key remain in insertion order.
+    """
+
+    #: The number of removed ports always allowed to remain in the list
+    SLACK = 64
+
+    def __init__(self, key=None):
+        """Initialise an empty list, ordered by key if given."""
+        self._key = key
+        self._ports = []       #: The ports (including those removed)
+        self._members = set()  #: The ports in the list
+        self._removed = set()  #: The removed ports still in the list
+        self._sorted = True    #: If the list is in order
+
+    def __contains__(self, port):
+        return port in self._members
+
+    def __getitem__(self, index):
+        return self._list()[index]
+
+    def __iter__(self):
+        return iter(self._list())
+
+    def __len__(self):
+        return len(self._members)
+
+    def __nonzero__(self):
+        return bool(self._members)
+
+    def add(self, port):
+        """Append a port to the list."""
+        assert port not in self._members
+        if port in self._removed:
+            self._compact()
+        self._members.add(port)
+        self._ports.append(port)
+        if self._key is not None:
+            self._sorted = False
+
+    def remove(self, port):
+        """Remove a port from the list."""
+        self._members.remove(port)
+        self._removed.add(port)
+        if len(self._removed) > max(self.SLACK, len(self._members)):
+            self._compact()
+
+    def resort(self):
+        """Indicate the keys of the ports have changed."""
+        if self._key is not None and len(self._ports) > 1:
+            self._sorted = False
+
+    def _compact(self):
+        """Drop the removed ports from the list."""
+        removed = self._removed
+        self._ports = [i for i in self._ports if i not in removed]
+        self._removed = set()
+
+    def _list(self):
+        """The ports, in order."""
+        if self._removed:
+            self._compact()
+        if not self._sorted:
+            self._ports.sort(key=self._key)
+            self._sorted = True
+        return self._ports
+
+
 class StateTracker(object):
     """Track the state of the port builder."""
 
@@ -41,11 +119,12 @@ class StateTracker(object):
             self.builder = builder
             self.stage = builder.stage
             self._state = state
-            self.active  = []
-            self.queued  = []
-            self.pending = []
-            self.failed  = []
-            self.done    = []
+            self.active  = PortList()
+            self.queued  = PortList(_priority)
+            self.pending = PortList(_priority)
+            self.failed  = PortList()
+            self.done    = PortList()
+            self.direct  = PortList()  #: Failed ports that failed themselves
             self.status = {
                     builder.ADDED:   self.pending,
                     builder.QUEUED:  self.queued,
@@ -66,19 +145,20 @@ class StateTracker(object):
             """Handle a change in the stage builder."""
             from .builder import Builder
 
+            self._state.version += 1
             if status == Builder.ADDED:
                 assert port not in self.ports
                 assert port not in self.failed
                 assert port not in self.done
                 if self._state.stage_started(self, port):
-                    bisect.insort(self.pending, port)
+                    self.pending.add(port)
                 self.ports.add(port)
             elif status == Builder.QUEUED:
                 self.pending.remove(port)
-                bisect.insort(self.queued, port)
+                self.queued.add(port)
             elif status == Builder.ACTIVE:
                 self.queued.remove(port)
-                self.active.append(port)
+                self.active.add(port)
             else:  # status in (FAILED, SUCCEEDED, SKIPPED, DONE)
                 self.ports.remove(port)
                 if port in self.active:
@@ -89,9 +169,11 @@ class StateTracker(object):
                     self.pending.remove(port)
                 if self.stage in port.stages:
                     if status == Builder.FAILED:
-                        self.failed.append(port)
+                        self.failed.add(port)
+                        if "failed" in port.flags:
+                            self.direct.add(port)
                     elif status == Builder.DONE:
-                        self.done.append(port)
+                        self.done.add(port)
                 self._state.stage_finished(self, port)
 
         def cleanup(self):
@@ -101,9 +183,15 @@ class StateTracker(object):
     def __init__(self):
         """Initialise the StateTracker."""
         self.stages = collections.OrderedDict()
+        self._next = {}  #: The stages that directly follow each stage
         for b in builder.builders.values():
             self.stages[b.stage] = StateTracker.Stage(b, self)
+            self._next[b.stage] = []
+        for stage in self.stages:
+            if stage.prev in self._next:
+                self._next[stage.prev].append(stage)
 
+        self.version = 0  #: Changed whenever the state (or an order) changes
         self._resort = False
         # Resort when the port has initialised it's dependency class.
         builder.depend.update.connect(self._sort)
@@ -118,59 +206,72 @@ class StateTracker(object):
         """Get the Stage object for stage."""
         return self.stages[stage]
 
+    def resort(self):
+        """Indicate the priority of ports have changed."""
+        self._resort = True
+        self.version += 1
+
     def sort(self):
         """Do any sorting required for the various stages."""
+        # NOTE: the lists are sorted when next read
         if self._resort:
             for stage in self.stages.values():
-                stage.pending.sort()
-                stage.queued.sort()
+                stage.pending.resort()
+                stage.queued.resort()
             self._resort = False
 
+    def port_failed(self, port):
+        """Indicate port has failed itself (and not only a dependency)."""
+        self.version += 1
+        for stage in self.stages.values():
+            if port in stage.failed and port not in stage.direct:
+                stage.direct.add(port)
+
     def stage_started(self, stage, port):
         """Indicate if the stage is the current primary for port."""
-        stages = set((stage.stage,))
-        stage = stage.stage.prev
-        while stage:
-            if port in self.stages[stage].ports:
+        prev = stage.stage.prev
+        while prev:
+            if port in self.stages[prev].ports:
                 return False
-            stage = stage.prev
-        for stage in self.stages:
-            if stage.prev in stages:
+            prev = prev.prev
+        stages = [stage.stage]
+        while stages:
+            for stage in self._next[stages.pop()]:
                 if port in self.stages[stage].ports:
                     self.stages[stage].pending.remove(port)
                 else:
-                    stages.add(stage)
+                    stages.append(stage)
         return True
 
     def stage_finished(self, stage, port):
         """Transfer primary stage to the next stage handler."""
-        stages = set((stage.stage,))
-        for stage in self.stages:
-            if stage.prev in stages:
-                if port in self.stages[stage].ports:
-                    if port in self.stages[stage].failed:
+        stages = [stage.stage]
+        while stages:
+            for stage in self._next[stages.pop()]:
+                stage = self.stages[stage]
+                if port in stage.ports:
+                    if port in stage.failed:
                         continue
-                    assert port not in self.stages[stage].pending
-                    assert port not in self.stages[stage].done
-                    if self._resort:
-                        self.stages[stage].pending.append(port)
-                    else:
-                        bisect.insort(self.stages[stage].pending, port)
+                    assert port not in stage.pending
+                    assert port not in stage.done
+                    stage.pending.add(port)
                 else:
-                    stages.add(stage)
+                    stages.append(stage.stage)
 
     def _sort(self, _builder, status, _port):
         """Handle changes that require a resort (due to changes in priority)"""
         from .builder import Builder
         if status in (Builder.FAILED, Builder.SUCCEEDED):
-            self._resort = True
+            self.resort()
 
 
 def stop(kill=False, kill_clean=False):
     """Stop building ports and cleanup."""
     from .env import CPUS, flags
+    from . import cgroup, fetch, log
     import signal
 
+    log.flush()
     if flags["no_op"]:
         raise SystemExit(254)
 
@@ -180,14 +281,18 @@ def stop(kill=False, kill_clean=False):
     if kill_clean:
         kill_queues += (queue.clean,)
 
-    # Kill all active jobs
+    # Abort the native downloads
+    fetch.abort()
+
+    # Kill all active jobs (and all processes in their cgroup, if contained)
+    sig = signal.SIGKILL if kill else signal.SIGTERM
     for q in kill_queues:
-        for pid in (job.pid for job in q.active if job.pid):
+        for job in q.active:
+            cgroup.kill(job, sig)
+            if not job.pid:
+                continue
             try:
-                if kill:
-                    os.killpg(pid, signal.SIGKILL)
-                else:
-                    os.killpg(pid, signal.SIGTERM)
+                os.killpg(job.pid, sig)
             except OSError:
                 pass
 
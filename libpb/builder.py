@@ -5,10 +5,11 @@ from __future__ import absolute_import
 import abc
 import collections
 
-from libpb import env, event, job, log, queue, signal, stacks
+from libpb import (env, event, job, journal, log, metrics, queue, signal,
+                   stacks, trace)
 
 __all__ = [
-        "Builder", "builders", "depend_resolve",
+        "Builder", "builders", "cancel", "depend_resolve",
     ]
 
 
@@ -32,7 +33,9 @@ class DependLoader(object):
             return sig
         else:
             sig = signal.Signal()
-            self.method[port] = env.flags["method"][0]
+            # Resume with the method last used (if resuming)
+            self.method[port] = (journal.resume_method(port) or
+                                 env.flags["method"][0])
 
             for builder, method in zip((install, pkginstall, repoinstall),
                                        ("build", "package", "repo")):
@@ -62,12 +65,16 @@ class DependLoader(object):
             # If the port failed and there is another method to try
             if self._find_method(stagejob.port):
                 return
+        else:
+            metrics.resolved(stagejob.stack.name)
 
         self.ports.pop(stagejob.port).emit(stagejob.port)
         self.finished.add(stagejob.port)
 
     def _find_method(self, port):
         """Find a method to resolve the port."""
+        from . import state
+
         while True:
             method = self.method[port]
             if not method:
@@ -76,6 +83,7 @@ class DependLoader(object):
                 for stack in port.stacks.values():
                     if stack.failed and stack.failed is not True:
                         port.flags.add("failed")
+                        state.port_failed(port)
                         break
                 port.dependent.status_changed(exhausted=True)
                 if port.dependent.failed and not port.dependency.failed:
@@ -89,6 +97,8 @@ class DependLoader(object):
                     log.debug("DependLoader._find_method()",
                               "Port '%s': resolving using method '%s'" %
                                   (port.origin, method))
+                    journal.method(port, method)
+                    trace.method(port, method)
                     return True
                 else:
                     log.debug("DependLoader._find_method()",
@@ -330,6 +340,9 @@ class StageBuilder(Builder):
             return
 
         if env.flags["mode"] == "recursive":
+            # NOTE: the indirect dependencies are waited on by the builders of
+            # the direct dependencies (and, of a resolved dependency, may not
+            # be loaded)
             depends = port.dependency.get(self.stage)
         else:
             depends = port.dependency.check(self.stage)
@@ -351,6 +364,34 @@ class StageBuilder(Builder):
         if not self._pending[port]:
             self._port_ready(port)
 
+    def cancel(self, port):
+        """Fail a port that is waiting for its dependencies or prior stage."""
+        if port in self._pending:
+            log.debug("StageBuilder.cancel()",
+                      "Port '%s': cancelled stage %s" %
+                          (port.origin, self.stage.name))
+            if not self.ports[port].stack.failed:
+                self.ports[port].stack.failed = True
+            self._port_failed(port)
+
+    def reserve(self, port):
+        """Reserve the queue for port's stage job, if it will be ready as soon
+        as its previous stage completes (and may then start without waiting
+        on the queue), returns the stage job (otherwise None)."""
+        stagejob = self.ports.get(port)
+        q = self.queue
+        if (stagejob is None or self._pending.get(port) != 1 or
+                self.stage.prev in port.stages or
+                not self._port_check(port) or stagejob.complete() or
+                q.queue or q.stalled or
+                q.active_load + stagejob.load > q.load):
+            return None
+        log.debug("StageBuilder.reserve()",
+                  "Port '%s': reserved queue for stage %s" %
+                      (port.origin, self.stage.name))
+        q.reserve(stagejob)
+        return stagejob
+
     def _started(self, stagejob):
         """Emit a signal to indicate a port for this stage has become active."""
         self.update.emit(self, Builder.ACTIVE, stagejob.port)
@@ -399,6 +440,8 @@ class StageBuilder(Builder):
     def _stage_resolv(self, stagejob):
         """Update pending structures for resolved prior stage."""
         port = stagejob.port
+        if port in self.failed:
+            return
         if not stagejob.stack.failed and env.flags["mode"] != "clean":
             self._pending[port] -= 1
             if not self._pending[port]:
@@ -417,7 +460,7 @@ class StageBuilder(Builder):
         """Add a port to the stage queue."""
         assert not self._pending[port]
         assert not self.ports[port].stack.failed
-        assert not port.dependency.check(self.stage)
+        assert not port.dependency.blocked(self.stage)
         del self._pending[port]
         stagejob = self.ports[port]
         if self._port_check(port):
@@ -483,6 +526,13 @@ class PackageBuilder(StageBuilder):
                     self.stage.prev in port.stages)
 
 
+def cancel(port):
+    """Fail all stages of a port that are waiting to be built."""
+    for builder in builders.values():
+        if isinstance(builder, StageBuilder):
+            builder.cancel(port)
+
+
 depend_resolve = DependLoader()
 
 builders = collections.OrderedDict((
@@ -0,0 +1,388 @@
+"""
+The buildlog module.  This module streams the build logs of ports through a
+compressor, caps their size and keeps the log directory within a quota.
+
+The output of a port's commands is piped to portbuilder, and appended (as it
+is read on the event loop) to the port's compressed log (log_file.gz,
+readable with zcat(1) even if several logs have been appended) as gzip
+members.  If a log grows larger than flags["log_cap"] only its head and tail
+are kept: the members following the head are then held in memory, the oldest
+dropped, and written once the log is closed.
+
+A log is closed once it is kept (i.e. the port failed, or was not cleaned),
+or discarded (once the port has been cleaned).  Once the kept logs exceed
+flags["log_quota"] the oldest logs of ports that did not fail (starting with
+those of previous runs) are removed.
+"""
+
+from __future__ import absolute_import
+
+import collections
+import errno
+import fcntl
+import os
+import zlib
+
+from libpb import env, event, log
+
+__all__ = [
+        "discard", "follow", "keep", "moved", "read", "start", "streaming",
+        "write"
+    ]
+
+#: The size (in bytes) of the head of a capped log
+HEAD = 1024 * 1024
+
+#: The size (in bytes) of log in each gzip member following the head
+SEGMENT = 1024 * 1024
+
+#: The size (in bytes) of the end of a log held in memory (see read())
+RECENT = 64 * 1024
+
+#: The compression level (favouring speed, as logs are compressed inline)
+LEVEL = 1
+
+
+def _member():
+    """A compressor for a gzip member."""
+    return zlib.compressobj(LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+
+class BuildLog(object):
+    """The (compressed) build log of a port, as it is written.
+
+    The log is appended as gzip members: the head, then members of SEGMENT
+    bytes.  Once the log exceeds its cap the members following the head are
+    moved (from the file) to memory, and the oldest members dropped to keep
+    the tail within the cap."""
+
+    def __init__(self, path, cap):
+        """Initialise appending the log to path, capped to cap bytes."""
+        self.path = path
+        self.size = 0        #: The size of the log (uncompressed)
+        self.recent = ""     #: The end of the log
+        self._file = open(path, "ab")
+        self._offset = os.fstat(self._file.fileno()).st_size
+        self._start = self._offset  #: The size of the file when opened
+        if cap:
+            self._head = min(HEAD, cap // 2)
+            self._window = cap - self._head  #: The size of the tail
+            self._segment = max(1, min(SEGMENT, self._window // 4))
+        else:
+            self._head = self._window = self._segment = None
+        self._compress = None  #: The compressor of the current member
+        self._length = 0       #: The size of the current member
+        self._begin = None     #: The offset of the current member
+        self._members = collections.deque()  #: The offset and size of members
+        self._tail = 0         #: The size of the members after the head
+        self._held = None      #: The members held in memory (once capped)
+        self._buffer = []      #: The current member (once capped)
+        self._omitted = 0      #: The size of the dropped members
+
+    def write(self, data):
+        """Append data to the log."""
+        self.size += len(data)
+        self.recent = (self.recent + data)[-RECENT:]
+        while data:
+            if self._compress is None:
+                self._compress = _member()
+                self._length = 0
+                self._begin = self._offset
+            written = self.size - len(data)
+            if self._head is None:
+                limit, tail = len(data), False
+            elif written < self._head:
+                limit, tail = self._head - written, False
+            else:
+                limit, tail = self._segment - self._length, True
+            chunk, data = data[:limit], data[limit:]
+            self._output(self._compress.compress(chunk))
+            self._length += len(chunk)
+            if self._head is not None:
+                if tail:
+                    self._tail += len(chunk)
+                if len(chunk) == limit:
+                    self._end_member(tail)
+                if self._tail > self._window:
+                    self._drop()
+
+    def _output(self, data):
+        """Write compressed data to the file (or, once capped, memory)."""
+        if not data:
+            return
+        if self._held is None:
+            self._file.write(data)
+            self._offset += len(data)
+        else:
+            self._buffer.append(data)
+
+    def _end_member(self, tail):
+        """Finish the current member."""
+        self._output(self._compress.flush())
+        self._compress = None
+        if not tail:
+            return
+        if self._held is None:
+            self._members.append((self._begin, self._length))
+        else:
+            self._held.append(("".join(self._buffer), self._length))
+            self._buffer = []
+
+    def _drop(self):
+        """Drop the oldest members following the head, once capped."""
+        if self._held is None:
+            # Move the members following the head from the file to memory
+            self._file.flush()
+            current = self._compress is not None
+            begin = self._members[0][0] if self._members else self._begin
+            with open(self.path, "rb") as log_file:
+                log_file.seek(begin)
+                data = log_file.read(self._offset - begin)
+            self._held = collections.deque()
+            offsets = [i for i, _ in self._members]
+            offsets.append(self._begin if current else self._offset)
+            for idx, (_, length) in enumerate(self._members):
+                self._held.append((data[offsets[idx] - begin:
+                                        offsets[idx + 1] - begin], length))
+            if current:
+                self._buffer = [data[self._begin - begin:]]
+            self._members.clear()
+            os.ftruncate(self._file.fileno(), begin)
+            self._offset = begin
+        while self._tail > self._window and self._held:
+            _, length = self._held.popleft()
+            self._tail -= length
+            self._omitted += length
+
+    def close(self):
+        """Finish the log, returns the change in size of the file."""
+        if self._compress is not None:
+            self._end_member(self._held is not None)
+        if self._held is not None:
+            if self._omitted:
+                note = _member()
+                self._held.appendleft((note.compress(
+                        "\n# ... %i bytes omitted ...\n" % self._omitted) +
+                        note.flush(), 0))
+            self._held, held = None, self._held
+            for data, _ in held:
+                self._output(data)
+        self._file.close()
+        return self._offset - self._start
+
+    def discard(self):
+        """Remove the log (leaving any logs it was appended to)."""
+        self._file.close()
+        if self._start:
+            with open(self.path, "ab") as log_file:
+                log_file.truncate(self._start)
+        else:
+            os.unlink(self.path)
+
+
+class Follower(object):
+    """Logs the (merged) output of a process to its port's log."""
+
+    def __init__(self, port, process):
+        """Follow the output of process, logging it for port."""
+        self.port = port
+        self.process = process
+        self._fd = process.stdout.fileno()
+        fcntl.fcntl(self._fd, fcntl.F_SETFL,
+                    fcntl.fcntl(self._fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        event.event(process.stdout, "r").connect(self._read)
+        # NOTE: connected first, so the output is logged before the process'
+        # exit is handled by others
+        process.connect(self._exit)
+
+    def _read(self):
+        """Log the process' output."""
+        if self.process.stdout.closed:
+            # Stale event
+            return
+        while True:
+            try:
+                data = os.read(self._fd, 65536)
+            except OSError, e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    return
+                raise
+            if not data:
+                break
+            write(self.port, data)
+        self._close()
+
+    def _exit(self, _process):
+        """Log the remaining output once the process has exited."""
+        if not self.process.stdout.closed:
+            self._read()
+            if not self.process.stdout.closed:
+                # Output still held open (i.e. by a daemon)
+                self._close()
+
+    def _close(self):
+        """Stop following the output."""
+        event.event(self.process.stdout, "r", clear=True)
+        self.process.stdout.close()
+
+
+class BuildLogs(object):
+    """The build logs, being written and kept."""
+
+    def __init__(self):
+        """Initialise the build logs (from the compressed logs present)."""
+        self._usage = 0  #: The size of all compressed logs
+        self._evictable = collections.OrderedDict()  #: Oldest first
+        self._logs = {}  #: The logs being written, by port
+
+        log_dir = env.flags["log_dir"]
+        logs = []
+        for name in os.listdir(log_dir):
+            if name.endswith(".gz"):
+                path = os.path.join(log_dir, name)
+                stat = os.stat(path)
+                logs.append((stat.st_mtime, path, stat.st_size))
+        for _mtime, path, size in sorted(logs):
+            self._evictable[path] = size
+            self._usage += size
+
+    def write(self, port, data):
+        """Append data to the build log of port."""
+        build_log = self._logs.get(port)
+        if build_log is None:
+            build_log = BuildLog(port.log_file + ".gz", env.flags["log_cap"])
+            self._logs[port] = build_log
+        try:
+            build_log.write(data)
+        except (IOError, OSError), e:
+            log.error("BuildLogs.write()", "Unable to write log '%s': %s" %
+                          (build_log.path, e))
+
+    def read(self, port):
+        """The size of the build log of port, and its end (if written)."""
+        build_log = self._logs.get(port)
+        if build_log is None:
+            return None
+        return build_log.size, build_log.recent
+
+    def keep(self, port, failed):
+        """Finish the build log of port (if any)."""
+        build_log = self._logs.pop(port, None)
+        if build_log is None:
+            return
+        try:
+            change = build_log.close()
+        except (IOError, OSError), e:
+            log.error("BuildLogs.keep()", "Unable to write log '%s': %s" %
+                          (build_log.path, e))
+        else:
+            self._kept(build_log.path, change, failed)
+
+    def discard(self, port):
+        """Remove the build log of port (if any)."""
+        build_log = self._logs.pop(port, None)
+        if build_log is None:
+            return
+        try:
+            build_log.discard()
+        except (IOError, OSError), e:
+            log.error("BuildLogs.discard()", "Unable to remove log '%s': %s" %
+                          (build_log.path, e))
+
+    def moved(self, port, log_file):
+        """Move the build log of port, from log_file."""
+        build_log = self._logs.get(port)
+        if build_log is None:
+            return
+        path = port.log_file + ".gz"
+        if os.path.exists(path):
+            # Do not mix with another port's log, keep it under the old name
+            self.keep(port, False)
+        else:
+            os.rename(build_log.path, path)
+            build_log.path = path
+
+    def _kept(self, path, change, failed):
+        """Account for a (changed) compressed log."""
+        self._usage += change
+        size = self._evictable.pop(path, 0) + change
+        if not failed:
+            self._evictable[path] = size
+
+        quota = env.flags["log_quota"]
+        while quota and self._usage > quota and self._evictable:
+            path, size = self._evictable.popitem(last=False)
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            self._usage -= size
+            log.debug("BuildLogs._kept()", "Removed log '%s' (quota)" % path)
+
+    def flush(self):
+        """Finish the logs still being written (as they are kept)."""
+        for port in self._logs.keys():
+            self.keep(port, port.dependent.failed)
+
+
+_logs = None
+
+
+def start():
+    """Start streaming build logs (and finish those still being written when
+    the event loop stops)."""
+    global _logs
+
+    _logs = BuildLogs()
+    event.stop.connect(_logs.flush)
+
+
+def streaming():
+    """Indicate if the build logs are streamed (otherwise the output of
+    commands is written directly to the log file)."""
+    return _logs is not None
+
+
+def write(port, data):
+    """Append data to the build log of port."""
+    if _logs is not None:
+        _logs.write(port, data)
+    else:
+        with open(port.log_file, "a") as log_file:
+            log_file.write(data)
+
+
+def follow(port, process):
+    """Log the (merged) output of process to the build log of port."""
+    Follower(port, process)
+
+
+def read(port):
+    """The size of the build log of port and (up to RECENT bytes of) its end,
+    if the log is being streamed (otherwise None)."""
+    if _logs is not None:
+        return _logs.read(port)
+    return None
+
+
+def keep(port, failed=False):
+    """Finish the build log of port, as it is being kept."""
+    if _logs is not None:
+        _logs.keep(port, failed)
+
+
+def discard(port):
+    """Remove the build log of port."""
+    if _logs is not None:
+        _logs.discard(port)
+    if os.path.isfile(port.log_file):
+        os.unlink(port.log_file)
+
+
+def moved(port, log_file):
+    """Move the build log of port, as its log file has changed from
+    log_file."""
+    if _logs is not None:
+        _logs.moved(port, log_file)
+    if os.path.isfile(log_file):
+        os.rename(log_file, port.log_file)
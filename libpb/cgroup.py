@@ -0,0 +1,332 @@
+"""
+The cgroup module.  This module contains the subprocesses of each stage of a
+port in a cgroup v2 leaf (on Linux, where the unified hierarchy is mounted
+and portbuilder's cgroup is delegated to it, e.g. by systemd's Delegate=yes).
+
+The leaf's CPU bandwidth (cpu.max) is limited to the stage's load (in CPUs)
+and its memory (memory.max) to flags["cgroup_memory"], so that a runaway
+build is throttled (or killed by the OOM killer, as a whole) instead of
+degrading the builds of other ports.  When the stage finishes the CPU, memory
+and I/O used by its leaf are read back (see Stage.accounting), any processes
+left behind are killed and the leaf is removed.  Stopping a stage signals
+every process in its leaf (see kill()).
+
+portbuilder moves itself into the leaf "portbuilder" of its cgroup (as
+processes may only be in leaves of a cgroup with controllers enabled) and the
+stages' leaves are created under "jobs".  posix_spawn(3) cannot start a
+process in a cgroup, so each subprocess first moves itself into its stage's
+leaf (see wrap()).  If cgroups are not available subprocesses are run as
+before.
+"""
+
+from __future__ import absolute_import, with_statement
+
+import copy
+import errno
+import os
+import signal
+import sys
+
+from libpb import env, event, log
+
+__all__ = ["Accounting", "fuse", "kill", "release", "stage_finished",
+           "stage_stalled", "stage_started", "start", "wrap"]
+
+#: The mount point of the cgroup v2 (unified) hierarchy
+ROOT = "/sys/fs/cgroup"
+
+#: The controllers enabled for the stages' leaves (cpu and memory required)
+CONTROLLERS = ("cpu", "io", "memory")
+
+#: The period (in microseconds) of the CPU bandwidth limit
+PERIOD = 100000
+
+#: Moves the shell into the cgroup (ignoring failure) then executes the command
+SCRIPT = '{ echo $$ >"$1"; } 2>/dev/null; shift; exec "$@"'
+
+
+def _read(path):
+    """The contents of a cgroup file (or "" if it is not available)."""
+    try:
+        with open(path) as cgfile:
+            return cgfile.read()
+    except IOError:
+        return ""
+
+
+def _write(path, value):
+    """Write a value to a cgroup file."""
+    with open(path, "w") as cgfile:
+        cgfile.write(value)
+
+
+def _keyed(path):
+    """The values of a flat keyed cgroup file (e.g. cpu.stat)."""
+    values = {}
+    for line in _read(path).splitlines():
+        key, _, value = line.partition(" ")
+        if value.isdigit():
+            values[key] = int(value)
+    return values
+
+
+class Accounting(object):
+    """The resources used by the processes of a cgroup."""
+
+    def __init__(self, path):
+        """Read the resources used by the cgroup at path."""
+        cpu = _keyed(os.path.join(path, "cpu.stat"))
+        self.utime = cpu.get("user_usec", 0) / 1e6        #: User CPU time
+        self.stime = cpu.get("system_usec", 0) / 1e6      #: System CPU time
+        self.throttled = cpu.get("throttled_usec", 0) / 1e6  #: Time throttled
+        #: The peak memory usage (in bytes, requires Linux 5.19)
+        self.memory = int(_read(os.path.join(path, "memory.peak")) or 0)
+        #: The number of processes killed by the OOM killer
+        self.oom_kills = _keyed(os.path.join(path, "memory.events")).get(
+                "oom_kill", 0)
+        self.rbytes = 0  #: The bytes read from block devices
+        self.wbytes = 0  #: The bytes written to block devices
+        for line in _read(os.path.join(path, "io.stat")).splitlines():
+            for field in line.split()[1:]:
+                key, _, value = field.partition("=")
+                if key == "rbytes":
+                    self.rbytes += int(value)
+                elif key == "wbytes":
+                    self.wbytes += int(value)
+
+    def __str__(self):
+        return ("cpu %.1fs (user %.1fs, sys %.1fs, throttled %.1fs), "
+                "memory %.1fMiB (%i OOM kills), io %.1f/%.1fMiB (read/write)"
+                    % (self.cpu, self.utime, self.stime, self.throttled,
+                       self.memory / 1048576., self.oom_kills,
+                       self.rbytes / 1048576., self.wbytes / 1048576.))
+
+    @property
+    def cpu(self):
+        """The total CPU time (in seconds)."""
+        return self.utime + self.stime
+
+    def since(self, previous):
+        """The resources used since a previous accounting of the cgroup (the
+        peak memory usage remains that of the cgroup)."""
+        used = copy.copy(self)
+        for field in ("utime", "stime", "throttled", "oom_kills", "rbytes",
+                      "wbytes"):
+            setattr(used, field,
+                    getattr(self, field) - getattr(previous, field))
+        return used
+
+
+class Leaf(object):
+    """A cgroup leaf containing the subprocesses of (fused) stages."""
+
+    def __init__(self, path, stagejob):
+        """Create the leaf, limited for the stage job."""
+        self.path = path
+        self.stages = set([stagejob])  #: The stages using the leaf
+        self.accounting = None  #: The resources used by the finished stages
+
+        os.mkdir(path)
+        try:
+            self._write("cpu.max", "%i %i" % (stagejob.load * PERIOD, PERIOD))
+            if env.flags["cgroup_memory"]:
+                self._write("memory.max", str(env.flags["cgroup_memory"]))
+                self._write("memory.oom.group", "1")
+        except (IOError, OSError):
+            os.rmdir(path)
+            raise
+
+    def _write(self, name, value):
+        """Write a value to a file of the leaf."""
+        _write(os.path.join(self.path, name), value)
+
+    def procs(self):
+        """The processes in the leaf."""
+        return [int(i) for i in
+                _read(os.path.join(self.path, "cgroup.procs")).split()]
+
+    def kill(self, sig):
+        """Send a signal to all processes in the leaf."""
+        if sig == signal.SIGKILL:
+            try:
+                # NOTE: cgroup.kill requires Linux 5.14
+                self._write("cgroup.kill", "1")
+                return
+            except (IOError, OSError):
+                pass
+        for pid in self.procs():
+            try:
+                os.kill(pid, sig)
+            except OSError:
+                pass
+
+    def remove(self):
+        """Remove the leaf (killing any processes left), returns False if the
+        processes have not yet exited."""
+        if self.procs():
+            self.kill(signal.SIGKILL)
+        try:
+            os.rmdir(self.path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                return False
+        return True
+
+
+_jobs = None   #: The cgroup containing the stages' leaves (if available)
+_count = 0     #: The number of leaves created
+_active = {}   #: The stage being run by each port
+_leaves = {}   #: The leaf of each stage
+_stale = []    #: The leaves with processes yet to exit
+
+
+def start():
+    """Contain the subprocesses of stages in cgroups, if available."""
+    global _jobs
+
+    if not sys.platform.startswith("linux"):
+        return
+    try:
+        for line in _read("/proc/self/cgroup").splitlines():
+            if line.startswith("0::"):
+                base = os.path.join(ROOT, line[3:].strip().lstrip("/"))
+                break
+        else:
+            raise IOError("cgroup v2 hierarchy not mounted")
+        controllers = _read(os.path.join(base, "cgroup.controllers")).split()
+        if "cpu" not in controllers or "memory" not in controllers:
+            raise IOError("cpu and memory controllers not available")
+        enabled = [i for i in CONTROLLERS if i in controllers]
+        subtree_control = os.path.join(base, "cgroup.subtree_control")
+        previous = _read(subtree_control).split()
+    except (IOError, OSError), e:
+        log.debug("cgroup.start()", "Cgroups not available: %s" % e)
+        return
+
+    jobs = os.path.join(base, "jobs")
+    created = []
+    moved = False
+    added = []  #: The controllers enabled for the subtree of base
+    try:
+        for path in (os.path.join(base, "portbuilder"), jobs):
+            if not os.path.isdir(path):
+                os.mkdir(path)
+                created.append(path)
+        _write(os.path.join(base, "portbuilder", "cgroup.procs"),
+               str(os.getpid()))
+        moved = True
+        _write(subtree_control, " ".join("+" + i for i in enabled))
+        added = [i for i in enabled if i not in previous]
+        _write(os.path.join(jobs, "cgroup.subtree_control"),
+               " ".join("+" + i for i in enabled))
+    except (IOError, OSError), e:
+        log.debug("cgroup.start()", "Cgroups not available: %s" % e)
+        # Leave the hierarchy as it was found
+        try:
+            if added:
+                _write(subtree_control, " ".join("-" + i for i in added))
+            if moved:
+                _write(os.path.join(base, "cgroup.procs"), str(os.getpid()))
+            for path in reversed(created):
+                os.rmdir(path)
+        except (IOError, OSError), e:
+            log.error("cgroup.start()",
+                      "Unable to restore cgroup '%s': %s" % (base, e))
+        return
+    log.debug("cgroup.start()", "Containing stages in cgroup: %s" % jobs)
+    _jobs = jobs
+    event.stop.connect(_cleanup)
+
+
+def _cleanup():
+    """Remove the leaves left when the event loop stops."""
+    for leaf in set(_leaves.values()) | set(_stale):
+        leaf.remove()
+
+
+def stage_started(stagejob):
+    """Contain the subprocesses of the stage's port in the stage's leaf."""
+    if _jobs is not None:
+        _active[stagejob.port] = stagejob
+
+
+def stage_stalled(stagejob):
+    """Stop containing subprocesses in the stage's leaf, as it stalled."""
+    if _active.get(stagejob.port) is stagejob:
+        del _active[stagejob.port]
+
+
+def stage_finished(stagejob, status):
+    """Log the resources used by the stage's leaf."""
+    if _active.get(stagejob.port) is stagejob:
+        del _active[stagejob.port]
+    leaf = _leaves.get(stagejob)
+    if leaf is not None:
+        accounting = Accounting(leaf.path)
+        if leaf.accounting is not None:
+            # Only account the stage's phase of a fused make(1) command
+            stagejob.accounting = accounting.since(leaf.accounting)
+        else:
+            stagejob.accounting = accounting
+        leaf.accounting = accounting
+        log.debug("cgroup.stage_finished()",
+                  "Port '%s': %s stage %s (cgroup) used %s" %
+                      (stagejob.port.origin,
+                       "finished" if status else "failed", stagejob.name,
+                       stagejob.accounting))
+    release(stagejob)
+
+
+def release(stagejob):
+    """Release the stage job's leaf, removing it once no stage uses it."""
+    leaf = _leaves.pop(stagejob, None)
+    if leaf is not None:
+        leaf.stages.discard(stagejob)
+        if not leaf.stages and not leaf.remove():
+            _stale.append(leaf)
+    for leaf in list(_stale):
+        if leaf.remove():
+            _stale.remove(leaf)
+
+
+def fuse(stages):
+    """Share the leaf of the first stage with the following (fused) stages."""
+    leaf = _leaves.get(stages[0])
+    if leaf is not None:
+        for stagejob in stages[1:]:
+            _leaves[stagejob] = leaf
+            leaf.stages.add(stagejob)
+
+
+def wrap(port, args):
+    """The arguments to run a subprocess of port in its stage's leaf (if
+    any)."""
+    global _count
+
+    stagejob = _active.get(port)
+    if stagejob is None:
+        return args
+    leaf = _leaves.get(stagejob)
+    if leaf is None:
+        _count += 1
+        path = os.path.join(_jobs, "%s.%s.%i" % (
+                port.origin.replace("/", "_"), stagejob.name, _count))
+        try:
+            leaf = Leaf(path, stagejob)
+        except (IOError, OSError), e:
+            log.debug("cgroup.wrap()", "Port '%s': unable to create cgroup "
+                      "%s: %s" % (port.origin, path, e))
+            return args
+        _leaves[stagejob] = leaf
+    return ("sh", "-c", SCRIPT, "sh",
+            os.path.join(leaf.path, "cgroup.procs")) + args
+
+
+def kill(job, sig):
+    """Send a signal to all processes of the job's leaf, returns False if the
+    job is not contained in a leaf."""
+    leaf = _leaves.get(job)
+    if leaf is None:
+        return False
+    leaf.kill(sig)
+    return True
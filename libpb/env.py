@@ -5,21 +5,60 @@ from __future__ import absolute_import
 import os
 
 __all__ = [
-        "CPUS", "CONFIG", "DEPEND", "MODE", "PKG_MGMT", "STAGE", "TARGET",
-        "env", "master", "flags",
+        "CPUS", "CONFIG", "DEPEND", "LOG_LEVEL", "MODE", "PKG_MGMT", "STAGE",
+        "TARGET",
+        "Tracked", "env", "master", "flags",
     ]
 
+
+class Tracked(dict):
+    """A dictionary that counts the changes made to it (but not changes made
+    to the values themselves), so results derived from it may be cached."""
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.generation = 0
+
+    def __setitem__(self, key, value):
+        self.generation += 1
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        self.generation += 1
+        dict.__delitem__(self, key)
+
+    def clear(self):
+        self.generation += 1
+        dict.clear(self)
+
+    def pop(self, *args):
+        self.generation += 1
+        return dict.pop(self, *args)
+
+    def popitem(self):
+        self.generation += 1
+        return dict.popitem(self)
+
+    def setdefault(self, key, default=None):
+        self.generation += 1
+        return dict.setdefault(self, key, default)
+
+    def update(self, *args, **kwargs):
+        self.generation += 1
+        dict.update(self, *args, **kwargs)
+
+
 CPUS = os.sysconf("SC_NPROCESSORS_ONLN")
 
 PORTSDIR = "/usr/ports"
 PKG_CACHEDIR = "/var/cache/pkg"
 
-env = {}
-master = {
+env = Tracked()
+master = Tracked({
   "PORTSDIR"     : PORTSDIR,      # Ports directory
   "PKG_CACHEDIR" : PKG_CACHEDIR,  # Local cache of remote repositories
   "NUMBER_OF_CPUS" : CPUS         # Number of CPUs
-}
+})
 
 ###############################################################################
 # LIBPB STATE FLAGS
@@ -27,6 +66,14 @@ master = {
 # buildstatus - The minimum install stage required before a port will be build.
 #       This impacts when a dependency is considered resolved.
 #
+# cgroup - Contain the subprocesses of each stage of a port in a cgroup v2
+#       leaf (on Linux, where portbuilder's cgroup is delegated to it), with
+#       the CPU bandwidth limited to the stage's load.  If cgroups are not
+#       available subprocesses are not contained.
+#
+# cgroup_memory - The memory (in bytes) available to each port's stage when
+#       contained in a cgroup, or 0 for no limit.
+#
 # chroot - The chroot directory to use.  If blank then the current root
 #       (i.e. /) is used.  A mixture of `chroot' and direct file inspection is
 #       used when an actual chroot is specified.
@@ -45,11 +92,34 @@ master = {
 #
 # fetch_only - Only fetch a port's distfiles.
 #
+# fuse - Run the install and package stages of a port using a single make
+#       command, where the package stage need not wait for its dependencies or
+#       queue.  The package queue is reserved while the command runs, and the
+#       install stage finishes once its phase of the command has (as indicated
+#       by the command's output).  The resource usage of the command (see
+#       usage) is accounted to the package stage.
+#
+# log_cap - The size (in bytes) above which only the head and tail of a port
+#       build log are kept (as it is written), or 0 to keep the whole log.
+#
 # log_dir - Directory where the log files, of the port build, and for
 #       portbuilder, are stored.
 #
 # log_file - The log file for portbuilder
 #
+# log_level - The least level of messages written to the log file.  The
+#       currently supported levels are:
+#               debug   - all messages
+#               log     - all but debug messages
+#               error   - only errors
+#
+# log_size - The size (in bytes) at which the log file is rotated, or 0 to
+#       never rotate the log file.
+#
+# log_quota - The size (in bytes) of compressed port build logs above which
+#       the oldest logs of ports that did not fail are removed, or 0 to never
+#       remove logs.
+#
 # method - The methods used to resolve a dependency.  Multiple methods may be
 #       specified in a sequence but a method may only be used once.  Currently
 #       supported methods are:
@@ -65,6 +135,11 @@ master = {
 #               clean     - only cleanup of ports are allowed (used for early
 #                       program termination)
 #
+# native_fetch - Fetch the distfiles of ports natively (over HTTP and HTTPS,
+#       concurrently and verifying their checksums as they are downloaded),
+#       instead of by make(1), leaving to make(1) the distfiles that could not
+#       be fetched natively.
+#
 # no_op - Do not do anything (and behave as if the command was successful).
 #
 # no_op_print - When no_op is True, print the commands that would have been
@@ -75,6 +150,17 @@ master = {
 #               pkg     - The package tools shipped with FreeBSD base
 #               pkgng   - The next generation package tools shipped with ports
 #
+# spawn - Start (non-interactive) subprocesses using posix_spawn(3), where
+#       supported, instead of fork(2).
+#
+# tmpfs - The directory (on a memory backed file system, such as a tmpfs(5),
+#       within the chroot) in which the work directories of ports that are
+#       expected to fit the budget are placed, or blank to build all ports on
+#       disk.
+#
+# tmpfs_budget - The size (in bytes) of the work directories placed in the
+#       tmpfs directory, or 0 for the size of its file system.
+#
 # target - The dependency targets when building a port required by a dependant.
 #       The currently supported targets are:
 #               install   - install the port
@@ -83,24 +169,36 @@ master = {
 #                       after the install/package target indicating that the
 #                       port should cleaned before or after, respectively.
 CONFIG   = ("none", "changed", "newer", "all")
+LOG_LEVEL = ("debug", "log", "error")
 METHOD   = ("build", "package", "repo")
 MODE     = ("install", "recursive", "clean")
 PKG_MGMT = ("pkgng")
 STAGE    = (0, 1, 2, 3)
 TARGET   = ("clean", "install", "package")
-flags = {
+flags = Tracked({
   "buildstatus" : 0,                    # The minimum level for build
+  "cgroup"      : False,                # Contain stages in cgroups
+  "cgroup_memory" : 0,                  # Memory limit of a contained stage
   "chroot"      : "",                   # Chroot directory of system
   "config"      : "changed",            # Configure ports based on criteria
   "debug"       : True,                 # Print extra debug messages
   "fetch_only"  : False,                # Only fetch ports
+  "fuse"        : False,                # Fuse make commands of stages
+  "log_cap"     : 32 * 1024 * 1024,     # Size of a log before capping
   "log_dir"     : "/tmp/portbuilder",   # Directory for logging information
   "log_file"    : "portbuilder",        # General log file
+  "log_level"   : "debug",              # Least level of logged messages
+  "log_quota"   : 1024 * 1024 * 1024,   # Size of kept logs before removal
+  "log_size"    : 64 * 1024 * 1024,     # Size before rotating the log file
   "method"      : ["build"],            # Resolve dependencies methods
   "mode"        : "install",            # Mode of operation
+  "native_fetch" : False,               # Fetch distfiles natively
   "no_op"       : False,                # Do nothing
   "no_op_print" : False,                # Print commands instead of execution
   "pkg_mgmt"    : "pkgng",              # The package system used ('pkg(ng)?')
+  "spawn"       : True,                 # Start subprocesses with posix_spawn
   "target"      : ["install", "clean"], # Dependency target (aka DEPENDS_TARGET)
+  "tmpfs"       : "",                   # Directory for work directories
+  "tmpfs_budget" : 0,                   # Size of work directories placed
   "cleanlog"    : False                  # Clean the log at start for debug purposes
-}
+})
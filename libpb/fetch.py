@@ -0,0 +1,666 @@
+"""
+The fetch module.  This module downloads the distfiles of ports natively
+(over HTTP and HTTPS, without fetch(1)) on the event loop, so that the
+distfiles of all ports being fetched are downloaded concurrently.
+
+The sites of a port's distfiles are listed, in order of preference, by the
+port's fetch-urlall-list target.  Connections are kept alive and reused per
+mirror (at most CONNECTIONS to each mirror, other downloads wait for a
+connection).  A partially downloaded distfile is resumed (using a Range
+request) and the size and SHA256 checksum of each distfile are verified,
+against the port's distinfo, as it is downloaded.  A distfile is downloaded
+from each of its sites in turn until one succeeds.
+
+Distfiles that cannot be fetched natively (without a size and SHA256
+checksum in distinfo, or only available using other protocols) and those
+that failed to download are left to make(1).
+
+NOTE: the address of each mirror is resolved (once) with getaddrinfo(3),
+which blocks.
+"""
+
+from __future__ import absolute_import, with_statement
+
+import collections
+import errno
+import fcntl
+import functools
+import hashlib
+import os
+import socket
+import ssl
+import time
+import urlparse
+
+from libpb import buildlog, env, event, log, make
+
+from .signal import Signal
+
+__all__ = ["Download", "PortFetch", "abort", "distinfo"]
+
+#: The number of connections kept to each mirror
+CONNECTIONS = 2
+
+#: The number of ports fetched at a time (the load of the fetch queue)
+PORTS = 8
+
+#: The size (in bytes) of data received at a time
+CHUNK = 65536
+
+#: The largest response header (in bytes) accepted
+MAX_HEAD = 65536
+
+#: The number of redirects followed, per site
+REDIRECTS = 5
+
+#: The time (in seconds) without progress before a download is abandoned
+TIMEOUT = 60
+
+#: The default port of each supported scheme
+SCHEMES = {"http": 80, "https": 443}
+
+#: The status of responses that redirect the request
+REDIRECT = (301, 302, 303, 307, 308)
+
+
+def distinfo(path):
+    """The size and SHA256 checksum of each distfile (by name) in distinfo."""
+    files = collections.defaultdict(dict)
+    try:
+        with open(path, "r") as info:
+            for line in info:
+                # i.e. "SHA256 (subdir/name) = checksum"
+                line = line.split()
+                if len(line) == 4 and line[0] in ("SHA256", "SIZE"):
+                    name = line[1][1:-1].rsplit("/", 1)[-1]
+                    files[name][line[0]] = line[3]
+    except IOError:
+        pass
+    return dict((name, (int(i["SIZE"]), i["SHA256"].lower()))
+                for name, i in files.iteritems()
+                if "SIZE" in i and "SHA256" in i and i["SIZE"].isdigit())
+
+
+class Connection(object):
+    """A persistent HTTP(S) connection to a mirror."""
+
+    def __init__(self, mirror):
+        """Connect to the mirror."""
+        self.mirror = mirror
+        self.download = None       #: The download being requested
+        self.reused = False        #: If a response has been read
+        self.active = time.time()  #: When there was last progress
+        self._state = "connect"    #: The state (None once closed)
+        self._mode = None          #: The event waited on
+        self._send = ""            #: The request left to send
+        self._recv = ""            #: The data received (not yet processed)
+        self._length = None        #: The size of the body left to read
+        self._keep = False         #: If the connection may be reused
+
+        family, address = mirror.address()
+        self._sock = socket.socket(family, socket.SOCK_STREAM)
+        self._sock.setblocking(0)
+        error = self._sock.connect_ex(address)
+        if error not in (0, errno.EINPROGRESS, errno.EAGAIN):
+            self._sock.close()
+            raise socket.error(error, os.strerror(error))
+        self._wait("w")
+
+    def fileno(self):
+        """The file descriptor of the connection."""
+        return self._sock.fileno()
+
+    def request(self, download):
+        """Request a download (once connected)."""
+        self.download = download
+        self.active = time.time()
+        request = ["GET %s HTTP/1.1" % download.target,
+                   "Host: %s" % self.mirror.netloc,
+                   "User-Agent: portbuilder",
+                   "Accept-Encoding: identity"]
+        if download.offset:
+            request.append("Range: bytes=%i-" % download.offset)
+        self._send = "\r\n".join(request) + "\r\n\r\n"
+        if self._state == "idle":
+            self._state = "send"
+            self._wait("w")
+
+    def close(self):
+        """Close the connection (abandoning any request)."""
+        if self._state is None:
+            return
+        self._wait(None)
+        self._state = None
+        self.download = None
+        self._sock.close()
+        self.mirror.closed(self)
+
+    def fail(self, reason):
+        """Close the connection, and fail (or retry) the request."""
+        download = self.download
+        # A kept alive connection may have been closed by the mirror
+        retry = (self.reused and self._state in ("idle", "send", "head") and
+                 not _aborted)
+        self.close()
+        if download is not None:
+            if retry:
+                self.mirror.request(download)
+            else:
+                download.failed(reason)
+
+    def _wait(self, mode):
+        """Wait for the socket to be ready to read ("r") or write ("w")."""
+        if self._mode != mode:
+            if self._mode is not None:
+                event.event(self, self._mode, clear=True)
+            self._mode = mode
+            if mode is not None:
+                event.event(self, mode).connect(self._ready)
+
+    def _ready(self):
+        """Progress the connection, until the socket would block."""
+        try:
+            while self._state is not None and self._progress():
+                pass
+        except ssl.SSLWantReadError:
+            self._wait("r")
+        except ssl.SSLWantWriteError:
+            self._wait("w")
+        except socket.error, e:
+            if e.errno not in (errno.EAGAIN, errno.EINTR):
+                self.fail(str(e))
+        except ValueError, e:
+            self.fail(str(e))
+
+    def _progress(self):
+        """Advance the state of the connection, returns False once waiting
+        (or closed)."""
+        state = self._state
+        if state == "connect":
+            error = self._sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if error:
+                raise socket.error(error, os.strerror(error))
+            self.active = time.time()
+            if self.mirror.scheme == "https":
+                self._sock = _context().wrap_socket(
+                        self._sock, server_hostname=self.mirror.host,
+                        do_handshake_on_connect=False)
+                self._state = "handshake"
+            else:
+                self._state = "idle"
+        elif state == "handshake":
+            self._sock.do_handshake()
+            self.active = time.time()
+            self._state = "idle"
+        elif state == "idle":
+            if self.download is not None:
+                self._state = "send"
+                return True
+            # An idle connection is only readable once closed by the mirror
+            self._wait("r")
+            self._sock.recv(1)
+            self.close()
+        elif state == "send":
+            self._wait("w")
+            self._send = self._send[self._sock.send(self._send):]
+            if not self._send:
+                self._state = "head"
+        elif state == "head":
+            if "\r\n\r\n" in self._recv:
+                self._head()
+            else:
+                self._receive()
+        elif state == "body":
+            if self._length == 0:
+                self._done()
+            elif self._recv or self._receive():
+                data = self._recv
+                if self._length is not None:
+                    data = data[:self._length]
+                    self._length -= len(data)
+                self._recv = self._recv[len(data):]
+                if not self.download.body(data):
+                    self.fail("download abandoned")
+            elif self._length is None:
+                # The body is ended by closing the connection
+                self._keep = False
+                self._done()
+            else:
+                raise socket.error(errno.ECONNRESET, "connection closed")
+        return self._state is not None
+
+    def _receive(self):
+        """Receive data, returns False once the mirror closed the
+        connection."""
+        self._wait("r")
+        data = self._sock.recv(CHUNK)
+        if not data:
+            if self._state == "head":
+                raise socket.error(errno.ECONNRESET, "connection closed")
+            return False
+        self.active = time.time()
+        self._recv += data
+        if (self._state == "head" and len(self._recv) > MAX_HEAD and
+                "\r\n\r\n" not in self._recv):
+            raise ValueError("response header too large")
+        return True
+
+    def _head(self):
+        """Process the response header."""
+        head, self._recv = self._recv.split("\r\n\r\n", 1)
+        lines = head.split("\r\n")
+        status = lines[0].split(None, 2)
+        if (len(status) < 2 or not status[0].startswith("HTTP/") or
+                not status[1].isdigit()):
+            raise ValueError("malformed response")
+        version, status = status[0], int(status[1])
+        if 100 <= status < 200:
+            # Interim response
+            return
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        connection = headers.get("connection", "").lower()
+        if version == "HTTP/1.0":
+            self._keep = connection == "keep-alive"
+        else:
+            self._keep = connection != "close"
+        if "chunked" in headers.get("transfer-encoding", "").lower():
+            raise ValueError("chunked transfer encoding not supported")
+        if status in (204, 304):
+            self._length = 0
+        elif headers.get("content-length", "").isdigit():
+            self._length = int(headers["content-length"])
+        else:
+            self._length = None
+            self._keep = False
+        self.reused = True
+        self._state = "body"
+        self.download.head(status, headers)
+
+    def _done(self):
+        """Finish the request, reusing the connection (if possible)."""
+        download = self.download
+        self.download = None
+        if self._keep and not self._recv:
+            self._state = "idle"
+            self.mirror.release(self)
+        else:
+            self.close()
+        download.done()
+
+
+class Mirror(object):
+    """The connections to a mirror (a scheme, host and port)."""
+
+    def __init__(self, scheme, host, port):
+        """Initialise a mirror without connections."""
+        self.scheme = scheme
+        self.host = host
+        self.port = port
+        if port == SCHEMES[scheme]:
+            self.netloc = host
+        else:
+            self.netloc = "%s:%i" % (host, port)
+        self.connections = set()  #: The open connections
+        self.idle = []            #: The connections without a request
+        self.waiting = collections.deque()  #: The downloads waiting
+        self._address = None
+
+    def __repr__(self):
+        return "<Mirror(%s://%s)>" % (self.scheme, self.netloc)
+
+    def address(self):
+        """The address family and address of the mirror."""
+        if self._address is None:
+            info = socket.getaddrinfo(self.host, self.port, 0,
+                                      socket.SOCK_STREAM)
+            self._address = (info[0][0], info[0][4])
+        return self._address
+
+    def request(self, download):
+        """Request a download, on an idle or new connection (or once a
+        connection is available)."""
+        if self.idle:
+            self.idle.pop().request(download)
+        elif len(self.connections) < CONNECTIONS:
+            try:
+                connection = Connection(self)
+            except socket.error, e:
+                download.failed(str(e))
+                return
+            self.connections.add(connection)
+            connection.request(download)
+        else:
+            self.waiting.append(download)
+
+    def release(self, connection):
+        """Reuse a connection that has finished its request."""
+        if self.waiting:
+            connection.request(self.waiting.popleft())
+        else:
+            self.idle.append(connection)
+
+    def closed(self, connection):
+        """Forget a closed connection."""
+        self.connections.discard(connection)
+        if connection in self.idle:
+            self.idle.remove(connection)
+        if self.waiting:
+            self.request(self.waiting.popleft())
+
+
+class Download(object):
+    """The download of a distfile, from each of its sites in turn."""
+
+    def __init__(self, name, path, size, sha256, urls, callback):
+        """Initialise the download of a distfile (to path), callback is
+        called with the download and its status once finished."""
+        self.name = name
+        self.path = path
+        self.size = size
+        self.sha256 = sha256
+        self.url = None     #: The URL being requested
+        self.target = None  #: The target (path and query) of the request
+        self.offset = 0     #: The size of the (partially) downloaded file
+        self._urls = collections.deque(urls)
+        self._callback = callback
+        self._hash = None   #: The checksum of the downloaded file
+        self._file = None
+        self._status = None
+        self._headers = {}
+        self._redirects = 0
+
+    def __repr__(self):
+        return "<Download(%s)>" % self.name
+
+    def start(self):
+        """Start downloading the distfile."""
+        self._next()
+
+    def _next(self):
+        """Download from the next site (or fail if none are left)."""
+        while self._urls and not _aborted:
+            self._redirects = 0
+            if self._request(self._urls.popleft()):
+                return
+        self._callback(self, False)
+
+    def _request(self, url):
+        """Request the distfile from url, returns False if unsupported."""
+        url = urlparse.urlsplit(url)
+        try:
+            port = url.port or SCHEMES.get(url.scheme)
+        except ValueError:
+            return False
+        if url.scheme not in SCHEMES or not url.hostname:
+            return False
+        self.url = url.geturl()
+        self.target = url.path or "/"
+        if url.query:
+            self.target += "?" + url.query
+        self._resume()
+        if self.offset == self.size and self._verify():
+            return True
+        _mirror(url.scheme, url.hostname, port).request(self)
+        return True
+
+    def _resume(self):
+        """Checksum the partially downloaded file (if any), to resume it."""
+        try:
+            offset = os.path.getsize(self.path)
+        except OSError:
+            offset = 0
+        if self._hash is not None and offset == self.offset:
+            return
+        self._hash = hashlib.sha256()
+        self.offset = 0
+        if offset > self.size:
+            os.unlink(self.path)
+            return
+        if offset:
+            with open(self.path, "rb") as partial:
+                while True:
+                    data = partial.read(CHUNK)
+                    if not data:
+                        break
+                    self._hash.update(data)
+                    self.offset += len(data)
+
+    def head(self, status, headers):
+        """Process the response header."""
+        self._status = status
+        self._headers = headers
+        if status == 206:
+            # i.e. "Content-Range: bytes first-last/size"
+            first = headers.get("content-range", "")[6:].split("-", 1)[0]
+            if first == str(self.offset):
+                self._file = open(self.path, "ab")
+            else:
+                self._status = None
+        elif status == 200:
+            self._hash = hashlib.sha256()
+            self.offset = 0
+            self._file = open(self.path, "wb")
+
+    def body(self, data):
+        """Write (and checksum) data received, returns False if the download
+        needs to be abandoned."""
+        if self._file is None:
+            # Ignore the body of other responses
+            return self._status is not None
+        if self.offset + len(data) > self.size:
+            return False
+        self._file.write(data)
+        self._hash.update(data)
+        self.offset += len(data)
+        return True
+
+    def done(self):
+        """Verify the downloaded file (or follow a redirect)."""
+        self._close()
+        status = self._status
+        if status in REDIRECT and "location" in self._headers:
+            if self._redirects < REDIRECTS:
+                self._redirects += 1
+                if self._request(urlparse.urljoin(self.url,
+                                                  self._headers["location"])):
+                    return
+        elif status in (200, 206):
+            if self._verify():
+                return
+        else:
+            log.debug("Download.done()",
+                      "Distfile '%s': unable to fetch %s: status %s" %
+                          (self.name, self.url, status))
+        self._next()
+
+    def failed(self, reason):
+        """Abandon the request (keeping the partially downloaded file)."""
+        self._close()
+        log.debug("Download.failed()", "Distfile '%s': unable to fetch %s: %s"
+                      % (self.name, self.url, reason))
+        self._next()
+
+    def _verify(self):
+        """Verify the size and checksum of the downloaded file."""
+        if self.offset == self.size and self._hash.hexdigest() == self.sha256:
+            log.debug("Download._verify()", "Distfile '%s': fetched %s" %
+                          (self.name, self.url))
+            self._callback(self, True)
+            return True
+        log.debug("Download._verify()",
+                  "Distfile '%s': checksum mismatch for %s" %
+                      (self.name, self.url))
+        os.unlink(self.path)
+        self._hash = None
+        self.offset = 0
+        return False
+
+    def _close(self):
+        """Close the downloaded file."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class PortFetch(Signal):
+    """Fetch the distfiles of a port natively, emits the status (if all the
+    distfiles were fetched)."""
+
+    def __init__(self, port, distfiles):
+        """Initialise fetching the distfiles of a port."""
+        Signal.__init__(self, "PortFetch")
+        self.port = port
+        self.distfiles = distfiles
+        self.fetched = set()  #: The distfiles fetched
+        self.failed = set()   #: The distfiles not fetched
+        self._pending = 0
+        self._output = []     #: The output of fetch-urlall-list
+
+    def get(self):
+        """List the sites of the distfiles, then download them."""
+        pmake = make.make_target(self.port, "fetch-urlall-list", pipe=True,
+                                 BATCH=True, DISABLE_CONFLICTS=True,
+                                 NO_DEPENDS=True)
+        # NOTE: the output is read as it is written, as make(1) would block
+        # once a pipe is full
+        for stream in (pmake.stdout, pmake.stderr):
+            fd = stream.fileno()
+            fcntl.fcntl(fd, fcntl.F_SETFL,
+                        fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+            keep = stream is pmake.stdout
+            event.event(stream, "r").connect(
+                    functools.partial(self._read, stream, keep))
+        pmake.connect(self._sites)
+        return self
+
+    def _read(self, stream, keep):
+        """Read the output of fetch-urlall-list (keeping it if keep)."""
+        if stream.closed:
+            # Stale event
+            return
+        while True:
+            try:
+                data = os.read(stream.fileno(), CHUNK)
+            except OSError, e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    return
+                raise
+            if not data:
+                break
+            if keep:
+                self._output.append(data)
+        event.event(stream, "r", clear=True)
+        stream.close()
+
+    def _sites(self, pmake):
+        """Start downloading the distfiles from their sites."""
+        for stream, keep in ((pmake.stdout, True), (pmake.stderr, False)):
+            self._read(stream, keep)
+            if not stream.closed:
+                # Output still held open (i.e. by a daemon)
+                event.event(stream, "r", clear=True)
+                stream.close()
+        if pmake.wait() == make.SUCCESS:
+            urls = "".join(self._output).split()
+        else:
+            urls = []
+        self._output = []
+
+        chroot = env.flags["chroot"]
+        info = distinfo(chroot + self.port.attr["distinfo"])
+        distdir = chroot + self.port.attr["distdir"]
+        downloads = []
+        for name in self.distfiles:
+            sites = [i for i in urls
+                     if i.split("?", 1)[0].endswith("/" + name)]
+            checksum = info.get(name.rsplit("/", 1)[-1])
+            if not sites or checksum is None or _aborted:
+                self.failed.add(name)
+                continue
+            path = os.path.join(distdir, name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            downloads.append(Download(name, path, checksum[0], checksum[1],
+                                      sites, self._downloaded))
+
+        self._pending = len(downloads)
+        if not downloads:
+            self._finish()
+        for download in downloads:
+            download.start()
+
+    def _downloaded(self, download, status):
+        """Record a finished download."""
+        if status:
+            self.fetched.add(download.name)
+        else:
+            self.failed.add(download.name)
+        if status:
+            buildlog.write(self.port, "# fetched %s\n" % download.url)
+        else:
+            buildlog.write(self.port, "# unable to fetch %s\n" % download.name)
+        self._pending -= 1
+        if not self._pending:
+            self._finish()
+
+    def _finish(self):
+        """Report the distfiles fetched."""
+        if self.failed:
+            files = ", ".join("'%s'" % i for i in sorted(self.failed))
+            log.debug("PortFetch._finish()",
+                      "Port '%s': unable to fetch distfiles natively: %s" %
+                          (self.port.origin, files))
+        self.emit(self, not self.failed)
+
+
+_mirrors = {}      #: The mirrors, by scheme, host and port
+_ssl = None        #: The SSL context of HTTPS connections
+_timer = False     #: If the timeouts are being checked
+_aborted = False   #: If fetching has been aborted
+
+
+def _mirror(scheme, host, port):
+    """The mirror for scheme, host and port."""
+    global _timer
+
+    key = (scheme, host, port)
+    if key not in _mirrors:
+        _mirrors[key] = Mirror(scheme, host, port)
+    if not _timer:
+        _timer = True
+        event.event(event.alarm(), "t", data=TIMEOUT / 4).connect(_timeout)
+    return _mirrors[key]
+
+
+def _context():
+    """The SSL context of HTTPS connections (verifying certificates)."""
+    global _ssl
+
+    if _ssl is None:
+        _ssl = ssl.create_default_context()
+    return _ssl
+
+
+def _timeout():
+    """Abandon requests without progress."""
+    expired = time.time() - TIMEOUT
+    for mirror in _mirrors.values():
+        for connection in list(mirror.connections):
+            if connection.download is not None and connection.active < expired:
+                connection.fail("timed out")
+
+
+def abort():
+    """Abort all downloads (e.g. when stopping)."""
+    global _aborted
+
+    _aborted = True
+    for mirror in _mirrors.values():
+        while mirror.waiting:
+            mirror.waiting.popleft().failed("aborted")
+        for connection in list(mirror.connections):
+            connection.fail("aborted")
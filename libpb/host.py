@@ -0,0 +1,191 @@
+"""
+The host module.  This module provides facts about the host system (such as
+sysctl(3) values and the OS version) without spawning subprocesses, where
+possible.
+
+The facts are retrieved by a platform specific provider and are cached per
+chroot.  A different provider may be installed using set_provider(), for
+example to supply fixed facts.
+"""
+
+from __future__ import absolute_import, with_statement
+
+import os
+import re
+import subprocess
+import sys
+
+from libpb import env
+
+__all__ = ["Facts", "ProcFacts", "SysctlFacts", "facts", "set_provider"]
+
+# Sysctl(3) values that are (unsigned) integers
+SYSCTL_INTEGER = set((
+        "compat.ia32.maxvmem", "kern.argmax", "kern.osreldate",
+    ))
+
+OSVERSION = re.compile(r"^#define\s+__FreeBSD_version\s+([0-9]*)")
+
+
+class Facts(object):
+    """Facts about the host, as retrieved using external commands."""
+
+    def __init__(self, chroot=""):
+        """Initialise the facts for the given chroot."""
+        self.chroot = chroot
+        self._sysctl = {}
+        self._uname = None
+        self._osversion = None
+
+    def __repr__(self):
+        return "<%s(chroot=%r)>" % (self.__class__.__name__, self.chroot)
+
+    def sysctl(self, name):
+        """Retrieve the string value of a sysctlbyname(3) ("" if unknown)."""
+        try:
+            return self._sysctl[name]
+        except KeyError:
+            value = self._sysctl[name] = self._get_sysctl(name)
+            return value
+
+    def uname(self):
+        """Retrieve the uname(3) of the host."""
+        if self._uname is None:
+            self._uname = os.uname()
+        return self._uname
+
+    def osversion(self):
+        """Get the OS Version.  Based on how ports/Mk/bsd.port.mk sets
+        OSVERSION."""
+        if self._osversion is None:
+            self._osversion = self._get_osversion()
+        return self._osversion
+
+    def _get_sysctl(self, name):
+        """Retrieve a sysctl(3) value using sysctl(8)."""
+        sysctl = subprocess.Popen(("sysctl", "-n", name),
+                                  stdout=subprocess.PIPE,
+                                  stderr=subprocess.PIPE, close_fds=True)
+        value = sysctl.communicate()[0]
+        if sysctl.returncode == 0:
+            return value[:-1]
+        else:
+            return ""
+
+    def _get_osversion(self):
+        """Read the __FreeBSD_version from param.h, or else the kernel."""
+        for path in (self.chroot + "/usr/include/sys/param.h",
+                     self.chroot + "/usr/src/sys/sys/param.h"):
+            if os.path.isfile(path):
+                with open(path, "r") as param:
+                    for line in param:
+                        if line.startswith("#define"):
+                            osversion = OSVERSION.match(line)
+                            if osversion:
+                                return osversion.group(1)
+        return self.sysctl("kern.osreldate")
+
+
+class SysctlFacts(Facts):
+    """Facts about the host, retrieved using sysctlbyname(3)."""
+
+    _libc = None
+
+    def _get_sysctl(self, name):
+        """Retrieve a sysctl(3) value using sysctlbyname(3)."""
+        import ctypes
+
+        libc = SysctlFacts._load_libc()
+        if libc is None:
+            return super(SysctlFacts, self)._get_sysctl(name)
+
+        size = ctypes.c_size_t()
+        if libc.sysctlbyname(name, None, ctypes.byref(size), None, 0):
+            return ""
+        buf = ctypes.create_string_buffer(size.value)
+        if libc.sysctlbyname(name, buf, ctypes.byref(size), None, 0):
+            return ""
+
+        if name in SYSCTL_INTEGER:
+            if size.value == ctypes.sizeof(ctypes.c_uint):
+                ctype = ctypes.c_uint
+            elif size.value == ctypes.sizeof(ctypes.c_ulong):
+                ctype = ctypes.c_ulong
+            else:
+                return super(SysctlFacts, self)._get_sysctl(name)
+            return str(ctype.from_buffer_copy(buf.raw[:size.value]).value)
+        else:
+            return buf.raw[:size.value].rstrip("\0")
+
+    @staticmethod
+    def _load_libc():
+        """Load libc (once) if it provides sysctlbyname(3)."""
+        if SysctlFacts._libc is None:
+            import ctypes
+            import ctypes.util
+
+            SysctlFacts._libc = False
+            try:
+                libc = ctypes.CDLL(ctypes.util.find_library("c"))
+                sysctlbyname = libc.sysctlbyname
+            except (AttributeError, OSError):
+                pass
+            else:
+                sysctlbyname.argtypes = (
+                        ctypes.c_char_p, ctypes.c_void_p,
+                        ctypes.POINTER(ctypes.c_size_t), ctypes.c_void_p,
+                        ctypes.c_size_t)
+                sysctlbyname.restype = ctypes.c_int
+                SysctlFacts._libc = libc
+        return SysctlFacts._libc or None
+
+
+class ProcFacts(Facts):
+    """Facts about the host, retrieved from the /proc filesystem."""
+
+    def _get_sysctl(self, name):
+        """Retrieve the nearest equivalent of a sysctl(3) value."""
+        if name == "kern.argmax":
+            return str(os.sysconf("SC_ARG_MAX"))
+        path = os.path.join("/proc/sys", name.replace(".", "/"))
+        try:
+            with open(path, "r") as value:
+                return value.read().strip()
+        except IOError:
+            return ""
+
+
+providers = {
+        "darwin":  SysctlFacts,
+        "freebsd": SysctlFacts,
+        "linux":   ProcFacts,
+    }  #: The host facts provider for each platform
+
+_provider = None
+_facts = {}
+
+
+def facts(chroot=None):
+    """Get the (cached) facts for a chroot, defaults to flags["chroot"]."""
+    if chroot is None:
+        chroot = env.flags["chroot"]
+    try:
+        return _facts[chroot]
+    except KeyError:
+        provider = _provider
+        if provider is None:
+            for platform, provider in providers.items():
+                if sys.platform.startswith(platform):
+                    break
+            else:
+                provider = Facts
+        host = _facts[chroot] = provider(chroot)
+        return host
+
+
+def set_provider(provider=None):
+    """Set the callable that creates the facts for a chroot (None for the
+    platform default) and discard all cached facts."""
+    global _provider
+    _provider = provider
+    _facts.clear()
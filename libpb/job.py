@@ -2,8 +2,12 @@
 
 from __future__ import absolute_import
 
+import time
+
 from abc import abstractmethod, ABCMeta
 
+from libpb import metrics
+
 from .signal import Signal, SignalProperty
 
 __all__ = ["Job", "PortJob", "StalledJob"]
@@ -36,6 +40,11 @@ class Job(Signal):
     def __lt__(self, other):
         return self.priority > other.priority
 
+    @property
+    def manager(self):
+        """The queue manager running the job (if any)."""
+        return self.__manager
+
     @abstractmethod
     def work(self):
         """Do the hard work.
@@ -66,16 +75,19 @@ class AttrJob(Job):
     def __init__(self, attr):
         Job.__init__(self)
         self.attr = attr
+        self._start = None
 
     def __repr__(self):
         return "<AttrJob(origin=%s)>" % self.attr.origin
 
     def work(self):
         """Fetch a ports attributes."""
+        self._start = time.time()
         self.pid = self.attr.get().connect(self._done).pid
 
     def _done(self, _make):
         """Callback special function with origin and attributes."""
+        metrics.attr_fetched(time.time() - self._start)
         self.done()
 
 
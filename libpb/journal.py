@@ -0,0 +1,204 @@
+"""
+The journal module.  This module records the progress of a build (completed
+and failed stages, and the methods used to resolve ports) in an append-only
+file, so that an interrupted build may be resumed without redoing the work
+that had already finished.  On resume the completed stages are restored,
+and each port is resolved starting with the method it was last resolved with.
+
+Each record is a tab separated line:
+    stage   ORIGIN  PKGNAME STAGE   STATUS
+    method  ORIGIN  PKGNAME METHOD
+
+Records are written in batches, and fsync(2)-ed, when the batch is full, once
+per second and when the event loop stops.
+"""
+
+from __future__ import absolute_import, with_statement
+
+import os
+
+from libpb import env, log, pkg
+
+__all__ = ["method", "replay", "resume_method", "stage", "start"]
+
+# Stages that are never replayed (as they need to run to create the port's
+# dependency structure).
+NO_REPLAY = ("Depend",)
+
+
+class Journal(object):
+    """An append-only journal of a build's progress."""
+
+    def __init__(self, path, batch=64):
+        """Initialise the journal, stored at path."""
+        self.path = path
+        self.batch = batch
+        self.records = {}  #: Records of the previous run, by origin
+        self.methods = {}  #: Last resolve method of the previous run, by port
+        self._buffer = []
+        self._file = None
+
+    def __repr__(self):
+        return "<Journal(%s)>" % self.path
+
+    def load(self):
+        """Load the records of a previous run."""
+        self.records = {}
+        if not os.path.isfile(self.path):
+            return
+        with open(self.path, "r") as journal:
+            for line in journal:
+                if not line.endswith("\n"):
+                    # Partially written record (from a crash)
+                    break
+                record = line[:-1].split("\t")
+                if record[0] == "stage" and len(record) == 5:
+                    kind, origin, pkgname, value, status = record
+                    status = status == "1"
+                elif record[0] == "method" and len(record) == 4:
+                    kind, origin, pkgname, value = record
+                    status = True
+                else:
+                    log.error("Journal.load()",
+                              "Ignoring bad journal record: %r" % line)
+                    continue
+                self.records.setdefault(origin, []).append(
+                        (kind, pkgname, value, status))
+
+    def open(self, resume=False):
+        """Open the journal for writing (truncating it, unless resuming)."""
+        self._file = open(self.path, "a" if resume else "w")
+
+    def close(self):
+        """Flush and close the journal."""
+        if self._file is not None:
+            self.flush()
+            self._file.close()
+            self._file = None
+
+    def record(self, *fields):
+        """Add a record to the journal."""
+        if self._file is not None:
+            self._buffer.append("\t".join(str(i) for i in fields) + "\n")
+            if len(self._buffer) >= self.batch:
+                self.flush()
+
+    def flush(self):
+        """Write all buffered records to stable storage."""
+        if self._buffer and self._file is not None:
+            self._file.write("".join(self._buffer))
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._buffer = []
+
+    def replay(self, port):
+        """Restore the stages (and failed stacks), and the resolve method, of
+        a port from the previous run.  Only records for the port's current
+        version are used, and completed stages are verified against the
+        system's current state."""
+        from libpb import stacks
+
+        records = self.records.pop(port.origin, ())
+        stages = {}
+        for kind, pkgname, value, status in records:
+            if pkgname != port.attr["pkgname"]:
+                # The port has been updated since the record was made
+                continue
+            if kind == "stage" and value not in NO_REPLAY:
+                stages[value] = status
+            elif kind == "method" and value in env.flags["method"]:
+                self.methods[port] = value
+        if not stages:
+            return
+
+        for stage in (stacks.Config, stacks.Checksum, stacks.Fetch,
+                      stacks.Build, stacks.Install, stacks.Package,
+                      stacks.PkgInstall, stacks.RepoConfig, stacks.RepoFetch,
+                      stacks.RepoInstall):
+            if stage.name not in stages or port.stacks[stage.stack].failed:
+                continue
+            status = stages[stage.name]
+            if not status and stage.stack == "common":
+                # Retry the common stages, they are required by all stacks
+                continue
+            if (stage.prev is not None and stage.prev.name not in NO_REPLAY and
+                    stage.prev not in port.stages):
+                # Cannot replay a stage without its previous stage
+                continue
+            if status and not self._verify(port, stage):
+                log.debug("Journal.replay()",
+                          "Port '%s': not replaying stage %s (changed)" %
+                              (port.origin, stage.name))
+                continue
+            port.stages.add(stage)
+            if not status:
+                port.stacks[stage.stack].failed = stage
+            log.debug("Journal.replay()",
+                      "Port '%s': replayed stage %s (%s)" %
+                          (port.origin, stage.name,
+                           "succeeded" if status else "failed"))
+
+    @staticmethod
+    def _verify(port, stage):
+        """Verify a completed stage's results are still present."""
+        from libpb import stacks
+
+        chroot = env.flags["chroot"]
+        if stage in (stacks.Checksum, stacks.Fetch):
+            distdir = chroot + port.attr["distdir"]
+            return all(os.path.isfile(os.path.join(distdir, i))
+                       for i in port.attr["distfiles"])
+        elif stage is stacks.Build:
+            return os.path.isdir(chroot + port.attr["wrkdir"])
+        elif stage in (stacks.Install, stacks.PkgInstall, stacks.RepoInstall):
+            return port in pkg.db
+        elif stage is stacks.Package:
+            return os.path.isfile(chroot + port.attr["pkgfile"])
+        else:
+            return True
+
+
+_journal = None
+
+
+def start(path, resume=False):
+    """Start journaling to path, replaying the existing journal if resuming."""
+    from libpb import event
+
+    global _journal
+    _journal = Journal(path)
+    if resume:
+        _journal.load()
+    _journal.open(resume)
+
+    event.event(event.alarm(), "t", data=1).connect(_journal.flush)
+    event.stop.connect(_journal.flush)
+
+
+def method(port, resolve_method):
+    """Record the method used to resolve a port."""
+    if _journal is not None:
+        _journal.record("method", port.origin, port.attr["pkgname"],
+                        resolve_method)
+
+
+def replay(port):
+    """Restore the progress of a port from the previous run."""
+    if _journal is not None and _journal.records:
+        _journal.replay(port)
+
+
+def resume_method(port):
+    """The method last used to resolve a port in the previous run (or None
+    if it was not resolved)."""
+    if _journal is not None:
+        return _journal.methods.pop(port, None)
+    return None
+
+
+def stage(stagejob, status):
+    """Record the completion of a stage."""
+    if _journal is not None:
+        port = stagejob.port
+        _journal.record("stage", port.origin, port.attr["pkgname"],
+                        stagejob.name, 1 if status else 0)
@@ -1,7 +1,17 @@
-"""The logging module.  This module provides support for logging messages."""
+"""
+The logging module.  This module provides support for logging messages.
+
+Messages are buffered in memory and written to a single, long-lived, handle
+of the log file: when the buffer is full, once per second (once start() has
+been called) and when the event loop stops.  Errors and exceptions are
+written immediately.  Messages below the log level (flags["log_level"]) are
+discarded, and once the log file reaches flags["log_size"] bytes it is
+rotated (to logfile.1, logfile.2, ...).
+"""
 
 from __future__ import absolute_import, with_statement
 
+import atexit
 import os
 import sys
 import time
@@ -9,10 +19,107 @@ import traceback
 
 from libpb import env
 
-__all__ = ["debug", "error", "exception", "get_tb"]
+__all__ = ["debug", "error", "exception", "flush", "get_tb", "start"]
 
 start_time = time.time()
 
+#: The log levels
+LEVELS = {"debug": 0, "log": 1, "error": 2}
+
+#: The size (in bytes) of buffered messages before they are written
+BUFFER = 64 * 1024
+
+#: The number of rotated log files kept
+ROTATE = 3
+
+
+class Log(object):
+    """A buffered log file."""
+
+    def __init__(self):
+        """Initialise the (unopened) log file."""
+        self.path = None    #: The path of the open log file
+        self._file = None   #: The handle of the open log file
+        self._size = 0      #: The size of the open log file
+        self._buffer = []   #: The buffered messages
+        self._buffered = 0  #: The size of the buffered messages
+
+    def write(self, level, msg, flush=False):
+        """Add a message to the log (if at or above the log level)."""
+        if LEVELS[level] < LEVELS[env.flags["log_level"]]:
+            return
+        path = logfile()
+        if path != self.path:
+            # Messages go to the log file current when they were written
+            self.flush()
+            self.path = path
+        self._buffer.append(msg)
+        self._buffered += len(msg)
+        if flush or self._buffered >= BUFFER:
+            self.flush()
+
+    def flush(self):
+        """Write all buffered messages to the log file."""
+        if not self._buffer:
+            return
+        data = "".join(self._buffer)
+        self._buffer = []
+        self._buffered = 0
+        try:
+            if self._file is None or self._file.name != self.path or \
+                    not os.path.exists(self.path):
+                # Reopen the log file if it has changed or been removed
+                self._open()
+            self._file.write(data)
+            self._file.flush()
+        except IOError:
+            return
+        self._size += len(data)
+        if env.flags["log_size"] and self._size >= env.flags["log_size"]:
+            self._rotate()
+
+    def _open(self):
+        """(Re)open the log file."""
+        self.close()
+        self._file = open(self.path, "a")
+        self._size = os.fstat(self._file.fileno()).st_size
+
+    def _rotate(self):
+        """Rotate the log file, keeping the last ROTATE log files."""
+        self.close()
+        try:
+            for i in range(ROTATE - 1, 0, -1):
+                if os.path.exists("%s.%i" % (self.path, i)):
+                    os.rename("%s.%i" % (self.path, i),
+                              "%s.%i" % (self.path, i + 1))
+            if ROTATE:
+                os.rename(self.path, self.path + ".1")
+            else:
+                os.unlink(self.path)
+        except OSError:
+            # Keep logging to the current file (and retry on the next flush)
+            pass
+
+    def close(self):
+        """Close the log file."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+_log = Log()
+
+flush = _log.flush
+atexit.register(flush)
+
+
+def start():
+    """Flush the log once per second, and when the event loop stops."""
+    from libpb import event
+
+    event.event(event.alarm(), "t", data=1).connect(flush)
+    event.stop.connect(flush)
+
 
 def get_tb(offset=0):
     """Get the current traceback, excluding the top `offset` frames."""
@@ -51,13 +158,11 @@ def debug(func, msg):
     if env.flags["debug"]:
         msg = msg.replace("\n", "n  ")
         msg = "[%11.4f] (D) %s> %s\n" % (offset_time(), func, msg)
-        with open(logfile(), "a") as log:
-            log.write(msg)
+        _log.write("debug", msg)
 
 def simplylog(msg):
     msg = "[%11.4f] (L) Simply> %s\n" % (offset_time(), msg)
-    with open(logfile(), "a") as log:
-        log.write(msg)
+    _log.write("log", msg)
 
 
 def error(func, msg, trace=False):
@@ -71,8 +176,7 @@ def error(func, msg, trace=False):
         msg += format_tb(get_tb(), "message")
         fullmsg += msg.replace("\n", "\n  ")[:-2]
 
-    with open(logfile(), "a") as log:
-        log.write(fullmsg)
+    _log.write("error", fullmsg, flush=True)
 
 
 def exception():
@@ -84,7 +188,6 @@ def exception():
     msg += format_tb(traceback.extract_tb(exc_tb), "exception")[:-1]
     msg += "%s: %s" % (exc_type.__name__, exc_value)
     msg += "\n"
-    with open(logfile(), "a") as log:
-        log.write("[%10.3f] (EXCEPTION)\n  " % (offset_time()))
-        log.write(msg.replace("\n", "\n  ")[:-2])
+    _log.write("error", "[%10.3f] (EXCEPTION)\n  " % (offset_time()) +
+                        msg.replace("\n", "\n  ")[:-2], flush=True)
     return msg
@@ -1,16 +1,16 @@
 """Make targets."""
 
-from __future__ import absolute_import
+from __future__ import absolute_import, with_statement
 
 import errno
 import os
 import subprocess
 
-from libpb import env
+from libpb import buildlog, cgroup, env, spawn, usage, wrkdir
 
 from .signal import Signal
 
-__all__ = ["SUCCESS", "make_target"]
+__all__ = ["SUCCESS", "make_args", "make_target"]
 
 SUCCESS = 0
 
@@ -41,32 +41,70 @@ def env2args(environ):
             yield "%s=%s" % (key, value)
 
 
+#: The constant part of the make arguments, for the current generation of the
+#: environment: (generation, prefix, PORTSDIR, variables, variable arguments)
+_args = (None, (), "", {}, ())
+
+
+def make_args(origin, targets, kwargs):
+    """The arguments to make targets for origin, with the make variables in
+    kwargs (overriding those in the environment)."""
+    global _args
+
+    generation = (env.env.generation, env.master.generation,
+                  env.flags.generation)
+    if _args[0] != generation:
+        master = env.master
+        variables = dict((k, v) for k, v in env.env.iteritems()
+                         if k not in master or master[k] != v)
+        prefix = ("make", "-C")
+        if env.flags["chroot"]:
+            prefix = ("chroot", env.flags["chroot"]) + prefix
+        _args = (generation, prefix, env.env["PORTSDIR"], variables,
+                 tuple(env2args(variables)))
+    _generation, prefix, portsdir, variables, varargs = _args
+
+    args = prefix + (os.path.join(kwargs.get("PORTSDIR", portsdir), origin),)
+    args += targets
+    if not kwargs:
+        return args + varargs
+    master = env.master
+    if kwargs.viewkeys() & variables.viewkeys():
+        # Override the environment's variables
+        environ = dict(variables)
+        environ.update(kwargs)
+        for key in kwargs:
+            if key in master and environ[key] == master[key]:
+                del environ[key]
+        return args + tuple(env2args(environ))
+    else:
+        return args + varargs + tuple(env2args(dict(
+                (k, v) for k, v in kwargs.iteritems()
+                if k not in master or master[k] != v)))
+
+
 def make_target(port, targets, pipe=None, **kwargs):
-    """Build a make target and call a function when finished."""
+    """Build a make target and call a function when finished.
+
+    The output is logged to the port's build log (streamed, if the build logs
+    are, see buildlog), unless pipe is True (the output is piped), False (no
+    redirection) or "log" (the output, with stderr merged into stdout, is
+    piped and the caller logs it)."""
     if isinstance(port, str):
         assert pipe is True
         origin = port
     else:
         origin = port.origin
+        if wrkdir.prefix(port) is not None:
+            # Build in the work directory the port was placed in
+            kwargs["WRKDIRPREFIX"] = wrkdir.prefix(port)
 
     if isinstance(targets, str):
         targets = (targets,)
     elif not isinstance(targets, tuple):
         targets = tuple(targets)
 
-    environ = {}
-    environ.update(env.env)
-    environ.update(kwargs)
-
-    args = ("make", "-C", os.path.join(environ["PORTSDIR"], origin)) + targets
-    for key, value in env.master.items():
-        # Remove default environment variables
-        if environ[key] == value:
-            del environ[key]
-    args += tuple(env2args(environ))
-
-    if env.flags["chroot"]:
-        args = ("chroot", env.flags["chroot"]) + args
+    args = make_args(origin, targets, kwargs)
 
     if pipe is True:
         # Give access to subprocess output
@@ -74,26 +112,49 @@ def make_target(port, targets, pipe=None, **kwargs):
     elif pipe is False:
         # No piping of output (i.e. interactive)
         stdin, stdout, stderr = None, None, None
+    elif pipe == "log" and not env.flags["no_op"]:
+        # Give access to (merged) subprocess output, to be logged by the caller
+        stdin, stdout, stderr = subprocess.PIPE, subprocess.PIPE, \
+                                subprocess.STDOUT
+        buildlog.write(port, "# %s\n" % " ".join(args))
     elif not env.flags["no_op"]:
-        # Pipe output to log_file
+        # Pipe output to the build log (or directly to log_file)
         stdin = subprocess.PIPE
-        stdout = open(port.log_file, 'a')
-        stderr = stdout
-        stdout.write("# %s\n" % " ".join(args))
+        buildlog.write(port, "# %s\n" % " ".join(args))
+        if buildlog.streaming():
+            stdout, stderr = subprocess.PIPE, subprocess.STDOUT
+        else:
+            stdout = open(port.log_file, 'a')
+            stderr = stdout
 
-    if pipe is None and env.flags["no_op"]:
+    if pipe in (None, "log") and env.flags["no_op"]:
         make = PopenNone(args, port)
     else:
-        make = Popen(args, port, stdin=stdin, stdout=stdout, stderr=stderr)
+        make = popen(args, port, stdin=stdin, stdout=stdout, stderr=stderr)
         if stdin is not None:
             make.stdin.close()
+        if pipe is None and buildlog.streaming():
+            buildlog.follow(port, make)
 
     return make
 
 
+def popen(args, origin, stdin, stdout, stderr):
+    """Start a subprocess, using posix_spawn if available (and the subprocess
+    is not interactive), that emits a signal on exit.  The subprocess is
+    contained in the cgroup of its port's stage (if any)."""
+    args = cgroup.wrap(origin, args)
+    if spawn.available and env.flags["spawn"] and stdin is not None:
+        return Spawn(args, origin, stdin, stdout, stderr)
+    else:
+        return Popen(args, origin, stdin, stdout, stderr)
+
+
 class Popen(subprocess.Popen, Signal):
     """A Popen class with signals that emits a signal on exit."""
 
+    rusage = None  #: The resource usage, once reaped
+
     def __init__(self, target, origin, stdin, stdout, stderr):
         from .event import event
 
@@ -105,8 +166,48 @@ class Popen(subprocess.Popen, Signal):
 
         event(self, "p-").connect(self._emit)
 
+    def wait(self):
+        """Wait for the subprocess to terminate, with its resource usage."""
+        while self.returncode is None:
+            try:
+                pid, status, rusage = os.wait4(self.pid, 0)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno != errno.ECHILD:
+                    raise
+                # Already reaped (by someone else)
+                self.returncode = 0
+                break
+            if pid == self.pid:
+                self.rusage = rusage
+                self._handle_exitstatus(status)
+        return self.returncode
+
+    def _emit(self):
+        """Emit signal after process termination."""
+        self.wait()
+        usage.reaped(self.origin, self.rusage)
+        self.emit(self)
+
+
+class Spawn(spawn.Process, Signal):
+    """A spawned process with signals that emits a signal on exit."""
+
+    def __init__(self, target, origin, stdin, stdout, stderr):
+        from .event import event
+
+        spawn.Process.__init__(self, target, stdin=stdin, stdout=stdout,
+                               stderr=stderr)
+        Signal.__init__(self, "Spawn")
+        self.origin = origin
+
+        event(self, "p-").connect(self._emit)
+
     def _emit(self):
         """Emit signal after process termination."""
+        self.wait()
+        usage.reaped(self.origin, self.rusage)
         self.emit(self)
 
 
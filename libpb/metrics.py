@@ -0,0 +1,384 @@
+"""
+The metrics module.  This module collects metrics about a build (jobs started,
+completed and failed, queue loads, stage durations, attribute fetch latency,
+event loop lag and the methods used to resolve ports) and serves them, in the
+Prometheus text format, over HTTP.
+
+The HTTP listener runs on the event loop (without threads): connections are
+accepted, read and written without blocking, and each request is answered
+with the current metrics before the connection is closed.  Connections idle
+for longer than TIMEOUT are closed, and no more connections are accepted
+while MAX_CONNECTIONS are open (or no more file descriptors are available).
+Metrics are only collected once the listener has been started.
+"""
+
+from __future__ import absolute_import
+
+import bisect
+import collections
+import errno
+import socket
+import time
+
+from libpb import event, log, queue
+
+__all__ = ["attr_fetched", "resolved", "stage_finished", "stage_stalled",
+           "stage_started", "start"]
+
+#: The bucket bounds (in seconds) of the stage duration histograms
+STAGE_BUCKETS = (1, 5, 15, 30, 60, 300, 900, 1800, 3600, 7200, 14400)
+
+#: The bucket bounds (in seconds) of the attribute fetch histogram
+ATTR_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+#: The largest request (in bytes) accepted
+MAX_REQUEST = 8192
+
+#: The number of connections open at a time
+MAX_CONNECTIONS = 16
+
+#: The time (in seconds) without progress before a connection is closed
+TIMEOUT = 5
+
+
+class Histogram(object):
+    """A histogram of observations, with cumulative buckets."""
+
+    def __init__(self, buckets):
+        """Initialise an empty histogram with the given bucket bounds."""
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.
+
+    def observe(self, value):
+        """Add an observation to the histogram."""
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def format(self, name, labels=""):
+        """The histogram in text format."""
+        lines = []
+        total = 0
+        for bound, count in zip(self.buckets + ("+Inf",), self.counts):
+            total += count
+            lines.append('%s_bucket{%sle="%s"} %i' %
+                         (name, labels + "," if labels else "", bound, total))
+        labels = "{%s}" % labels if labels else ""
+        lines.append("%s_sum%s %g" % (name, labels, self.sum))
+        lines.append("%s_count%s %i" % (name, labels, self.count))
+        return lines
+
+
+class Metrics(object):
+    """The metrics of a build."""
+
+    def __init__(self):
+        """Initialise the metrics."""
+        self.started = collections.Counter()    #: Jobs by (stage, queue)
+        self.completed = collections.Counter()  #: Jobs by (stage, queue)
+        self.failed = collections.Counter()     #: Jobs by (stage, queue)
+        self.resolved = collections.Counter()   #: Ports by method
+        self.stages = {}  #: The duration histogram of each stage
+        self.attr = Histogram(ATTR_BUCKETS)
+        self.lag = 0.     #: The latest event loop lag
+        self._start = {}  #: The start time of each active stage
+
+    def stage_started(self, stagejob):
+        """Record a stage has started."""
+        assert stagejob not in self._start
+        self.started[(stagejob.name, _queue(stagejob))] += 1
+        self._start[stagejob] = time.time()
+
+    def stage_stalled(self, stagejob):
+        """Forget a stage has started, as it stalled (and will be rerun)."""
+        self.started[(stagejob.name, _queue(stagejob))] -= 1
+        del self._start[stagejob]
+
+    def stage_finished(self, stagejob, status):
+        """Record a stage has finished."""
+        key = (stagejob.name, _queue(stagejob))
+        if status:
+            self.completed[key] += 1
+        else:
+            self.failed[key] += 1
+        start = self._start.pop(stagejob, None)
+        if start is not None:
+            if stagejob.name not in self.stages:
+                self.stages[stagejob.name] = Histogram(STAGE_BUCKETS)
+            self.stages[stagejob.name].observe(time.time() - start)
+
+    def measure_lag(self):
+        """Measure the time an event waits to be run."""
+        event.post_event(self._lag, time.time())
+
+    def _lag(self, posted):
+        """Record the time an event waited to be run."""
+        self.lag = time.time() - posted
+
+    def format(self):
+        """The metrics in text format."""
+        lines = []
+
+        def counter(name, helps, values, labels):
+            """Add a counter, by its labels."""
+            lines.append("# HELP %s %s" % (name, helps))
+            lines.append("# TYPE %s counter" % name)
+            for key, value in sorted(values.iteritems()):
+                if not isinstance(key, tuple):
+                    key = (key,)
+                lines.append("%s{%s} %i" %
+                             (name, ",".join('%s="%s"' % i
+                                             for i in zip(labels, key)),
+                              value))
+
+        def gauge(name, helps, values):
+            """Add a gauge, by queue."""
+            lines.append("# HELP %s %s" % (name, helps))
+            lines.append("# TYPE %s gauge" % name)
+            for q, value in values:
+                lines.append('%s{queue="%s"} %g' % (name, q.name, value))
+
+        labels = ("stage", "queue")
+        counter("portbuilder_jobs_started_total", "Stages started.",
+                self.started, labels)
+        counter("portbuilder_jobs_completed_total", "Stages completed.",
+                self.completed, labels)
+        counter("portbuilder_jobs_failed_total", "Stages failed.",
+                self.failed, labels)
+        counter("portbuilder_ports_resolved_total",
+                "Ports resolved, by method.", self.resolved, ("method",))
+
+        queues = (queue.attr, queue.clean) + tuple(
+                sorted(set(queue.queues), key=queue.queues.index))
+        gauge("portbuilder_queue_depth", "Jobs waiting to run.",
+              ((q, len(q.queue) + len(q.stalled)) for q in queues))
+        gauge("portbuilder_queue_active_load", "Load of the running jobs.",
+              ((q, q.active_load) for q in queues))
+        gauge("portbuilder_queue_load", "Load available.",
+              ((q, q.load) for q in queues))
+
+        name = "portbuilder_stage_duration_seconds"
+        lines.append("# HELP %s Duration of stages." % name)
+        lines.append("# TYPE %s histogram" % name)
+        for stage in sorted(self.stages):
+            lines.extend(self.stages[stage].format(name, 'stage="%s"' % stage))
+
+        name = "portbuilder_attr_fetch_seconds"
+        lines.append("# HELP %s Duration of port attribute fetches." % name)
+        lines.append("# TYPE %s histogram" % name)
+        lines.extend(self.attr.format(name))
+
+        name = "portbuilder_event_loop_lag_seconds"
+        lines.append("# HELP %s Time an event waits to be run." % name)
+        lines.append("# TYPE %s gauge" % name)
+        lines.append("%s %g" % (name, self.lag))
+
+        name = "portbuilder_events_total"
+        lines.append("# HELP %s Events run." % name)
+        lines.append("# TYPE %s counter" % name)
+        lines.append("%s %i" % (name, event.event_count()))
+
+        return "\n".join(lines) + "\n"
+
+
+def _queue(stagejob):
+    """The name of the queue running a stage."""
+    return stagejob.manager.name if stagejob.manager else ""
+
+
+class Connection(object):
+    """A HTTP connection, answered with the metrics."""
+
+    def __init__(self, sock, listener):
+        """Initialise the connection, reading the request."""
+        self.active = time.time()  #: When there was last progress
+        self._sock = sock
+        self._listener = listener
+        self._request = ""
+        self._response = ""
+        self._mode = "r"  #: The event waited on (None once closed)
+        sock.setblocking(0)
+        event.event(self, "r").connect(self._read)
+
+    def fileno(self):
+        """The file descriptor of the connection."""
+        return self._sock.fileno()
+
+    def _read(self):
+        """Read the request, and respond once complete."""
+        if self._mode != "r":
+            # Stale event
+            return
+        try:
+            data = self._sock.recv(4096)
+        except socket.error, e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return
+            data = ""
+        if not data:
+            self.close()
+            return
+        self.active = time.time()
+        self._request += data
+        if "\r\n\r\n" not in self._request:
+            if len(self._request) > MAX_REQUEST:
+                self._respond("413 Request Entity Too Large", "")
+            return
+
+        request = self._request.split("\r\n", 1)[0].split()
+        if len(request) < 2 or request[0] not in ("GET", "HEAD"):
+            self._respond("405 Method Not Allowed", "")
+        elif request[1].split("?", 1)[0] not in ("/", "/metrics"):
+            self._respond("404 Not Found", "")
+        else:
+            body = _metrics.format()
+            if request[0] == "HEAD":
+                self._respond("200 OK", "", len(body))
+            else:
+                self._respond("200 OK", body)
+
+    def _respond(self, status, body, length=None):
+        """Start writing the response."""
+        event.event(self, "r", clear=True)
+        self._mode = "w"
+        self._response = (
+                "HTTP/1.0 %s\r\n"
+                "Content-Type: text/plain; version=0.0.4\r\n"
+                "Content-Length: %i\r\n"
+                "Connection: close\r\n\r\n%s" %
+                    (status, len(body) if length is None else length, body))
+        event.event(self, "w").connect(self._write)
+
+    def _write(self):
+        """Write as much of the response as possible."""
+        if self._mode != "w":
+            # Stale event
+            return
+        try:
+            written = self._sock.send(self._response)
+        except socket.error, e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return
+            written = len(self._response)
+        self.active = time.time()
+        self._response = self._response[written:]
+        if not self._response:
+            self.close()
+
+    def close(self):
+        """Close the connection."""
+        if self._mode is None:
+            return
+        event.event(self, self._mode, clear=True)
+        self._mode = None
+        self._sock.close()
+        self._listener.closed(self)
+
+
+class Listener(object):
+    """Accepts HTTP connections."""
+
+    def __init__(self, address):
+        """Listen for connections at address, a (host, port) pair."""
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind(address)
+        self._sock.listen(16)
+        self._sock.setblocking(0)
+        self._connections = set()  #: The open connections
+        self._accepting = False    #: If waiting for connections
+        self._resume()
+
+    def _resume(self):
+        """Wait for connections (again)."""
+        if not self._accepting:
+            self._accepting = True
+            event.event(self._sock, "r").connect(self._accept)
+
+    def _pause(self):
+        """Stop waiting for connections, until a connection closes (or the
+        connections are checked)."""
+        if self._accepting:
+            self._accepting = False
+            event.event(self._sock, "r", clear=True)
+
+    def _accept(self):
+        """Accept all pending connections."""
+        if not self._accepting:
+            # Stale event
+            return
+        while len(self._connections) < MAX_CONNECTIONS:
+            try:
+                sock = self._sock.accept()[0]
+            except socket.error, e:
+                if e.errno in (errno.EMFILE, errno.ENFILE):
+                    log.error("Listener._accept()",
+                              "Unable to accept connection: %s" % e)
+                    self._pause()
+                elif e.errno not in (errno.EAGAIN, errno.EINTR,
+                                     errno.ECONNABORTED):
+                    log.error("Listener._accept()",
+                              "Unable to accept connection: %s" % e)
+                return
+            self._connections.add(Connection(sock, self))
+        self._pause()
+
+    def closed(self, connection):
+        """Forget a closed connection (and accept connections again)."""
+        self._connections.discard(connection)
+        self._resume()
+
+    def expire(self):
+        """Close the connections without progress."""
+        expired = time.time() - TIMEOUT
+        for connection in list(self._connections):
+            if connection.active < expired:
+                connection.close()
+        if len(self._connections) < MAX_CONNECTIONS:
+            self._resume()
+
+
+_metrics = None
+_listener = None
+
+
+def start(address):
+    """Start collecting metrics, and serving them at address."""
+    global _listener, _metrics
+
+    _metrics = Metrics()
+    _listener = Listener(address)
+    event.event(event.alarm(), "t", data=1).connect(
+            _metrics.measure_lag).connect(_listener.expire)
+
+
+def stage_started(stagejob):
+    """Record a stage has started."""
+    if _metrics is not None:
+        _metrics.stage_started(stagejob)
+
+
+def stage_stalled(stagejob):
+    """Record a stage has stalled (and has not started)."""
+    if _metrics is not None:
+        _metrics.stage_stalled(stagejob)
+
+
+def stage_finished(stagejob, status):
+    """Record a stage has finished (successfully if status)."""
+    if _metrics is not None:
+        _metrics.stage_finished(stagejob, status)
+
+
+def attr_fetched(duration):
+    """Record the time taken to fetch a port's attributes."""
+    if _metrics is not None:
+        _metrics.attr.observe(duration)
+
+
+def resolved(method):
+    """Record a port was resolved using method."""
+    if _metrics is not None:
+        _metrics.resolved[method] += 1
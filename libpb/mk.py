@@ -3,12 +3,13 @@
 from __future__ import absolute_import
 
 import os
-import re
 import subprocess
 
-from libpb import env, job, log, make, queue, signal
+from libpb import env, host, job, log, make, queue, signal
 
-__all__ = ["Attr", "attr", "cache", "clean", "load_defaults"]
+__all__ = [
+        "Attr", "PortAttr", "attr", "attrs", "cache", "clean", "load_defaults"
+    ]
 
 
 def bootstrap_master():
@@ -108,8 +109,10 @@ def clean():
 
 def cache():
     """Cache commonly used variables. which are expensive to compute."""
+    facts = host.facts()
+
     # Variables conditionally set in ports/Mk/bsd.port.mk
-    uname = os.uname()
+    uname = facts.uname()
     if "ARCH" not in os.environ:
         os.environ["ARCH"] = uname[4]
     if "OPSYS" not in os.environ:
@@ -117,18 +120,17 @@ def cache():
     if "OSREL" not in os.environ:
         os.environ["OSREL"] = uname[2].split('-', 1)[0].split('(', 1)[0]
     if "OSVERSION" not in os.environ:
-        os.environ["OSVERSION"] = _get_os_version()
+        os.environ["OSVERSION"] = facts.osversion()
     if (uname[4] in ("amd64", "ia64") and
         "HAVE_COMPAT_IA32_KERN" not in os.environ):
-        # TODO: create ctypes wrapper around sysctl(3)
-        has_compact = "YES" if _sysctl("compat.ia32.maxvmem") else ""
+        has_compact = "YES" if facts.sysctl("compat.ia32.maxvmem") else ""
         os.environ["HAVE_COMPAT_IA32_KERN"] = has_compact
     if "LINUX_OSRELEASE" not in os.environ:
-        os.environ["LINUX_OSRELEASE"] = _sysctl("compat.linux.osrelease")
+        os.environ["LINUX_OSRELEASE"] = facts.sysctl("compat.linux.osrelease")
     if "UID" not in os.environ:
         os.environ["UID"] = str(os.getuid())
     if "CONFIGURE_MAX_CMD_LEN" not in os.environ:
-        os.environ["CONFIGURE_MAX_CMD_LEN"] = _sysctl("kern.argmax")
+        os.environ["CONFIGURE_MAX_CMD_LEN"] = facts.sysctl("kern.argmax")
 
     # Variables conditionally set in ports/Mk/bsd.port.subdir.mk
     if "_OSVERSION" not in os.environ:
@@ -144,6 +146,15 @@ def attr(origin):
     return attr_obj
 
 
+def attrs(origins):
+    """Retrieve several ports attributes, queued as a single batch."""
+    attr_objs = [Attr(origin) for origin in origins]
+    for attr_obj in attr_objs:
+        log.debug("attrs()", "Port '%s': getting attribute" % attr_obj.origin)
+    queue.attr.extend(job.AttrJob(attr_obj) for attr_obj in attr_objs)
+    return attr_objs
+
+
 class Attr(signal.Signal):
     """Get the attributes for a given port"""
 
@@ -202,32 +213,8 @@ class Attr(signal.Signal):
         for fltr in ports_fltr:
             fltr(attr_map)
 
-        self.emit(self.origin, attr_map)
-
+        self.emit(self.origin, PortAttr(attr_map))
 
-def _sysctl(name):
-    """Retrieve the string value of a sysctlbyname(3)."""
-    # TODO: create ctypes wrapper around sysctl(3)
-    sysctl = subprocess.Popen(("sysctl", "-n", name), stdout=subprocess.PIPE,
-                              stderr=subprocess.PIPE, close_fds=True)
-    if sysctl.wait() == 0:
-        return sysctl.stdout.read()[:-1]
-    else:
-        return ""
-
-
-def _get_os_version():
-    """Get the OS Version.  Based on how ports/Mk/bsd.port.mk sets OSVERSION"""
-    # XXX: platform specific code
-    for path in (env.flags["chroot"] + "/usr/include/sys/param.h",
-                 env.flags["chroot"] + "/usr/src/sys/sys/param.h"):
-        if os.path.isfile(path):
-            # We have a param.h
-            osversion = re.search('^#define\s+__FreeBSD_version\s+([0-9]*).*$',
-                                open(path, "r").read(), re.MULTILINE)
-            if osversion:
-                return osversion.groups()[0]
-    return _sysctl("kern.osreldate")
 
 #=============================================================================#
 #                          PORTS ATTRIBUTE SECTION                            #
@@ -294,8 +281,18 @@ ports_fltr = []  # Clean-up functions for the ports attributes
 # The following are 'fixes' for various attributes
 ports_attr["depends"].append(lambda x: [i[len(env.env["PORTSDIR"]) + 1:]
                                                                    for i in x])
-ports_attr["depends"].append(lambda x: ([x.remove(i) for i in x
-                                         if x.count(i) > 1], x)[1])
+
+
+def unique(items):
+    """Remove duplicate items (keeping the first of each), in linear time."""
+    seen = set()
+    unique_items = []
+    for i in items:
+        if i not in seen:
+            seen.add(i)
+            unique_items.append(i)
+    return unique_items
+ports_attr["depends"].append(unique)
 ports_attr["distfiles"].append(lambda x: [i.split(':', 1)[0] for i in x])
 
 
@@ -343,3 +340,89 @@ def ports_options(attr):
     attr["options"] = options
     del attr["_options"]
 ports_fltr.append(ports_options)
+
+
+_shared = {}  #: Shared instances of tuples of strings
+
+
+def intern_value(value):
+    """Intern the strings in an attribute value.
+
+    Tuples of strings (such as a dependency's (object, origin) pair) are also
+    shared between all ports."""
+    if isinstance(value, str):
+        return intern(value)
+    elif isinstance(value, tuple):
+        value = tuple(intern_value(i) for i in value)
+        for i in value:
+            if not isinstance(i, str):
+                return value
+        return _shared.setdefault(value, value)
+    elif isinstance(value, list):
+        return [intern_value(i) for i in value]
+    elif isinstance(value, dict):
+        return dict((intern_value(k), intern_value(v))
+                    for k, v in value.iteritems())
+    else:
+        return value
+
+
+class PortAttr(object):
+    """The attributes of a port.
+
+    A fixed layout record, accessed like a dictionary (i.e. attr["pkgname"]),
+    with the strings in each value interned."""
+
+    __slots__ = tuple(sorted(ports_attr))
+
+    def __init__(self, attr=None):
+        """Initialise the record from a dictionary of attributes."""
+        if attr:
+            for key, value in attr.iteritems():
+                self[key] = value
+
+    def __repr__(self):
+        return "<PortAttr(%s)>" % self.get("pkgname", "")
+
+    def __contains__(self, key):
+        return key in ports_attr and hasattr(self, key)
+
+    def __getitem__(self, key):
+        if key in ports_attr:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                pass
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key not in ports_attr:
+            raise KeyError(key)
+        setattr(self, key, intern_value(value))
+
+    def __delitem__(self, key):
+        if key in ports_attr:
+            try:
+                delattr(self, key)
+                return
+            except AttributeError:
+                pass
+        raise KeyError(key)
+
+    def __iter__(self):
+        return (key for key in self.__slots__ if hasattr(self, key))
+
+    def get(self, key, default=None):
+        """Get an attribute, or default if it is not set."""
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        """List the attributes that are set."""
+        return list(self)
+
+    def items(self):
+        """List the (attribute, value) pairs that are set."""
+        return [(key, getattr(self, key)) for key in self]
@@ -1,19 +1,22 @@
 """Displays about activity."""
 
-from __future__ import absolute_import
+from __future__ import absolute_import, with_statement
 
 import abc
 import collections
 import curses, curses.ascii
+import errno
+import json
+import os
 import sys
 import time
 
-from libpb import env, event, queue, stacks
+from libpb import buildlog, env, event, log, queue, stacks, usage
 
 from .port.port import Port
 from .builder import Builder
 
-__all__ = ["Monitor", "Top"]
+__all__ = ["Monitor", "Status", "Top"]
 
 
 class Monitor(object):
@@ -21,11 +24,11 @@ class Monitor(object):
 
     __metaclass__ = abc.ABCMeta
 
-    def __init__(self):
+    def __init__(self, delay=1):
         """Initialise the monitor"""
         from .event import alarm, event, stop, start
 
-        self.delay = 1  #: Delay between monitor iterations
+        self.delay = delay  #: Delay between monitor iterations
         self._running = False  #: Indicate if we have started
         self._timer_id = alarm()
 
@@ -87,14 +90,108 @@ STATUS = collections.OrderedDict((
     (Builder.DONE,   "done"),
   ))
 
+#: The control characters (not displayed in the log pane)
+CONTROL = "".join(chr(i) for i in range(32)) + chr(127)
+
 
 def get_name(port):
     """Get the ports name."""
     return port.attr["pkgname"]
 
 
+def get_usage(port):
+    """Get the CPU time and maximum RSS used by the port's subprocesses."""
+    port_usage = usage.get(port)
+    if port_usage is None:
+        return ' ' * 12
+    cpu = port_usage.cpu
+    return '%3i:%02i %4iM' % (cpu / 60, cpu % 60, port_usage.maxrss / 1024)
+
+
+def get_stages():
+    """Get the state of the displayed stages."""
+    from . import state
+
+    if env.flags["fetch_only"]:
+        return tuple(state[i] for i in STAGES[:5])
+    else:
+        return tuple(state[i] for i in STAGES)
+
+
+class LogTail(object):
+    """Follows the last lines of a port's build log.
+
+    The log is read from where the previous update stopped, thus only the
+    new output is ever read.  When (re)starting, or if more output was added
+    than is kept, only the end of the log is read.  A streamed log is read
+    from memory (see buildlog.read()), otherwise from the log file."""
+
+    #: The most (in bytes) read from the end of the log
+    TAIL = buildlog.RECENT
+
+    def __init__(self, port, lines):
+        """Initialise following the last lines of the log of port."""
+        self.port = port
+        self.path = port.log_file
+        self.lines = collections.deque(maxlen=lines)
+        self._offset = None  #: The offset of the next byte to read
+        self._partial = ""   #: The last (incomplete) line
+
+    def update(self):
+        """Read any new output."""
+        recent = buildlog.read(self.port)
+        if recent is not None:
+            size, end = recent
+        else:
+            try:
+                size = os.stat(self.path).st_size
+            except OSError:
+                return
+        if self._offset is None or size < self._offset or \
+                size - self._offset > self.TAIL:
+            # Started, truncated or too far behind: skip to the end
+            self._offset = max(0, size - self.TAIL)
+            self._partial = "" if not self._offset else None
+            self.lines.clear()
+        if size == self._offset:
+            return
+
+        if recent is not None:
+            data = end[len(end) - (size - self._offset):]
+        else:
+            try:
+                with open(self.path, "rb") as log_file:
+                    log_file.seek(self._offset)
+                    data = log_file.read(size - self._offset)
+            except IOError:
+                return
+        self._offset += len(data)
+        lines = data.split("\n")
+        if self._partial is None:
+            # Started mid line, skip to the next line
+            if len(lines) == 1:
+                return
+            lines.pop(0)
+            self._partial = ""
+        lines[0] = self._partial + lines[0]
+        self._partial = lines.pop()
+        self.lines.extend(i.rsplit("\r", 1)[-1] for i in lines)
+
+    def tail(self):
+        """The last lines of the file (including any incomplete line)."""
+        lines = list(self.lines)
+        if self._partial:
+            lines.append(self._partial.rsplit("\r", 1)[-1])
+        return lines[-self.lines.maxlen:]
+
+
 class Top(Monitor):
-    """A monitor modelled after the top(1) utility."""
+    """A monitor modelled after the top(1) utility.
+
+    The summary and the visible rows are laid out only when the state (or the
+    display) changes, with the counts taken from the indexed state and the
+    rows sliced directly from the visible window.  Otherwise only the running
+    times are updated."""
 
     def __init__(self):
         """Initialise the top monitor."""
@@ -114,21 +211,42 @@ class Top(Monitor):
 
         self._last_event_count = 0
 
+        self._layout = None  #: The state (and display) of the last layout
+        self._lines = []     #: The summary and stage lines
+        self._rows = []      #: The visible rows, as (item, stage, status)
+
+        self._log = False    #: If the log pane is shown
+        self._selected = None  #: The port whose log is shown
+        self._tail = None    #: The log of the selected port
+
     def run(self):
         """Refresh the display."""
         from . import state
 
         state.sort()
-        if env.flags["fetch_only"]:
-            stages = tuple(state[i] for i in STAGES[:5])
-        else:
-            stages = tuple(state[i] for i in STAGES)
+        stages = get_stages()
         self._curr_time = time.time()
-        self._stdscr.erase()
-        self._update_header(self._stdscr, stages)
-        self._update_rows(self._stdscr, stages)
-        self._stdscr.move(self._offset, 0)
-        self._stdscr.refresh()
+
+        scr = self._stdscr
+        lines = scr.getmaxyx()[0]
+        pane = lines // 3 if self._log and lines >= 6 else 0
+        layout = (state.version, self._skip, self._failed_only,
+                  self._indirect, self._idle, lines, pane,
+                  len(queue.clean.active), len(queue.clean.stalled),
+                  len(queue.clean.queue))
+        if layout != self._layout:
+            self._lines = self._update_summary(stages)
+            self._rows = self._update_rows(
+                    stages, lines - len(self._lines) - 3 - pane)
+            self._layout = (state.version, self._skip) + layout[2:]
+
+        scr.erase()
+        self._update_header(scr)
+        self._draw_rows(scr)
+        if pane:
+            self._draw_log(scr, stages, pane)
+        scr.move(self._offset, 0)
+        scr.refresh()
 
     def _init(self):
         """Initialise the curses library."""
@@ -170,6 +288,15 @@ class Top(Monitor):
             elif char == ord('i'):
                 # Toggle showing idle
                 self._idle = not self._idle
+            elif char == ord('l'):
+                # Toggle showing the log of the selected port
+                self._log = not self._log
+            elif char == ord('n'):
+                # Show the log of the next active port
+                self._select(1)
+            elif char == ord('p'):
+                # Show the log of the previous active port
+                self._select(-1)
             elif char == ord('q'):
                 # Quit
                 from . import stop
@@ -201,13 +328,50 @@ class Top(Monitor):
             # Redraw display if required
             self.run()
 
-    def _update_header(self, scr, stages):
+    def _select(self, step):
+        """Select the log of another active port (step ports away)."""
+        active = [i for stage in reversed(get_stages()) for i in stage.active]
+        if not active:
+            return
+        if self._selected in active:
+            idx = active.index(self._selected) + step
+        else:
+            idx = 0 if step > 0 else -1
+        self._selected = active[idx % len(active)]
+        self._tail = None
+        self._log = True
+
+    def _draw_log(self, scr, stages, pane):
+        """Draw the log pane, with the tail of the selected port's log."""
+        if self._selected is None:
+            for stage in reversed(stages):
+                if stage.active:
+                    self._selected = stage.active[0]
+                    break
+            else:
+                return
+        if (self._tail is None or self._tail.path != self._selected.log_file
+                or self._tail.lines.maxlen != pane - 1):
+            self._tail = LogTail(self._selected, pane - 1)
+        self._tail.update()
+
+        lines, columns = scr.getmaxyx()
+        offset = lines - pane
+        title = "-- %s " % get_name(self._selected)
+        scr.addnstr(offset, 0, title + "-" * (columns - len(title)),
+                    columns - 1, curses.A_BOLD)
+        for line in self._tail.tail():
+            offset += 1
+            scr.addnstr(offset, 0, line.expandtabs().translate(None, CONTROL),
+                        columns - 1)
+
+    def _update_header(self, scr):
         """Update the header details."""
         self._offset = 0
         self._update_ports(scr)
-        self._update_summary(scr, stages)
-        for stage in stages:
-            self._update_stage(scr, stage)
+        for line in self._lines:
+            scr.addstr(self._offset, 0, line)
+            self._offset += 1
 
         offset = self._curr_time - self._time
         secs, mins, hours = offset % 60, offset / 60 % 60, offset / 60 / 60 % 60
@@ -241,77 +405,40 @@ class Top(Monitor):
 
         self._offset += 1
 
-    def _update_summary(self, scr, stages):
-        """Update the summary information."""
+    def _ports(self, stage, status):
+        """The ports at status in stage (as displayed)."""
+        if status == Builder.FAILED and not self._indirect:
+            return stage.direct
+        return stage[status]
+
+    def _update_summary(self, stages):
+        """The summary and stage lines."""
         msg = dict((i, 0) for i in STATUS.values())
         ports = 0
+        lines = []
         for stage in stages:
+            stage_msg = []
             for stat, status in STATUS.items():
-                msg[status] += len(stage[stat])
+                length = len(self._ports(stage, stat))
+                msg[status] += length
                 if stat not in (Builder.FAILED, Builder.DONE):
-                    ports += len(stage[stat])
-                if stat == Builder.FAILED and not self._indirect:
-                    msg[status] -= len([i for i in stage[stat]
-                                                  if "failed" not in i.flags])
+                    ports += length
+                if length and stat != Builder.DONE:
+                    stage_msg.append("%i %s" % (length, status))
+            if stage_msg:
+                stage_name = stage.stage.name
+                lines.append("%s:%s%s" % (stage_name[:8],
+                                          " " * max(1, 9 - len(stage_name)),
+                                          ", ".join(stage_msg)))
 
         msg = ", ".join("%i %s" % (msg[i], i) for i in STATUS.values()
                                                                     if msg[i])
-        scr.addstr(
-                self._offset, 0, "%i port%s remaining: %s" %
-                (ports, " " if ports == 1 else "s", msg))
-        self._offset += 1
-        self._skip = min(self._skip, ports - 1)
-
-    def _update_stage(self, scr, stage):
-        """Update various stage details."""
-        msg = []
-        for state, status in STATUS.items()[:-1]:
-            if stage.status[state]:
-                length = len(stage[state])
-                if state == Builder.FAILED and not self._indirect:
-                    length -= len([i for i in stage[state]
-                                                  if "failed" not in i.flags])
-                    if not length:
-                        continue
-                msg.append("%i %s" % (length, status))
-
-        if msg:
-            stage_name = stage.stage.name
-            scr.addstr(
-                    self._offset, 0, "%s:%s%s" %
-                        (stage_name[:8],
-                         " " * max(1, 9 - len(stage_name)), ", ".join(msg)))
-            self._offset += 1
-
-    def _update_rows(self, scr, stages):
-        """Update the rows of port information."""
-        scr.addstr(self._offset + 1, 2, ' STAGE   STATE   TIME PACKAGE')
+        lines.insert(0, "%i port%s remaining: %s" %
+                            (ports, " " if ports == 1 else "s", msg))
+        return lines
 
-        def ports(stages, status):
-            """Retrieve all the ports at status from stages."""
-            for stage in reversed(stages):
-                stat = stage[status]
-                if self._skip:
-                    length = len(stat)
-                    if status == Builder.FAILED and not self._indirect:
-                        length -= len([i for i in stat
-                                                  if "failed" not in i.flags])
-                    if self._skip >= length:
-                        self._skip -= length
-                        continue
-                    else:
-                        stat = stat[self._skip:]
-                        self._skip = 0
-                for port in stat:
-                    if (status == Builder.FAILED and not self._indirect and
-                        "failed" not in port.flags):
-                        continue
-                    yield port, stage.stage
-
-        skip = self._skip
-        lines, columns = scr.getmaxyx()
-        offset = self._offset + 2
-        lines -= offset
+    def _update_rows(self, stages, lines):
+        """The visible rows of port information."""
         if self._failed_only:
             status = (Builder.FAILED,)
         elif self._idle:
@@ -319,23 +446,11 @@ class Top(Monitor):
         else:
             status = (Builder.ACTIVE,)
 
+        sections = []
         if Builder.ACTIVE == status[0]:
             status = status[1:]
-            for port, stage in ports(stages, Builder.ACTIVE):
-                if not port.stacks[stage.stack].working:
-                    continue
-
-                offtime = self._curr_time - port.stacks[stage.stack].working
-                active = '%3i:%02i' % (offtime / 60, offtime % 60)
-                scr.addnstr(
-                        offset, 0, '%8s  active %s %s' %
-                        (stage.name[:8].lower(), active, get_name(port)),
-                        columns)
-                offset += 1
-                lines -= 1
-                if not lines:
-                    self._skip = skip
-                    return
+            for stage in reversed(stages):
+                sections.append((stage.active, stage.stage, Builder.ACTIVE))
 
             # Display ports cleaning and queued to be cleaned
             if self._idle:
@@ -343,43 +458,226 @@ class Top(Monitor):
                          queue.clean.queue)
             else:
                 clean = queue.clean.active
-            if self._skip >= len(clean):
-                self._skip -= len(clean)
-            else:
-                for job in clean[self._skip:]:
-                    # TODO: Currently clean jobs don't show progress
-                    if False and job.port.working:
-                        offtime = self._curr_time - job.port.working
-                        active = '%3i:%02i' % (offtime / 60, offtime % 60)
-                        state = "active"
-                    else:
-                        active = ' ' * 6
-                        state = "queued"
-                    scr.addnstr(
-                            offset, 0, '   clean  %s %s %s' %
-                            (state, active, get_name(job.port)), columns)
-                    offset += 1
-                    lines -= 1
-                    if not lines:
-                        self._skip = skip
-                        return
-                self._skip = 0
-
-        for status in status:
-            for port, stage in ports(stages, status):
-                scr.addnstr(
-                        offset, 0, '%8s %7s        %s' %
-                        (stage.name[:8].lower(), STATUS[status],
-                         get_name(port)), columns)
-                offset += 1
-                lines -= 1
-                if not lines:
-                    self._skip = skip
-                    return
+            sections.append((clean, None, None))
+
+        for stat in status:
+            for stage in reversed(stages):
+                sections.append((self._ports(stage, stat), stage.stage, stat))
 
         # make sure at least one port is visible
-        if self._skip:
-            self._skip = max(0, skip - self._skip - 1)
-            self._update_rows(scr, stages)
+        self._skip = skip = max(0, min(self._skip,
+                                       sum(len(i[0]) for i in sections) - 1))
+        rows = []
+        for items, stage, stat in sections:
+            if skip >= len(items):
+                skip -= len(items)
+                continue
+            rows.extend((i, stage, stat)
+                        for i in items[skip:skip + lines - len(rows)])
+            skip = 0
+            if len(rows) >= lines:
+                break
+        return rows
+
+    def _draw_rows(self, scr):
+        """Draw the rows of port information."""
+        scr.addstr(self._offset + 1, 2,
+                   ' STAGE   STATE   TIME    CPU   RSS PACKAGE')
+
+        columns = scr.getmaxyx()[1]
+        offset = self._offset + 2
+        for item, stage, status in self._rows:
+            if status == Builder.ACTIVE:
+                working = item.stacks[stage.stack].working
+                if not working:
+                    continue
+                offtime = self._curr_time - working
+                active = '%3i:%02i' % (offtime / 60, offtime % 60)
+                line = '%8s  active %s %s %s' % (stage.name[:8].lower(),
+                                                 active, get_usage(item),
+                                                 get_name(item))
+            elif stage is None:
+                # TODO: Currently clean jobs don't show progress
+                line = '   clean  queued %s %s %s' % (' ' * 6,
+                                                      get_usage(item.port),
+                                                      get_name(item.port))
+            else:
+                line = '%8s %7s %s %s %s' % (stage.name[:8].lower(),
+                                             STATUS[status], ' ' * 6,
+                                             get_usage(item), get_name(item))
+            scr.addnstr(offset, 0, line, columns)
+            offset += 1
+
+
+class Status(Monitor):
+    """A monitor that streams the status as JSON lines.
+
+    Each line is a frame, either a snapshot of the full status or a delta of
+    the values changed since the previous frame written.  The stream is
+    written to a file, a FIFO or a (stream) unix socket without blocking: if
+    the reader falls behind only the latest frame is kept, with the dropped
+    frames counted.  A FIFO or socket without a reader is retried at the next
+    frame (starting again with a snapshot)."""
+
+    #: The number of frames between snapshots
+    SNAPSHOT = 60
+
+    def __init__(self, path, delay=1):
+        """Initialise the status monitor, streaming to path."""
+        Monitor.__init__(self, delay)
+
+        self.path = path
+        self._file = None      #: The file (or socket) being written to
+        self._buffer = ""      #: The unwritten part of the current frame
+        self._frame = None     #: The latest frame, waiting to be written
+        self._sent = {}        #: The status as of the last frame written
+        self._frames = 0       #: The number of frames written (to this file)
+        self._dropped = 0      #: The number of frames dropped
+        self._writing = False  #: If waiting for the file to become writable
+
+    def fileno(self):
+        """The file descriptor of the stream."""
+        return self._file.fileno()
+
+    def run(self):
+        """Write the current status (once the stream is ready)."""
+        if self._frame is not None:
+            self._dropped += 1
+        self._frame = self._status()
+        if self._file is None:
+            self._open()
+        if self._file is not None and not self._buffer:
+            self._write()
+
+    def _deinit(self):
+        """Close the stream."""
+        self._close()
+
+    def _open(self):
+        """Open the stream, if a reader is available."""
+        import socket
+        import stat
+
+        try:
+            if os.path.exists(self.path) and \
+                    stat.S_ISSOCK(os.stat(self.path).st_mode):
+                self._file = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                try:
+                    self._file.connect(self.path)
+                except socket.error:
+                    self._file.close()
+                    self._file = None
+                    return
+                self._file.setblocking(0)
+            else:
+                fd = os.open(self.path, os.O_WRONLY | os.O_APPEND |
+                                        os.O_CREAT | os.O_NONBLOCK, 0644)
+                self._file = os.fdopen(fd, "a", 0)
+        except (IOError, OSError), e:
+            if e.errno not in (errno.ENXIO, errno.EINTR):
+                log.error("Status._open()", "Unable to open status stream "
+                          "'%s': %s" % (self.path, e))
+            self._file = None
+            return
+        self._sent = {}
+        self._frames = 0
+
+    def _close(self):
+        """Close the stream."""
+        if self._file is not None:
+            if self._writing:
+                event.event(self, "w", clear=True)
+                self._writing = False
+            self._file.close()
+            self._file = None
+            self._buffer = ""
+
+    def _write(self):
+        """Write as much of the pending frames as possible."""
+        import socket
+
+        if self._file is None:
+            # Stale event (the stream has since closed)
+            return
+        while True:
+            if not self._buffer:
+                if self._frame is None:
+                    break
+                self._buffer = self._encode(self._frame)
+                self._frame = None
+            try:
+                if isinstance(self._file, socket.socket):
+                    written = self._file.send(self._buffer)
+                else:
+                    written = os.write(self._file.fileno(), self._buffer)
+            except (OSError, socket.error), e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    break
+                # The reader has gone away
+                self._close()
+                return
+            self._buffer = self._buffer[written:]
+
+        if self._buffer and not self._writing:
+            event.event(self, "w").connect(self._write)
+            self._writing = True
+        elif not self._buffer and self._writing:
+            event.event(self, "w", clear=True)
+            self._writing = False
+
+    def _encode(self, status):
+        """Encode the status as a frame, relative to the last frame."""
+        if not self._frames % self.SNAPSHOT:
+            frame = dict(status)
+            frame["type"] = "snapshot"
         else:
-            self._skip = skip
+            frame = {"type": "delta"}
+            for key, value in status.iteritems():
+                sent = self._sent.get(key)
+                if isinstance(value, dict) and isinstance(sent, dict):
+                    value = dict((i, j) for i, j in value.iteritems()
+                                 if sent.get(i) != j)
+                    if value:
+                        frame[key] = value
+                elif value != sent:
+                    frame[key] = value
+        frame["dropped"] = self._dropped
+        self._sent = status
+        self._frames += 1
+        return json.dumps(frame, separators=(",", ":"), sort_keys=True) + "\n"
+
+    def _status(self):
+        """The current status."""
+        stages = get_stages()
+        now = time.time()
+
+        counts = {}
+        active = []
+        for stage in stages:
+            counts[stage.stage.name.lower()] = dict(
+                    (status, len(stage[stat]))
+                    for stat, status in STATUS.iteritems())
+            for port in stage.active:
+                working = port.stacks[stage.stage.stack].working
+                if working:
+                    active.append((stage.stage.name.lower(), get_name(port),
+                                   round(now - working, 1)))
+
+        queues = {}
+        for q in (queue.attr, queue.clean) + queue.queues:
+            queues[q.name] = {
+                    "load":     q.load,
+                    "used":     q.active_load,
+                    "active":   len(q.active),
+                    "queued":   len(q.queue),
+                    "stalled":  len(q.stalled),
+                }
+
+        return {
+                "time":     round(now, 1),
+                "stages":   counts,
+                "active":   sorted(active),
+                "queues":   queues,
+                "events":   {"count":   event.event_count(),
+                             "pending": event.pending_events()},
+            }
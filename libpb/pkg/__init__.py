@@ -6,7 +6,7 @@ from __future__ import absolute_import
 
 import subprocess
 
-from libpb import env, make
+from libpb import buildlog, env, make
 from . import pkgng
 
 # Installed status flags
@@ -80,9 +80,14 @@ def cmd(port, args, do_op=False):
     if env.flags["no_op"] and not do_op:
         pkg_cmd = make.PopenNone(args, port)
     else:
-        logfile = open(port.log_file, "a")
-        logfile.write("# %s\n" % " ".join(args))
-        pkg_cmd = make.Popen(args, port, subprocess.PIPE, logfile, logfile)
+        buildlog.write(port, "# %s\n" % " ".join(args))
+        if buildlog.streaming():
+            pkg_cmd = make.popen(args, port, subprocess.PIPE, subprocess.PIPE,
+                                 subprocess.STDOUT)
+            buildlog.follow(port, pkg_cmd)
+        else:
+            logfile = open(port.log_file, "a")
+            pkg_cmd = make.popen(args, port, subprocess.PIPE, logfile, logfile)
         pkg_cmd.stdin.close()
     return pkg_cmd
 
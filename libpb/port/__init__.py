@@ -2,9 +2,11 @@
 
 from __future__ import absolute_import
 
+import collections
+
 from libpb import event, mk, signal
 
-__all__ = ["get_port", "get_ports", "ports"]
+__all__ = ["all_ports", "get_port", "get_ports", "load", "peek", "ports"]
 
 
 class PortCache(object):
@@ -18,6 +20,16 @@ class PortCache(object):
     def __len__(self):
         return len(self._ports)
 
+    def __contains__(self, origin):
+        return origin in self._ports
+
+    def __iter__(self):
+        return self._ports.itervalues()
+
+    def peek(self, origin, default=None):
+        """Get a port (or default) immediately, without loading it."""
+        return self._ports.get(origin, default)
+
     def get_port(self, origin):
         """Get a port and callback with it."""
         if origin in self._ports:
@@ -25,16 +37,45 @@ class PortCache(object):
             event.post_event(sig.emit, self._ports[origin])
             return sig
         else:
-            if origin in self._waiters:
-                return self._waiters[origin]
-            else:
-                sig = signal.Signal()
-                self._waiters[origin] = sig
-                mk.attr(origin).connect(self._attr)
-                return sig
+            if origin not in self._waiters:
+                self._load((origin,))
+            return self._waiters[origin]
 
-    def __iter__(self):
-        return self._ports.values()
+    def get_ports(self, origins):
+        """Get several ports and callback, once, with a list of the ports (in
+        the same order as origins)."""
+        origins = tuple(origins)
+        sig = signal.Signal()
+        pending = set(i for i in origins if i not in self._ports)
+        if not pending:
+            event.post_event(sig.emit, [self._ports[i] for i in origins])
+            return sig
+
+        def loaded(port):
+            """Callback with all the ports once the last one has loaded."""
+            pending.remove(port if isinstance(port, str) else port.origin)
+            if not pending:
+                sig.emit([self._ports[i] for i in origins])
+
+        self.load(pending)
+        for origin in pending:
+            self._waiters[origin].connect(loaded)
+        return sig
+
+    def load(self, origins):
+        """Start loading several ports (those not loaded or loading), as a
+        single batch."""
+        origins = [i for i in collections.OrderedDict.fromkeys(origins)
+                   if i not in self._ports and i not in self._waiters]
+        if origins:
+            self._load(origins)
+
+    def _load(self, origins):
+        """Fetch the attributes of ports, as a single batch."""
+        for origin in origins:
+            self._waiters[origin] = signal.Signal()
+        for attr in mk.attrs(origins):
+            attr.connect(self._attr)
 
     def _attr(self, origin, attr):
         """Use attr to create a port."""
@@ -51,6 +92,9 @@ class PortCache(object):
 
 _cache = PortCache()
 
-ports = _cache.__len__
+all_ports = _cache.__iter__
 get_port = _cache.get_port
-get_ports = _cache.__iter__
+get_ports = _cache.get_ports
+load = _cache.load
+peek = _cache.peek
+ports = _cache.__len__
@@ -0,0 +1,152 @@
+"""
+Export and analysis of the dependency graph.
+
+The graph (of loaded ports) may be written as JSON or in the DOT language,
+with each edge labelled by its dependency types.  The analysis gives the size
+of the graph, the build levels (and thus the available parallelism), the
+critical path under a duration model and the ports with the most dependants.
+"""
+
+from __future__ import absolute_import, with_statement
+
+import collections
+import json
+
+from .dependhandler import DependHandler
+from .graph import graph
+
+__all__ = ["MODELS", "analyse", "levels", "write", "write_dot", "write_json"]
+
+#: The name of each dependency type
+TYPES = dict((getattr(DependHandler, i), i) for i in
+             ("BUILD", "EXTRACT", "FETCH", "LIB", "RUN", "PATCH", "PKG"))
+
+#: The duration models, the (relative) time taken to build a port
+MODELS = {
+        "unit": lambda port: 1,
+        "size": lambda port: 1 + port.priority / float(1 << 20),
+    }
+
+
+def types(typemask):
+    """The names of the dependency types in typemask."""
+    return [TYPES[i] for i in sorted(TYPES) if typemask & (1 << i)]
+
+
+def _edges(ports, members=None):
+    """Iterate over the (port, depend, typemask) edges between ports."""
+    if members is None:
+        members = ports
+    for port in ports:
+        if port in graph:
+            depends = sorted(graph.iter_depends(port),
+                             key=lambda x: x[0].origin)
+            for depend, typemask in depends:
+                if depend in members:
+                    yield port, depend, typemask
+
+
+def write_json(path, ports):
+    """Write the graph of ports as JSON."""
+    ports = sorted(ports, key=lambda x: x.origin)
+    index = dict((j, i) for i, j in enumerate(ports))
+    data = {
+            "ports": [[i.origin, i.attr["pkgname"]] for i in ports],
+            "edges": [[index[i], index[j], types(k)]
+                      for i, j, k in _edges(ports, index)],
+        }
+    with open(path, "w") as output:
+        json.dump(data, output, separators=(",", ":"))
+
+
+def write_dot(path, ports):
+    """Write the graph of ports in the DOT language."""
+    ports = sorted(ports, key=lambda x: x.origin)
+    with open(path, "w") as output:
+        output.write("digraph ports {\n")
+        for port in ports:
+            output.write('  "%s" [label="%s"];\n' %
+                         (port.origin, port.attr["pkgname"]))
+        for port, depend, typemask in _edges(ports, set(ports)):
+            output.write('  "%s" -> "%s" [label="%s"];\n' %
+                         (port.origin, depend.origin,
+                          ",".join(types(typemask))))
+        output.write("}\n")
+
+
+def write(path, ports):
+    """Write the graph of ports, in DOT if path ends in .dot or .gv otherwise
+    as JSON."""
+    if path.endswith(".dot") or path.endswith(".gv"):
+        write_dot(path, ports)
+    else:
+        write_json(path, ports)
+
+
+def levels(ports):
+    """Order the ports by level: a port's level is one more than the highest
+    level of its dependencies (ports without dependencies are level 0).
+    Returns the list of ports in (topological) order, and their level.  Ports
+    in (or depending on) a cycle are excluded."""
+    ports = set(ports)
+    waiting = dict((i, 0) for i in ports)
+    for port, _depend, _typemask in _edges(ports):
+        waiting[port] += 1
+    ready = collections.deque(i for i, j in waiting.iteritems() if not j)
+    level = dict((i, 0) for i in ready)
+    order = []
+    while ready:
+        port = ready.popleft()
+        order.append(port)
+        for dependant, _typemask in graph.iter_dependants(port):
+            if dependant in waiting:
+                level[dependant] = max(level.get(dependant, 0),
+                                       level[port] + 1)
+                waiting[dependant] -= 1
+                if not waiting[dependant]:
+                    ready.append(dependant)
+    return order, dict((i, level[i]) for i in order)
+
+
+def analyse(ports, model="unit"):
+    """Analyse the graph of ports, returns a dictionary of results."""
+    ports = set(ports)
+    duration = MODELS[model]
+    order, level = levels(ports)
+
+    width = collections.Counter(level[i] for i in order)
+    finish = {}
+    critical = {}
+    for port in order:
+        start = 0
+        for depend, _typemask in graph.iter_depends(port):
+            if depend in finish and finish[depend] > start:
+                start = finish[depend]
+                critical[port] = depend
+        finish[port] = start + duration(port)
+
+    path = []
+    if finish:
+        port = max(finish, key=finish.get)
+        length = finish[port]
+        while port is not None:
+            path.append(port)
+            port = critical.get(port)
+    else:
+        length = 0
+
+    fanin = dict((i, len(graph.dependants(i) & ports))
+                 for i in ports if i in graph)
+    hubs = sorted((i for i in fanin if fanin[i]),
+                  key=lambda x: (-fanin[x], x.origin))[:10]
+
+    return {
+            "ports":     len(ports),
+            "edges":     sum(1 for _ in _edges(ports)),
+            "cyclic":    len(ports) - len(order),
+            "depth":     len(width),
+            "levels":    [width[i] for i in range(len(width))],
+            "path":      path,
+            "length":    length,
+            "hubs":      [(i, fanin[i]) for i in hubs],
+        }
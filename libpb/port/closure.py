@@ -0,0 +1,157 @@
+"""
+The transitive closure of the dependency graph.
+
+Each port is given a dense integer index, and the (transitive) dependencies
+and dependants of a port are stored as bitsets (Python longs) over those
+indices.  The closures are computed in bulk when the index is created.  New
+dependencies are applied, when the index is next queried, incrementally if
+there are only a few of them, otherwise the closures are recomputed in bulk.
+"""
+
+from __future__ import absolute_import
+
+import collections
+
+__all__ = ["ClosureIndex"]
+
+
+def bits(bitset):
+    """Iterate over the indices set in bitset."""
+    # NOTE: isolating the lowest bit of a long is linear in its size, thus
+    # search for the bits in its (reversed) binary representation instead.
+    digits = bin(bitset)[:1:-1]
+    idx = digits.find("1")
+    while idx != -1:
+        yield idx
+        idx = digits.find("1", idx + 1)
+
+
+class ClosureIndex(object):
+    """The transitive dependencies and dependants of all ports in a graph."""
+
+    #: The number of new dependencies above which the closures are rebuilt
+    REBUILD = 32
+
+    def __init__(self, graph):
+        """Initialise the index from the ports and dependencies of graph."""
+        self._graph = graph
+        self._index = {}      #: The index of each port
+        self._ports = []      #: The port of each index
+        self._closure = []    #: The (transitive) dependencies of each port
+        self._rclosure = []   #: The (transitive) dependants of each port
+        self._pending = []    #: New dependencies, yet to be applied
+
+        for port in graph:
+            self.add(port)
+        self._rebuild()
+
+    def __contains__(self, port):
+        return port in self._index
+
+    def __len__(self):
+        return len(self._ports)
+
+    def _rebuild(self):
+        """Compute the closures in bulk."""
+        self._pending = []
+        self._build(self._graph.iter_depends, self._closure)
+        self._build(self._graph.iter_dependants, self._rclosure)
+
+    def _update(self):
+        """Apply all new dependencies."""
+        if len(self._pending) > self.REBUILD:
+            self._rebuild()
+        else:
+            pending = self._pending
+            self._pending = []
+            for port, depend in pending:
+                self._add_edge(port, depend)
+
+    def _build(self, edges, closure):
+        """Compute the closure over edges, from the leaves up."""
+        index = self._index
+        ports = self._ports
+        waiting = [sum(1 for _ in edges(i)) for i in ports]
+        ready = collections.deque(i for i, j in enumerate(waiting) if not j)
+        reverse = [[] for _ in ports]
+        for idx, port in enumerate(ports):
+            for edge, _typemask in edges(port):
+                reverse[index[edge]].append(idx)
+
+        def update(idx):
+            """Compute the closure of a port from its edges."""
+            reach = 0
+            for edge, _typemask in edges(ports[idx]):
+                edge = index[edge]
+                reach |= closure[edge] | (1 << edge)
+            closure[idx] = reach
+
+        while ready:
+            idx = ready.popleft()
+            update(idx)
+            for parent in reverse[idx]:
+                waiting[parent] -= 1
+                if not waiting[parent]:
+                    ready.append(parent)
+
+        # Ports in (or depending on) a cycle, iterate until stable
+        cyclic = [i for i, j in enumerate(waiting) if j]
+        changed = bool(cyclic)
+        while changed:
+            changed = False
+            for idx in cyclic:
+                old = closure[idx]
+                update(idx)
+                changed |= closure[idx] != old
+
+    def add(self, port):
+        """Add a port (without dependencies) to the index."""
+        self._index[port] = len(self._ports)
+        self._ports.append(port)
+        self._closure.append(0)
+        self._rclosure.append(0)
+
+    def add_edge(self, port, depend):
+        """Add a dependency, from port to depend, to the index."""
+        self._pending.append((port, depend))
+
+    def _add_edge(self, port, depend):
+        """Update the closures with a dependency from port to depend."""
+        idx = self._index[port]
+        didx = self._index[depend]
+        reach = self._closure[didx] | (1 << didx)
+        if not reach & ~self._closure[idx]:
+            # Port (and thus its dependants) already depend on all of these
+            return
+        ancestors = self._rclosure[idx] | (1 << idx)
+        closure = self._closure
+        rclosure = self._rclosure
+        for i in bits(ancestors):
+            closure[i] |= reach
+        for i in bits(reach):
+            rclosure[i] |= ancestors
+
+    def ports(self, bitset):
+        """The ports in bitset."""
+        ports = self._ports
+        return [ports[i] for i in bits(bitset)]
+
+    def bitset(self, ports):
+        """The bitset of ports."""
+        index = self._index
+        bitset = 0
+        for port in ports:
+            bitset |= 1 << index[port]
+        return bitset
+
+    def depends(self, port):
+        """The bitset of the (transitive) dependencies of port."""
+        if self._pending:
+            self._update()
+        return self._closure[self._index[port]]
+
+    def dependants(self, port):
+        """The bitset of the (transitive) dependants of port."""
+        if self._pending:
+            self._update()
+        return self._rclosure[self._index[port]]
@@ -2,12 +2,35 @@
 
 from __future__ import absolute_import
 
-import collections
+import time
 
-from libpb import env, event, log, pkg, signal, stacks
+from libpb import env, event, log, pkg, queue, signal, stacks
+
+from .graph import ALL, FAILURE, RESOLV, UNRESOLV, graph, mask
 
 __all__ = ['Dependent', 'Dependency']
 
+#: The longest time (in seconds) changes in priority may be held back while
+#: ports are loading
+PRIORITY_DELAY = 10
+
+_priority_timer = None
+_priority_time = 0
+
+
+def _propagate_priority():
+    """Propagate changes in priority once a wave of ports have loaded."""
+    global _priority_time
+    from libpb import state
+
+    if len(queue.attr) and time.time() < _priority_time + PRIORITY_DELAY:
+        return
+    _priority_time = time.time()
+    if graph.propagate():
+        state.resort()
+        for i in queue.queues:
+            i.reorder()
+
 
 class DependHandler(object):
     """Common declarations to both Dependent and Dependency."""
@@ -36,26 +59,34 @@ class DependHandler(object):
       stacks.RepoInstall: (LIB, RUN, PKG),
     }
 
+    #: The dependency type mask for a given stage
+    STAGE2MASK = dict((stage, mask(types))
+                      for stage, types in STAGE2DEPENDS.items())
+
 
 class Dependent(DependHandler):
     """Tracks the dependants for a Port."""
 
     # The dependent status
-    FAILURE  = -1  #: The port failed and/or cannot resolve dependants
-    UNRESOLV = 0   #: Port does not satisfy dependants
-    RESOLV   = 1   #: Dependants resolved
+    FAILURE  = FAILURE   #: The port failed and/or cannot resolve dependants
+    UNRESOLV = UNRESOLV  #: Port does not satisfy dependants
+    RESOLV   = RESOLV    #: Dependants resolved
 
     def __init__(self, port):
         """Initialise the databases of dependants."""
+        global _priority_timer
+
         DependHandler.__init__(self)
-        self._dependants = [[], [], [], [], [], [], []]  #: All dependants
+        self._dependants = {}  #: The dependants by type mask
         self.port = port  #: The port whom we handle
-        self.priority = port.priority
+        if _priority_timer is None:
+            _priority_timer = event.event(event.alarm(), "t", data=1)
+            _priority_timer.connect(_propagate_priority)
         if port.install_status > env.flags["buildstatus"]:
-            self.status = Dependent.RESOLV
+            graph.add(port, Dependent.RESOLV, port.priority)
             # TODO: Change to actually check if we are resolved
         else:
-            self.status = Dependent.UNRESOLV
+            graph.add(port, Dependent.UNRESOLV, port.priority)
 
     def __repr__(self):
         return "<Dependent(port=%s)>" % self.port.origin
@@ -67,20 +98,44 @@ class Dependent(DependHandler):
                 self.status = Dependent.UNRESOLV
                 self._notify_all()
 
-        self._dependants[typ].append((field, port))
+        if graph.add_edge(port, self.port, typ, field):
+            self._dependants.clear()
 
     def get(self, stage=None):
         """Retrieve a list of dependants."""
-        if stage is None:
-            depends = set()
-            for i in self._dependants:
-                depends.update(j[1] for j in i)
-        else:
-            depends = set()
-            for i in DependHandler.STAGE2DEPENDS[stage]:
-                depends.update(j[1] for j in self._dependants[i])
+        typemask = ALL if stage is None else self.STAGE2MASK[stage]
+        try:
+            return self._dependants[typemask]
+        except KeyError:
+            dependants = frozenset(graph.dependants(self.port, typemask))
+            self._dependants[typemask] = dependants
+            return dependants
+
+    @property
+    def status(self):
+        """The dependent status of our port."""
+        return graph.status(self.port)
 
-        return depends
+    @status.setter
+    def status(self, status):
+        """Change the dependent status of our port."""
+        graph.set_status(self.port, status)
+        self.update_resolved()
+
+    def update_resolved(self):
+        """Update if our port resolves its dependants (after a change in its
+        status, install status or flags)."""
+        graph.set_resolved(self.port, self.port.resolved())
+
+    @property
+    def priority(self):
+        """The priority of our port (including that of all its dependants),
+        updated once the current wave of ports have loaded."""
+        return graph.priority(self.port)
+
+    def set_weight(self, weight):
+        """Set the weight (own priority) of our port."""
+        graph.set_weight(self.port, weight)
 
     @property
     def failed(self):
@@ -109,7 +164,7 @@ class Dependent(DependHandler):
 
     def _notify_all(self):
         """Notify all dependants that we have changed status."""
-        for i in self.get():
+        for i, _typemask in graph.iter_dependants(self.port):
             i.dependency.update(self)
 
     def _update(self, _field, typ):
@@ -138,10 +193,9 @@ class Dependent(DependHandler):
 
     def _verify(self):
         """Check that we actually satisfy all dependants."""
-        for i in range(len(self._dependants)):
-            for j in self._dependants[i]:
-                if not self._update(j[0], i):
-                    return False
+        for field, typ, _port in graph.fields(self.port):
+            if not self._update(field, typ):
+                return False
         return True
 
 
@@ -152,32 +206,31 @@ class Dependency(DependHandler):
 
     def __init__(self, port, depends=None):
         """Initialise the databases of dependencies."""
-        from . import get_port
+        from . import get_ports
 
         DependHandler.__init__(self)
-        self._count = 0  #: The count of outstanding dependencies
-        self._dependencies = [[], [], [], [], [], [], []]  #: All dependencies
         self._loading = 0  #: Number of dependencies left to load
         self._bad = 0  #: Number of bad dependencies
+        self._depends = {}  #: The dependencies by type mask (once loaded)
+        self.cycle = None  #: The dependency cycle the port is part of
         self.failed = False  #: If a dependency has failed
         self.port = port  #: The port whom we handle
 
         if not depends:
             depends = []
 
-        def adder(field, typ):
-            """Create an adder to place resolved port on dependency list,"""
-            def do_add(port):
-                """Add port to dependency list."""
-                self._add(port, field, typ)
-            return do_add
-
-        for i in range(len(depends)):
-            for j in depends[i]:
-                self._loading += 1
-                get_port(j[1]).connect(adder(j[0], i))
-        if not self._loading:
-            self._update_priority()
+        edges = [(j[0], i) for i in range(len(depends)) for j in depends[i]]
+        self._loading = len(edges)
+        if self._loading:
+            def adder(ports):
+                """Add the resolved ports to the dependency list."""
+                for port, (field, typ) in zip(ports, edges):
+                    self._add(port, field, typ)
+
+            origins = [j[1] for i in depends for j in i]
+            get_ports(origins).connect(adder)
+        else:
+            graph.loaded(self.port)
             event.post_event(self.loaded.emit, True)
 
     def __repr__(self):
@@ -189,12 +242,8 @@ class Dependency(DependHandler):
 
         if not isinstance(port, str):
             status = port.dependent.status
-            if port not in self._dependencies[typ]:
-                self._dependencies[typ].append(port)
+            if not graph.has_edge(self.port, port, typ):
                 port.dependent.add(field, self.port, typ)
-
-                if status != Dependent.RESOLV:
-                    self._count += 1
         else:
             log.error("Dependency._add()",
                       "Port '%s': failed to load dependency '%s'" %
@@ -210,64 +259,64 @@ class Dependency(DependHandler):
                 self.failed = True
 
         if self._loading == 0:
-            self._update_priority()
+            graph.loaded(self.port)
+            # NOTE: only searches from the ports loaded since the last search
+            # (a port without dependencies cannot be part of a cycle)
+            Dependency._check_cycles()
             self.loaded.emit(not self._bad)
 
     def get(self, stage=None):
         """Retrieve a list of dependencies."""
-        if stage is None:
-            depends = set()
-            for i in self._dependencies:
-                depends.update(i)
-        else:
-            depends = set()
-            for i in DependHandler.STAGE2DEPENDS[stage]:
-                depends.update(self._dependencies[i])
-
-        return depends
+        typemask = ALL if stage is None else self.STAGE2MASK[stage]
+        try:
+            return self._depends[typemask]
+        except KeyError:
+            depends = frozenset(graph.depends(self.port, typemask))
+            if not self._loading:
+                self._depends[typemask] = depends
+            return depends
 
     def check(self, stage):
         """Check the dependency status for a given stage."""
-        # DependHandler status might change without Port's changing
-        bad = set()
-        for i in DependHandler.STAGE2DEPENDS[stage]:
-            bad.update(j for j in self._dependencies[i] if not j.resolved())
-        return bad
+        return graph.blocking(self.port, DependHandler.STAGE2MASK[stage])
+
+    def blocked(self, stage):
+        """Indicate if any dependencies for a given stage are unresolved."""
+        return graph.blocked(self.port, DependHandler.STAGE2MASK[stage])
+
+    @property
+    def unresolved(self):
+        """The number of outstanding (typed) dependencies."""
+        return graph.unresolved(self.port)
 
     def update(self, depend):
         """Called when a dependency has changed status."""
-        status = depend.status
-        if status == Dependent.FAILURE:
+        # NOTE: the count of unresolved dependencies is maintained by the graph
+        if depend.status == Dependent.FAILURE:
             self.failed = True
             if not self.port.dependent.failed:
                 self.port.dependent.status_changed()
-            delta = -1
-        elif status == Dependent.RESOLV:
-            delta = 1
-        else: # depend.status() == DependHandler.UNRESOLV
-            delta = -1
-
-        self._count -= (delta * len([i for i in sum(self._dependencies, [])
-                                             if i == depend]))
-        if self._count < 0:
-            self._count = 0
-        if not self._count:
-            # Check that we do actually have all the dependencies met
-            # TODO: Remove, debug check
-            for i in self.get():
-                if i.dependent.status != Dependent.RESOLV:
-                    self._count += 1
-
-    def _update_priority(self):
-        """Update the priority of all ports that are affected by this port,"""
-        update_list = collections.deque()
-        updated = set()
-        update_list.extend(self.get())
-        priority = self.port.dependent.priority
-        while len(update_list):
-            port = update_list.popleft()
-            if port not in updated:
-                port.dependent.priority += priority
-                if port.dependency is not None:
-                    update_list.extend(port.dependency.get())
-                updated.add(port)
+
+    @staticmethod
+    def _check_cycles():
+        """Fail all ports that are part of a dependency cycle."""
+        from ..builder import cancel
+
+        for ports, cycle in graph.find_cycles():
+            if ports[0] is cycle[0]:
+                log.error("Dependency._check_cycles()",
+                          "Cyclic dependency: %s" %
+                              " -> ".join(i.origin for i in cycle))
+            else:
+                # The ports have joined a cycle already reported
+                log.error("Dependency._check_cycles()",
+                          "Cyclic dependency (%s): %s" %
+                              (", ".join(i.origin for i in ports),
+                               " -> ".join(i.origin for i in cycle)))
+            for port in ports:
+                port.dependency.cycle = cycle
+            for port in ports:
+                port.dependency.failed = True
+                if not port.dependent.failed:
+                    port.dependent.status_changed()
+                cancel(port)
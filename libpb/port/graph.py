@@ -0,0 +1,395 @@
+"""
+The dependency graph of ports.
+
+The graph is shared by all the Dependent and Dependency handlers.  Each edge,
+from a port to one of its dependencies, is stored (in both directions) with a
+bitmask of its dependency types.  For each port the graph maintains its
+unresolved (blocking) dependencies, and a count of them for each dependency
+type, updated incrementally as ports become resolved (or unresolved).  Thus
+if a stage is blocked (by dependencies of the stage's types) is known in
+constant time.
+
+The priority of a port is its own weight plus the priority of each of its
+dependants (thus a port shared by many dependants is built sooner).  Changes
+in priority are recorded as pending deltas, which are propagated to all the
+affected dependencies in a single topological pass by propagate().
+
+A port is complete once it has loaded its dependencies and all of those are
+complete.  As a port in a cycle can never be complete, cycles are searched
+for (with Tarjan's algorithm) only among the loaded but incomplete ports, and
+only from the ports loaded since the last search (as any new cycle contains
+the port that loaded last).  The ports of a cycle remain incomplete, so a
+port that later joins a cycle is found (and attached to it).
+"""
+
+from __future__ import absolute_import
+
+import collections
+
+__all__ = [
+        "ALL", "DependGraph", "FAILURE", "RESOLV", "UNRESOLV", "graph", "mask"
+    ]
+
+# The dependent status
+FAILURE  = -1  #: The port failed and/or cannot resolve dependants
+UNRESOLV = 0   #: Port does not satisfy dependants
+RESOLV   = 1   #: Dependants resolved
+
+TYPES = 7  #: The number of dependency types
+ALL = (1 << TYPES) - 1  #: The mask of all dependency types
+
+#: The dependency types in each mask
+TYPEBITS = tuple(tuple(i for i in range(TYPES) if mask & (1 << i))
+                 for mask in range(ALL + 1))
+
+
+def mask(types):
+    """Convert a sequence of dependency types into a mask."""
+    typemask = 0
+    for typ in types:
+        typemask |= 1 << typ
+    return typemask
+
+
+class DependGraph(object):
+    """A graph of ports and their (typed) dependencies."""
+
+    def __init__(self):
+        """Initialise an empty graph."""
+        self._status = {}      #: The dependent status of each port
+        self._depends = {}     #: The dependencies of a port (and their mask)
+        self._dependants = {}  #: The dependants of a port (and their mask)
+        self._fields = {}      #: The field of each (dependant, type) edge
+        self._resolved = set() #: Ports that resolve their dependants
+        self._blocking = {}    #: The unresolved dependencies of a port
+        self._blocked = {}     #: The count of unresolved dependencies by type
+        self._weight = {}      #: The weight (own priority) of each port
+        self._priority = {}    #: The priority of each port
+        self._pending = {}     #: Priority changes yet to be propagated
+        self._complete = set() #: Ports with all dependencies complete
+        self._incomplete = {}  #: Count of incomplete dependencies (if loaded)
+        self._new = []         #: Ports loaded since the last search
+        self._cycles = {}      #: The path of the cycle each port is part of
+        self._closure = None   #: The transitive closure (once required)
+        self.edges = 0         #: The number of (typed) edges
+
+    def __contains__(self, port):
+        return port in self._status
+
+    def __iter__(self):
+        return self._status.iterkeys()
+
+    def __len__(self):
+        return len(self._status)
+
+    def add(self, port, status=UNRESOLV, weight=0):
+        """Add a port to the graph."""
+        assert port not in self._status
+        self._status[port] = status
+        self._depends[port] = {}
+        self._dependants[port] = {}
+        self._fields[port] = {}
+        self._blocking[port] = {}
+        self._blocked[port] = [0] * TYPES
+        self._weight[port] = weight
+        self._priority[port] = 0
+        if weight:
+            self._pending[port] = weight
+        if self._closure is not None:
+            self._closure.add(port)
+
+    def add_edge(self, port, depend, typ, field=None):
+        """Add a dependency edge, of type typ, from port to depend.  Returns
+        False if the edge already exists."""
+        bit = 1 << typ
+        typemask = self._depends[port].get(depend, 0)
+        if typemask & bit:
+            return False
+        if not typemask:
+            self._add_delta(depend, self._priority[port])
+            if self._closure is not None:
+                self._closure.add_edge(port, depend)
+        self._depends[port][depend] = typemask | bit
+        self._dependants[depend][port] = typemask | bit
+        self._fields[depend][(port, typ)] = field
+        self.edges += 1
+        if depend not in self._resolved:
+            self._blocking[port][depend] = typemask | bit
+            self._blocked[port][typ] += 1
+        return True
+
+    def has_edge(self, port, depend, typ):
+        """Indicate if port depends on depend (with type typ)."""
+        return bool(self._depends[port].get(depend, 0) & (1 << typ))
+
+    def depends(self, port, typemask=ALL):
+        """The dependencies of port (with any of the types in typemask)."""
+        if typemask == ALL:
+            return set(self._depends[port])
+        return set(i for i, j in self._depends[port].iteritems()
+                   if j & typemask)
+
+    def dependants(self, port, typemask=ALL):
+        """The dependants of port (with any of the types in typemask)."""
+        if typemask == ALL:
+            return set(self._dependants[port])
+        return set(i for i, j in self._dependants[port].iteritems()
+                   if j & typemask)
+
+    def closure(self):
+        """The transitive closure index of the graph (created on first use
+        and thereafter maintained as the graph changes)."""
+        if self._closure is None:
+            from .closure import ClosureIndex
+            self._closure = ClosureIndex(self)
+        return self._closure
+
+    def iter_depends(self, port):
+        """Iterate over the dependencies of port (and their type masks)."""
+        return self._depends[port].iteritems()
+
+    def iter_dependants(self, port):
+        """Iterate over the dependants of port (and their type masks)."""
+        return self._dependants[port].iteritems()
+
+    def fields(self, port):
+        """Iterate over the (field, type, dependant) of port's dependants."""
+        for (dependant, typ), field in self._fields[port].iteritems():
+            yield field, typ, dependant
+
+    def status(self, port):
+        """The dependent status of port."""
+        return self._status[port]
+
+    def set_status(self, port, status):
+        """Change the dependent status of port."""
+        self._status[port] = status
+
+    def resolved(self, port):
+        """Indicate if port resolves its dependants."""
+        return port in self._resolved
+
+    def set_resolved(self, port, resolved):
+        """Change if port resolves its dependants, updating the unresolved
+        dependencies of all its dependants."""
+        if resolved == (port in self._resolved):
+            return
+        blocking = self._blocking
+        blocked = self._blocked
+        if resolved:
+            self._resolved.add(port)
+            for dependant, typemask in self._dependants[port].iteritems():
+                del blocking[dependant][port]
+                counts = blocked[dependant]
+                for typ in TYPEBITS[typemask]:
+                    counts[typ] -= 1
+        else:
+            self._resolved.remove(port)
+            for dependant, typemask in self._dependants[port].iteritems():
+                blocking[dependant][port] = typemask
+                counts = blocked[dependant]
+                for typ in TYPEBITS[typemask]:
+                    counts[typ] += 1
+
+    def blocking(self, port, typemask=ALL):
+        """The unresolved dependencies of port (with any of the types in
+        typemask)."""
+        if typemask == ALL:
+            return set(self._blocking[port])
+        return set(i for i, j in self._blocking[port].iteritems()
+                   if j & typemask)
+
+    def blocked(self, port, typemask=ALL):
+        """Indicate if port has unresolved dependencies (with any of the types
+        in typemask)."""
+        counts = self._blocked[port]
+        for typ in TYPEBITS[typemask]:
+            if counts[typ]:
+                return True
+        return False
+
+    def unresolved(self, port):
+        """The number of port's unresolved dependency edges."""
+        return sum(self._blocked[port])
+
+    def priority(self, port):
+        """The priority of port (its weight plus its dependants' priority), as
+        of the last propagate()."""
+        return self._priority[port]
+
+    def set_weight(self, port, weight):
+        """Set the weight (own priority) of port."""
+        self._add_delta(port, weight - self._weight[port])
+        self._weight[port] = weight
+
+    def _add_delta(self, port, delta):
+        """Record a change in the priority of port."""
+        # NOTE: port's priority may exclude pending changes of its dependants,
+        # those changes will propagate to port's dependencies when applied.
+        if delta:
+            self._pending[port] = self._pending.get(port, 0) + delta
+
+    def propagate(self):
+        """Apply all pending changes in priority, dependants before their
+        dependencies.  Returns False if there were no pending changes."""
+        if not self._pending:
+            return False
+        depends = self._depends
+        delta = self._pending
+        self._pending = {}
+
+        # Count the number of affected dependants of each affected port
+        waiting = dict.fromkeys(delta, 0)
+        queue = list(delta)
+        while queue:
+            for depend in depends[queue.pop()]:
+                if depend in waiting:
+                    waiting[depend] += 1
+                else:
+                    waiting[depend] = 1
+                    queue.append(depend)
+
+        priority = self._priority
+        ready = collections.deque(i for i, j in waiting.iteritems() if not j)
+        while waiting:
+            if not ready:
+                # A cycle in the graph, break it at an arbitrary port
+                ready.append(iter(waiting).next())
+            port = ready.popleft()
+            if port not in waiting:
+                continue
+            del waiting[port]
+            change = delta.pop(port, 0)
+            priority[port] += change
+            for depend in depends[port]:
+                if depend in waiting:
+                    if change:
+                        delta[depend] = delta.get(depend, 0) + change
+                    waiting[depend] -= 1
+                    if not waiting[depend]:
+                        ready.append(depend)
+        return True
+
+    def loaded(self, port):
+        """Indicate port has loaded (added all its dependency edges)."""
+        assert port not in self._incomplete and port not in self._complete
+        complete = self._complete
+        count = sum(1 for i in self._depends[port] if i not in complete)
+        if count:
+            self._incomplete[port] = count
+            self._new.append(port)
+        else:
+            self._set_complete((port,))
+
+    def find_cycles(self):
+        """Find the new dependency cycles amongst the ports loaded since the
+        last search.  Each cycle is returned as a tuple of its ports and a
+        path through them (from and back to the first port).  Ports that have
+        joined a cycle already found are returned with the path of that
+        cycle."""
+        if not self._new:
+            return []
+        roots = self._new
+        self._new = []
+        depends = self._depends
+        region = self._incomplete
+
+        cycles = []
+        index = {}
+        lowlink = {}
+        stack = []
+        onstack = set()
+        for root in roots:
+            if root in index:
+                continue
+            index[root] = lowlink[root] = len(index)
+            stack.append(root)
+            onstack.add(root)
+            work = [(root, iter(depends[root]))]
+            while work:
+                port, children = work[-1]
+                for child in children:
+                    if child not in region:
+                        continue
+                    if child not in index:
+                        index[child] = lowlink[child] = len(index)
+                        stack.append(child)
+                        onstack.add(child)
+                        work.append((child, iter(depends[child])))
+                        break
+                    elif child in onstack:
+                        lowlink[port] = min(lowlink[port], index[child])
+                else:
+                    work.pop()
+                    if work:
+                        parent = work[-1][0]
+                        lowlink[parent] = min(lowlink[parent], lowlink[port])
+                    if lowlink[port] == index[port]:
+                        scc = []
+                        while True:
+                            child = stack.pop()
+                            onstack.remove(child)
+                            scc.append(child)
+                            if child is port:
+                                break
+                        if len(scc) > 1 or port in depends[port]:
+                            cycles.append(scc)
+
+        found = []
+        for scc in cycles:
+            path = None
+            for port in scc:
+                if port in self._cycles:
+                    path = self._cycles[port]
+                    break
+            ports = [i for i in scc if i not in self._cycles]
+            if not ports:
+                continue
+            if path is None:
+                path = self._cycle_path(scc)
+            for port in ports:
+                self._cycles[port] = path
+            found.append((ports, path))
+        return found
+
+    def _cycle_path(self, scc):
+        """Find a (shortest) cycle, starting with the first port in scc."""
+        members = set(scc)
+        start = scc[0]
+        parent = {start: None}
+        queue = collections.deque((start,))
+        while queue:
+            port = queue.popleft()
+            for depend in self._depends[port]:
+                if depend is start:
+                    path = [start]
+                    while port is not start:
+                        path.insert(1, port)
+                        port = parent[port]
+                    path.append(start)
+                    return path
+                if depend in members and depend not in parent:
+                    parent[depend] = port
+                    queue.append(depend)
+        return scc + scc[:1]
+
+    def _set_complete(self, ports):
+        """Mark ports as complete, and any loaded dependants that have thus
+        become complete."""
+        complete = self._complete
+        incomplete = self._incomplete
+        ports = list(ports)
+        for port in ports:
+            incomplete.pop(port, None)
+        complete.update(ports)
+        while ports:
+            for dependant in self._dependants[ports.pop()]:
+                if dependant in incomplete:
+                    incomplete[dependant] -= 1
+                    if not incomplete[dependant]:
+                        del incomplete[dependant]
+                        complete.add(dependant)
+                        ports.append(dependant)
+
+
+graph = DependGraph()
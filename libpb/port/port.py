@@ -4,7 +4,7 @@ from __future__ import absolute_import, with_statement
 
 import os
 
-from libpb import env, log, make, pkg, stacks
+from libpb import buildlog, env, journal, log, make, pkg, stacks, wrkdir
 
 __all__ = ["Port"]
 
@@ -34,10 +34,14 @@ class Port(object):
         self.stacks = dict((i, stacks.Stack(i)) for i in ("common", "build",
                                                           "package", "repo"))
 
+        self.dependency = None
+        self.dependent = None
+
+        journal.replay(self)
         self.install_status = pkg.db.status(self)
 
-        self.dependency = None
         self.dependent = Dependent(self)
+        self.dependent.update_resolved()
 
     def __lt__(self, other):
         return self.dependent.priority > other.dependent.priority
@@ -45,6 +49,18 @@ class Port(object):
     def __repr__(self):
         return "<Port(%s)>" % (self.origin)
 
+    @property
+    def install_status(self):
+        """The install status of the port."""
+        return self._install_status
+
+    @install_status.setter
+    def install_status(self, status):
+        """Set the install status of the port."""
+        self._install_status = status
+        if self.dependent is not None:
+            self.dependent.update_resolved()
+
     def resolved(self):
         """Indicate if the port meets it's dependents."""
         # TODO: use Dependent.RESOLV (current import issues)
@@ -70,8 +86,12 @@ class Port(object):
             return True
 
     def _post_clean(self, _pmake=None):
-        """Remove log file."""
-        if not self.dependent.failed and os.path.isfile(self.log_file) and \
+        """Remove (or keep, compressed) log file, and release the port's work
+        directory."""
+        wrkdir.release(self)
+        if not self.dependent.failed and \
                 (env.flags["mode"] == "clean" or stacks.Build in self.stages or
                  (self.dependency and self.dependency.failed)):
-            os.unlink(self.log_file)
+            buildlog.discard(self)
+        else:
+            buildlog.keep(self, self.dependent.failed)
@@ -4,7 +4,7 @@ from __future__ import absolute_import
 
 import bisect
 
-from libpb import env
+from libpb import env, trace
 
 __all__ = [
         "QueueManager", "queues", "attr", "config", "checksum", "fetch",
@@ -15,13 +15,15 @@ __all__ = [
 class QueueManager(object):
     """Manages jobs and runs them as resources come available."""
 
-    def __init__(self, load=1):
+    def __init__(self, load=1, name=""):
         """Initialise the manager with an indication of load available."""
         self._load = load
+        self.name = name
         self._sort = False
         self.queue = []
         self.active = []
         self.stalled = []
+        self.reserved = []
         self.active_load = 0
 
     def __len__(self):
@@ -43,6 +45,14 @@ class QueueManager(object):
     def add(self, job):
         """Add a job to be run."""
         assert(job not in self.queue)
+        trace.added(self, job)
+        if job in self.reserved:
+            # The load is already reserved, run the job directly
+            self.reserved.remove(job)
+            self.active.append(job)
+            trace.started(self, job)
+            job.run(self)
+            return
         if self._sort:
             self.queue.append(job)
         else:
@@ -50,13 +60,41 @@ class QueueManager(object):
         if self.active_load < self._load:
             self._run()
 
+    def extend(self, jobs):
+        """Add several jobs to be run."""
+        jobs = list(jobs)
+        if not jobs:
+            return
+        for job in jobs:
+            trace.added(self, job)
+        self.queue.extend(jobs)
+        if not self._sort:
+            self.queue.sort()
+        if self.active_load < self._load:
+            self._run()
+
     def done(self, job):
         """Indicates a job has completed."""
         self.active.remove(job)
         self.active_load -= job.load
+        trace.done(self, job)
         if self.active_load < self._load:
             self._run()
 
+    def reserve(self, job):
+        """Reserve load for a job, that will be run as soon as it is added."""
+        assert(job not in self.queue and job not in self.reserved)
+        self.reserved.append(job)
+        self.active_load += job.load
+
+    def release(self, job):
+        """Release the load reserved for a job (that will not be added)."""
+        if job in self.reserved:
+            self.reserved.remove(job)
+            self.active_load -= job.load
+            if self.active_load < self._load:
+                self._run()
+
     def reorder(self):
         """Reorder the queued jobs as their priority may have changed."""
         self._sort = True
@@ -85,11 +123,13 @@ class QueueManager(object):
                 try:
                     self.active_load += job.load
                     self.active.append(job)
+                    trace.started(self, job)
                     job.run(self)
                 except StalledJob:
                     self.active_load -= job.load
                     self.active.remove(job)
                     stalled.append(job)
+                    trace.stalled(self, job)
         if len(stalled):
             self.stalled.extend(stalled)
             self.stalled.sort()
@@ -111,13 +151,13 @@ class QueueManager(object):
         return queue.pop(best_idx)
 
 
-attr  = QueueManager(env.CPUS)
-clean = QueueManager(1)
+attr  = QueueManager(env.CPUS, "attr")
+clean = QueueManager(1, "clean")
 
-config   = QueueManager(1)
-checksum = QueueManager(max(1, env.CPUS // 2))
-fetch    = QueueManager(1)
-build    = QueueManager(env.CPUS * 2)
-install  = QueueManager(1)
-package  = QueueManager(1)
+config   = QueueManager(1, "config")
+checksum = QueueManager(max(1, env.CPUS // 2), "checksum")
+fetch    = QueueManager(1, "fetch")
+build    = QueueManager(env.CPUS * 2, "build")
+install  = QueueManager(1, "install")
+package  = QueueManager(1, "package")
 queues   = (config, checksum, fetch, build, install, package, install, install)
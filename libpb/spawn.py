@@ -0,0 +1,203 @@
+"""
+The spawn module.  This module starts subprocesses using posix_spawn(3)
+(through ctypes) instead of fork(2), where supported.
+
+subprocess.Popen forks the interpreter, runs Python code in the child (to
+call setsid(2)) and, for close_fds, calls close(2) on every descriptor up to
+the descriptor limit.  Here the child is placed in its own process group (so
+it may be killed with killpg(2)), the signals ignored by portbuilder are reset
+and all descriptors except stdin, stdout and stderr are closed using the spawn
+attributes and file actions, without running any code between fork and exec.
+
+This requires posix_spawn_file_actions_addclosefrom_np(3) (FreeBSD 13.1 and
+glibc 2.34), otherwise `available' is False and subprocess should be used.
+"""
+
+from __future__ import absolute_import
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import signal
+import sys
+
+__all__ = ["PIPE", "STDOUT", "Process", "available"]
+
+#: Create a pipe to the standard stream (as subprocess.PIPE)
+PIPE = -1
+
+#: Redirect stderr to stdout (as subprocess.STDOUT)
+STDOUT = -2
+
+#: The spawn attribute flags, by platform (POSIX_SPAWN_SETPGROUP and
+#: POSIX_SPAWN_SETSIGDEF)
+FLAGS = {
+        "freebsd": (0x02, 0x10),
+        "linux":   (0x02, 0x04),
+    }
+
+#: The signals reset to their default action in the child
+SIGDEF = (signal.SIGINT, signal.SIGTERM, signal.SIGPIPE)
+
+#: The size (in bytes) reserved for posix_spawn_file_actions_t,
+#: posix_spawnattr_t and sigset_t (an upper bound of the supported platforms)
+OPAQUE = 512
+
+
+def _libc():
+    """The C library, if it supports spawning processes."""
+    platform = sys.platform.rstrip("0123456789")
+    name = ctypes.util.find_library("c")
+    if platform not in FLAGS or not name:
+        return None
+    try:
+        libc = ctypes.CDLL(name, use_errno=True)
+        libc.posix_spawnp
+        libc.posix_spawn_file_actions_addclosefrom_np
+    except (AttributeError, OSError):
+        return None
+    return libc
+
+_c = _libc()
+
+#: Indicates if processes can be started with posix_spawn
+available = _c is not None
+
+
+class Process(object):
+    """A subprocess, started with posix_spawnp (similar to subprocess.Popen).
+
+    The subprocess is the leader of a new process group.  The standard
+    streams may be None (inherited), PIPE or a file (object or descriptor),
+    and stderr may also be STDOUT.
+    """
+
+    def __init__(self, args, stdin=None, stdout=None, stderr=None):
+        """Start a subprocess running args."""
+        self.args = args
+        self.pid = None
+        self.returncode = None
+        self.rusage = None  #: The resource usage, once reaped
+        self.stdin = self.stdout = self.stderr = None
+
+        child = []   #: Descriptors for the child, closed once spawned
+        parent = []  #: Descriptors for the parent
+        actions = []
+        for fd, stream in enumerate((stdin, stdout, stderr)):
+            if stream is None:
+                parent.append(None)
+                continue
+            if stream == STDOUT:
+                assert fd == 2 and stdout is not None
+                parent.append(None)
+                actions.append((1, 2))
+                continue
+            if stream == PIPE:
+                read, write = os.pipe()
+                if fd:
+                    stream, end = write, read
+                else:
+                    stream, end = read, write
+                child.append(stream)
+                parent.append(end)
+            else:
+                if hasattr(stream, "fileno"):
+                    stream.flush()
+                    stream = stream.fileno()
+                parent.append(None)
+            actions.append((stream, fd))
+
+        try:
+            self.pid = _spawn(args, actions)
+        except:
+            for fd in child + [i for i in parent if i is not None]:
+                os.close(fd)
+            raise
+        for fd in child:
+            os.close(fd)
+
+        if parent[0] is not None:
+            self.stdin = os.fdopen(parent[0], "wb")
+        if parent[1] is not None:
+            self.stdout = os.fdopen(parent[1], "rb")
+        if parent[2] is not None:
+            self.stderr = os.fdopen(parent[2], "rb")
+
+    def poll(self):
+        """Check if the subprocess has terminated, returns the returncode."""
+        if self.returncode is None:
+            self._wait(os.WNOHANG)
+        return self.returncode
+
+    def wait(self):
+        """Wait for the subprocess to terminate, returns the returncode."""
+        if self.returncode is None:
+            self._wait(0)
+        return self.returncode
+
+    def _wait(self, options):
+        """Reap the subprocess (if terminated), with its resource usage."""
+        while True:
+            try:
+                pid, status, self.rusage = os.wait4(self.pid, options)
+                break
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno != errno.ECHILD:
+                    raise
+                # Already reaped (by someone else)
+                pid, status = self.pid, 0
+                break
+        if pid == self.pid:
+            if os.WIFSIGNALED(status):
+                self.returncode = -os.WTERMSIG(status)
+            else:
+                self.returncode = os.WEXITSTATUS(status)
+
+
+def _spawn(args, actions):
+    """Spawn args, with the given (descriptor, target) dup2 actions, returns
+    the pid."""
+    setpgroup, setsigdef = FLAGS[sys.platform.rstrip("0123456789")]
+    file_actions = ctypes.create_string_buffer(OPAQUE)
+    attr = ctypes.create_string_buffer(OPAQUE)
+    sigdef = ctypes.create_string_buffer(OPAQUE)
+
+    _check(_c.posix_spawn_file_actions_init(file_actions))
+    try:
+        for fd, target in actions:
+            _check(_c.posix_spawn_file_actions_adddup2(file_actions, fd,
+                                                       target))
+        _check(_c.posix_spawn_file_actions_addclosefrom_np(file_actions, 3))
+
+        _check(_c.posix_spawnattr_init(attr))
+        try:
+            _c.sigemptyset(sigdef)
+            for signum in SIGDEF:
+                _c.sigaddset(sigdef, signum)
+            _check(_c.posix_spawnattr_setsigdefault(attr, sigdef))
+            _check(_c.posix_spawnattr_setpgroup(attr, 0))
+            _check(_c.posix_spawnattr_setflags(
+                    attr, ctypes.c_short(setpgroup | setsigdef)))
+
+            argv = (ctypes.c_char_p * (len(args) + 1))(
+                    *(tuple(args) + (None,)))
+            environ = ["%s=%s" % i for i in os.environ.iteritems()]
+            envp = (ctypes.c_char_p * (len(environ) + 1))(
+                    *(environ + [None]))
+            pid = ctypes.c_int()
+            _check(_c.posix_spawnp(ctypes.byref(pid), args[0], file_actions,
+                                   attr, argv, envp))
+            return pid.value
+        finally:
+            _c.posix_spawnattr_destroy(attr)
+    finally:
+        _c.posix_spawn_file_actions_destroy(file_actions)
+
+
+def _check(err):
+    """Raise an OSError if a posix_spawn function failed."""
+    if err:
+        raise OSError(err, os.strerror(err))
@@ -5,7 +5,8 @@ The stacks.base module.  This module contains the basic Stack and Stage classes.
 import abc
 import time
 
-from libpb import event, job, log
+from libpb import (buildlog, cgroup, event, job, journal, log, metrics,
+                   usage, wrkdir)
 
 __all__ = ["Stack", "Stage"]
 
@@ -32,6 +33,8 @@ class Stage(job.Job):
         self.pid = None
         self.stack = port.stacks[self.stack]
         self.failed = self.stack.failed
+        self.usage = usage.Usage()
+        self.accounting = None  #: The resources used by the stage's cgroup
 
     def __repr__(self):
         return "<%s(%s)>" % (self.__class__.__name__, self.port.origin)
@@ -62,6 +65,9 @@ class Stage(job.Job):
 
         log.debug("Stage.work()", "Port '%s': starting stage %s" %
                       (self.port.origin, self.name))
+        metrics.stage_started(self)
+        usage.stage_started(self)
+        cgroup.stage_started(self)
         if not self.check(self.port):
             # Cannot call self._finalise(True) directly as self.done() cannot
             # be called from within the scope of self.work()
@@ -69,13 +75,22 @@ class Stage(job.Job):
             return
         assert self.prev in self.port.stages
         assert (not self.port.dependency or
-                not self.port.dependency.check(self.__class__))
+                not self.port.dependency.blocked(self.__class__))
         if self.complete():
             # Cannot call self._finalise(True) directly as self.done() cannot
             # be called from within the scope of self.work()
             event.post_event(self._finalise, True)
         else:
-            self._do_stage()  # May throw job.JobStalled()
+            # NOTE: placed once it is known the stage will run
+            wrkdir.stage_started(self)
+            try:
+                self._do_stage()  # May throw job.StalledJob()
+            except job.StalledJob:
+                # The stage will be run again, once no longer stalled
+                metrics.stage_stalled(self)
+                usage.stage_stalled(self)
+                cgroup.stage_stalled(self)
+                raise
             self.stack.working = time.time()
 
     def _finalise(self, status):
@@ -89,9 +104,15 @@ class Stage(job.Job):
             else:
                 self.stack.failed = self.__class__
             self.failed = True
+            buildlog.keep(self.port, True)
         else:
             log.debug("Stage._finalise()", "Port '%s': finished stage %s" %
                           (self.port.origin, self.name))
         self.stack.working = False
         self.port.stages.add(self.__class__)
+        journal.stage(self, status)
+        metrics.stage_finished(self, status)
+        usage.stage_finished(self, status)
+        cgroup.stage_finished(self, status)
+        wrkdir.stage_finished(self, status)
         self.done()
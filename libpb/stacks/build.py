@@ -6,7 +6,7 @@ The stacks.build module.  This module contains the Stages that make up the
 import contextlib
 import os
 
-from libpb import env, job, log, pkg, queue
+from libpb import env, fetch, job, log, make, pkg, queue, wrkdir
 from libpb.stacks import base, common, mutators
 
 __all__ = ["Checksum", "Fetch", "Build", "Install", "Package"]
@@ -123,9 +123,27 @@ class Fetch(Distfiles, mutators.MakeStage):
         """Issue a make.target() command to fetch outstanding distfiles,"""
         if not Fetch._fetch_lock.acquire(self.port.attr["distfiles"]):
             raise job.StalledJob()
+        elif env.flags["native_fetch"] and not env.flags["no_op"]:
+            distfiles = [i for i in self.port.attr["distfiles"]
+                         if i not in self._fetched]
+            fetch.PortFetch(self.port, distfiles).connect(
+                    self._post_fetch).get()
         else:
-            self._make_target("checksum", BATCH=True, DISABLE_CONFLICTS=True,
-                                          NO_DEPENDS=True)
+            self._fetch()
+
+    def _fetch(self):
+        """Issue a make.target() command to fetch (and checksum) the
+        distfiles."""
+        self._make_target("checksum", BATCH=True, DISABLE_CONFLICTS=True,
+                                      NO_DEPENDS=True)
+
+    def _post_fetch(self, _portfetch, status):
+        """Finish the stage once the distfiles have been fetched natively,
+        otherwise fetch the remaining distfiles with make(1)."""
+        if status or env.flags["mode"] == "clean":
+            self._finalise(self._post_make(status))
+        else:
+            self._fetch()
 
     def _post_make(self, status):
         """Process the results of make.target()."""
@@ -172,6 +190,22 @@ class Build(mutators.MakeStage, mutators.PostFetch):
         """Issue a make.target() to build the port."""
         self._make_target(("all",), BATCH=True, NO_DEPENDS=True)
 
+    def _post_make(self, status):
+        """Clean a placed port that failed to build as its work directory ran
+        out of space, to build it on disk."""
+        if (status or wrkdir.prefix(self.port) is None or
+                not wrkdir.exhausted(self.port)):
+            return status
+        self.pid = make.make_target(self.port, "clean", NOCLEANDEPENDS=True,
+                                    BATCH=True).connect(self._post_clean).pid
+        return None
+
+    def _post_clean(self, _pmake):
+        """Build the port again, on disk."""
+        self.pid = None
+        wrkdir.evict(self.port)
+        self._pre_make()
+
 
 class Install(mutators.Deinstall, mutators.MakeStage, mutators.PostFetch,
               mutators.Resolves):
@@ -181,6 +215,9 @@ class Install(mutators.Deinstall, mutators.MakeStage, mutators.PostFetch,
     prev = Build
     stack = "build"
 
+    # NOTE: Install is not fused with Build, as the install queue would be
+    # reserved (holding back the installs of other ports) for the whole build
+
     def _pre_make(self):
         """Issue a make.target() to install the port."""
         if self.port.install_status == pkg.ABSENT:
@@ -190,11 +227,14 @@ class Install(mutators.Deinstall, mutators.MakeStage, mutators.PostFetch,
         # pylint: disable-msg=E1101
         # NOTE: pylint doesn't detect self._make_target() inherited from
         # mutators.MakeStage()
+        self._make_target(target, **self._variables())
+
+    def _variables(self):
+        """The make variables used to install the port."""
         if "explicit" in self.port.flags:
-            self._make_target(target, BATCH=True, NO_DEPENDS=True)
+            return dict(BATCH=True, NO_DEPENDS=True)
         else:
-            self._make_target(target, BATCH=True, NO_DEPENDS=True,
-                                      INSTALLS_DEPENDS=True)
+            return dict(BATCH=True, NO_DEPENDS=True, INSTALLS_DEPENDS=True)
 
 
 class Package(mutators.MakeStage, mutators.Packagable, mutators.PostFetch):
@@ -204,6 +244,12 @@ class Package(mutators.MakeStage, mutators.Packagable, mutators.PostFetch):
     prev = Install
     stack = "build"
 
+    markers = ("===>  Building package for ",)
+
     def _pre_make(self):
         """Issue a make.target() to package the port,"""
         self._make_target("package", BATCH=True, NO_DEPENDS=True)
+
+    def _target(self):
+        """The targets to package the port (fused with its install)."""
+        return ("package",), dict(BATCH=True, NO_DEPENDS=True)
@@ -6,7 +6,7 @@ all other Stacks.
 import contextlib
 import os
 
-from libpb import env, event, job, mk, pkg
+from libpb import buildlog, env, event, job, mk, pkg
 from libpb.stacks import base, mutators
 
 __all__ = ["Config", "Depend"]
@@ -110,8 +110,8 @@ class Config(mutators.MakeStage):
             log_file = self.port.log_file
             self.port.log_file = os.path.join(env.flags["log_dir"],
                                               self.port.attr["pkgname"])
-            if log_file != self.port.log_file and os.path.isfile(log_file):
-                os.rename(log_file, self.port.log_file)
+            if log_file != self.port.log_file:
+                buildlog.moved(self.port, log_file)
         self._finalise(attr is not None)
 
 
@@ -138,7 +138,7 @@ class Depend(base.Stage):
                         if name in distfiles:
                             priority += int(size)
         self.port.priority = priority
-        self.port.dependent.priority += priority
+        self.port.dependent.set_weight(priority)
         depends = ("depend_build", "depend_extract", "depend_fetch",
                    "depend_lib", "depend_run", "depend_patch", "depend_package")
         depends = [self.port.attr[i] for i in depends]
@@ -4,14 +4,17 @@ behaviour of Stages.
 """
 
 import abc
+import errno
+import fcntl
 import functools
+import os
 
-from libpb import env, event, log, make, pkg
+from libpb import buildlog, cgroup, env, event, log, make, pkg
 from libpb.stacks import base
 
 __all__ = [
-        "Deinstall", "MakeStage", "Packagable", "PackageInstaller", "PostFetch",
-        "Resolves"
+        "Deinstall", "FusedMake", "MakeStage", "Packagable", "PackageInstaller",
+        "PostFetch", "Resolves"
     ]
 
 
@@ -56,6 +59,12 @@ class MakeStage(base.Stage):
     """A stage that requires a standard make(1) call."""
     __metaclass__ = abc.ABCMeta
 
+    #: The prefixes of the output lines that indicate this stage has started,
+    #: if the stage may be fused with the previous stage
+    markers = ()
+
+    _fused = None  #: The fused make(1) that runs this stage
+
     @abc.abstractmethod
     def _pre_make(self):
         """Prepare and issue a make(1) command."""
@@ -65,23 +74,193 @@ class MakeStage(base.Stage):
         """Process the result from a make(1) command."""
         return status
 
+    def _target(self):  # pylint: disable-msg=R0201
+        """The targets and make variables of this stage, if the stage may be
+        fused with the previous stage (otherwise None)."""
+        return None
+
     def _do_stage(self):
         """Run the self._pre_make() command to issue a make.target()."""
         self._pre_make()
 
     def _make_target(self, targets, **kwargs):
         """Build the requested targets."""
-        pmake = make.make_target(self.port, targets, **kwargs)
-        self.pid = pmake.connect(self.__make).pid
+        if self._fused is not None:
+            self.pid = self._fused.attach(self, self.__made)
+            return
+        if isinstance(targets, str):
+            targets = (targets,)
+        stages = ()
+        if env.flags["fuse"]:
+            stages, targets = self._fuse(targets, kwargs)
+        if stages:
+            fused = FusedMake([self] + stages, targets, kwargs)
+            self.pid = fused.attach(self, self.__made)
+        else:
+            pmake = make.make_target(self.port, targets, **kwargs)
+            self.pid = pmake.connect(self.__make).pid
+
+    def _fuse(self, targets, kwargs):
+        """Find the following stages that may be run by the same make(1)
+        command (updating the make variables), returns their stage jobs (with
+        the queues reserved) and the targets of all the stages."""
+        from libpb.builder import builders
+
+        if env.flags["no_op"] or env.flags["fetch_only"]:
+            return [], targets
+        stages = []
+        stage = self.__class__
+        while True:
+            for builder in builders.values():
+                if (builder.stage.prev is stage and
+                        issubclass(builder.stage, MakeStage) and
+                        self.port in builder.ports):
+                    break
+            else:
+                break
+            stagejob = builder.ports[self.port]
+            target = stagejob._target()
+            if target is None:
+                break
+            if [k for k, v in target[1].items() if kwargs.get(k, v) != v]:
+                # Conflicting make variables
+                break
+            if not builder.reserve(self.port):
+                break
+            targets += tuple(target[0])
+            kwargs.update(target[1])
+            stages.append(stagejob)
+            stage = builder.stage
+        return stages, targets
 
     def __make(self, pmake):
+        """Call the _post_[stage] function and finalise the stage."""
+        self.__made(pmake.wait() == make.SUCCESS)
+
+    def __made(self, status):
         """Call the _post_[stage] function and finalise the stage."""
         self.pid = None
-        status = self._post_make(pmake.wait() == make.SUCCESS)
+        status = self._post_make(status)
         if status is not None:
             self._finalise(status)
 
 
+class FusedMake(object):
+    """A make(1) command that runs the targets of consecutive stages.
+
+    The output is logged, and watched for the markers of the following
+    stages: once a stage's marker is seen all prior stages have succeeded.
+    The following stages are run (by their queues, which are reserved for
+    them) once their previous stage has finalised, and attach to the command.
+    """
+
+    def __init__(self, stages, targets, kwargs):
+        """Run the targets of the stages (the first being active)."""
+        from libpb.builder import builders
+
+        self.port = stages[0].port
+        self.stages = stages
+        self._phase = 0       #: The stage currently being run
+        self._status = {}     #: The status of finished stages
+        self._callbacks = {}  #: The callbacks of attached stages
+        self._line = ""       #: The start of the current output line
+        self._reading = True  #: If the output is still being read
+        self._queues = {}     #: The queues reserved for the following stages
+        for stagejob in stages[1:]:
+            stagejob._fused = self
+            self._queues[stagejob] = builders[stagejob.__class__].queue
+            stagejob.connect(self._release)
+
+        log.debug("FusedMake()", "Port '%s': fused stages %s" %
+                      (self.port.origin, ", ".join(i.name for i in stages)))
+        self.make = make.make_target(self.port, targets, pipe="log", **kwargs)
+        self.pid = self.make.pid
+        cgroup.fuse(stages)
+        self._fd = self.make.stdout.fileno()
+        fcntl.fcntl(self._fd, fcntl.F_SETFL,
+                    fcntl.fcntl(self._fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        event.event(self.make.stdout, "r").connect(self._read)
+        self.make.connect(self._exit)
+
+    def attach(self, stagejob, callback):
+        """Attach a stage job, callback is called with the stage's status once
+        finished, returns the pid of the command."""
+        idx = self.stages.index(stagejob)
+        if idx in self._status:
+            event.post_event(callback, self._status[idx])
+        else:
+            self._callbacks[idx] = callback
+        return self.pid
+
+    def _release(self, stagejob):
+        """Release the queue reserved for a stage job (if it was not run), and
+        its cgroup."""
+        self._queues[stagejob].release(stagejob)
+        cgroup.release(stagejob)
+
+    def _read(self):
+        """Log the command's output, and check for the stage markers."""
+        if not self._reading:
+            # Stale event
+            return
+        while True:
+            try:
+                data = os.read(self._fd, 65536)
+            except OSError, e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    return
+                raise
+            if not data:
+                break
+            self._output(data)
+        # End of output
+        event.event(self.make.stdout, "r", clear=True)
+        self._markers(self._line)
+        self._line = ""
+        self._reading = False
+
+    def _output(self, data):
+        """Log output, and check complete lines for the stage markers."""
+        buildlog.write(self.port, data)
+        lines = (self._line + data).split("\n")
+        # NOTE: the markers start a line, keep only the start of long lines
+        self._line = lines.pop()[:256]
+        for line in lines:
+            self._markers(line)
+
+    def _markers(self, line):
+        """Advance to the stage whose marker starts line (if any)."""
+        for idx in range(self._phase + 1, len(self.stages)):
+            if line.startswith(self.stages[idx].markers):
+                for i in range(self._phase, idx):
+                    self._finished(i, True)
+                self._phase = idx
+                break
+
+    def _finished(self, idx, status):
+        """Report a stage has finished."""
+        self._status[idx] = status
+        callback = self._callbacks.pop(idx, None)
+        if callback is not None:
+            callback(status)
+
+    def _exit(self, pmake):
+        """Finish the remaining stages once the command has exited."""
+        if self._reading:
+            self._read()
+            if self._reading:
+                # Output still held open (i.e. by a daemon)
+                event.event(self.make.stdout, "r", clear=True)
+                self._reading = False
+        self.make.stdout.close()
+        if pmake.wait() == make.SUCCESS:
+            for idx in range(self._phase, len(self.stages)):
+                self._finished(idx, True)
+        else:
+            # The following stages will fail (without being run)
+            self._finished(self._phase, False)
+
+
 class Packagable(base.Stage):
     """A stage depending on the packagability of a port."""
 
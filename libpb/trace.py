@@ -0,0 +1,140 @@
+"""
+The trace module.  This module records the scheduling decisions of a build
+(jobs added to, started by, stalled in and finished by the queues, the stage
+transitions of ports, the dependencies of ports and the methods used to resolve
+them) in a file, so that the build's timeline may be rebuilt, and alternative
+scheduling policies replayed, offline (see admin/script/replay.py).
+
+Each record is a JSON list on its own line, starting with the time (in
+seconds) since the trace started:
+    T   "loads"     {QUEUE: LOAD, ...}
+    T   "add"       QUEUE   JOB     ORIGIN  PRIORITY    LOAD
+    T   "start"     QUEUE   JOB     ORIGIN  PRIORITY    LOAD
+    T   "stall"     QUEUE   JOB     ORIGIN
+    T   "done"      QUEUE   JOB     ORIGIN
+    T   "stage"     STAGE   STATUS  ORIGIN  PRIORITY
+    T   "depends"   ORIGIN  [ORIGIN, ...]
+    T   "method"    ORIGIN  METHOD
+where JOB is the name of the stage (or "attr" and "clean" for attribute and
+clean jobs).  A job that stalls (after it was started) is returned to its
+queue.  Records are written in batches, once per second and when the
+event loop stops.
+"""
+
+from __future__ import absolute_import
+
+import json
+import time
+
+__all__ = ["added", "done", "method", "stalled", "start", "started"]
+
+#: The name of each builder status
+STATUS = ("added", "queued", "active", "failed", "succeeded", "skipped", "done")
+
+
+class Trace(object):
+    """A trace of a build's scheduling decisions."""
+
+    def __init__(self, path, batch=256):
+        """Initialise the trace, stored at path."""
+        self.path = path
+        self.batch = batch
+        self._buffer = []
+        self._file = open(path, "w")
+        self._start = time.time()
+
+    def __repr__(self):
+        return "<Trace(%s)>" % self.path
+
+    def record(self, *fields):
+        """Add a record to the trace."""
+        self._buffer.append(json.dumps(
+                (round(time.time() - self._start, 3),) + fields,
+                separators=(",", ":")) + "\n")
+        if len(self._buffer) >= self.batch:
+            self.flush()
+
+    def flush(self):
+        """Write all buffered records."""
+        if self._buffer:
+            self._file.write("".join(self._buffer))
+            self._file.flush()
+            self._buffer = []
+
+    def job(self, kind, manager, job, extra=True):
+        """Record a queue's decision about a job."""
+        name, origin = _job(job)
+        if extra:
+            self.record(kind, manager.name, name, origin, job.priority,
+                        job.load)
+        else:
+            self.record(kind, manager.name, name, origin)
+
+    def update(self, builder, status, port):
+        """Record a port's stage transition."""
+        from libpb import stacks
+
+        self.record("stage", builder.stage.name, STATUS[status], port.origin,
+                    port.dependent.priority)
+        if (builder.stage is stacks.Depend and status == builder.SUCCEEDED and
+                port.dependency is not None):
+            self.record("depends", port.origin,
+                        sorted(i.origin for i in port.dependency.get()))
+
+
+def _job(job):
+    """The name of a job and the origin of its port."""
+    if hasattr(job, "attr"):
+        return "attr", job.attr.origin
+    elif hasattr(job, "name"):
+        return job.name, job.port.origin
+    else:
+        return "clean", job.port.origin
+
+
+_trace = None
+
+
+def start(path):
+    """Start tracing the scheduling decisions to path."""
+    from libpb import builder, event, queue
+
+    global _trace
+    _trace = Trace(path)
+    _trace.record("loads", dict((q.name, q.load) for q in
+                                (queue.attr, queue.clean) + queue.queues))
+    for b in builder.builders.values():
+        b.update.connect(_trace.update)
+
+    event.event(event.alarm(), "t", data=1).connect(_trace.flush)
+    event.stop.connect(_trace.flush)
+
+
+def added(manager, job):
+    """Record a job added to a queue."""
+    if _trace is not None:
+        _trace.job("add", manager, job)
+
+
+def started(manager, job):
+    """Record a job started by a queue."""
+    if _trace is not None:
+        _trace.job("start", manager, job)
+
+
+def stalled(manager, job):
+    """Record a job stalled in a queue."""
+    if _trace is not None:
+        _trace.job("stall", manager, job, False)
+
+
+def done(manager, job):
+    """Record a job finished by a queue."""
+    if _trace is not None:
+        _trace.job("done", manager, job, False)
+
+
+def method(port, resolve_method):
+    """Record the method chosen to resolve a port."""
+    if _trace is not None:
+        _trace.record("method", port.origin, resolve_method)
@@ -0,0 +1,110 @@
+"""
+The usage module.  This module accounts for the resources used by the
+subprocesses of ports (as reported by wait4(2) when a subprocess is reaped):
+the user and system CPU time, maximum resident set size, block I/O and
+voluntary and involuntary context switches.  The usage includes the
+(reaped) descendants of each subprocess.
+
+The usage of a subprocess is added to the stage the port is running (if any,
+see Stage.usage) and to the port's total usage (see get()).  As the usage is
+only known once a subprocess is reaped, the usage of a make(1) command that
+runs several (fused) stages is added to the last stage it runs.
+"""
+
+from __future__ import absolute_import
+
+from libpb import log
+
+__all__ = ["Usage", "get", "reaped", "stage_finished", "stage_stalled",
+           "stage_started", "top"]
+
+
+class Usage(object):
+    """The resources used by subprocesses."""
+
+    def __init__(self):
+        """Initialise an empty usage."""
+        self.processes = 0  #: The number of subprocesses
+        self.utime = 0.     #: User CPU time (in seconds)
+        self.stime = 0.     #: System CPU time (in seconds)
+        self.maxrss = 0     #: The maximum resident set size (in KiB)
+        self.inblock = 0    #: Block input operations
+        self.oublock = 0    #: Block output operations
+        self.nvcsw = 0      #: Voluntary context switches
+        self.nivcsw = 0     #: Involuntary context switches
+
+    def __str__(self):
+        return ("%i processes, cpu %.1fs (user %.1fs, sys %.1fs), "
+                "rss %.1fMiB, io %i/%i blocks (in/out), ctx %i/%i "
+                "(voluntary/involuntary)" %
+                    (self.processes, self.cpu, self.utime, self.stime,
+                     self.maxrss / 1024., self.inblock, self.oublock,
+                     self.nvcsw, self.nivcsw))
+
+    @property
+    def cpu(self):
+        """The total CPU time (in seconds)."""
+        return self.utime + self.stime
+
+    def add(self, rusage):
+        """Add the usage of a subprocess (a resource.struct_rusage)."""
+        self.processes += 1
+        self.utime += rusage.ru_utime
+        self.stime += rusage.ru_stime
+        self.maxrss = max(self.maxrss, rusage.ru_maxrss)
+        self.inblock += rusage.ru_inblock
+        self.oublock += rusage.ru_oublock
+        self.nvcsw += rusage.ru_nvcsw
+        self.nivcsw += rusage.ru_nivcsw
+
+
+_active = {}  #: The stage being run by each port
+_ports = {}   #: The usage of each port
+
+
+def stage_started(stagejob):
+    """Account subprocesses of the stage's port to the stage."""
+    _active[stagejob.port] = stagejob
+
+
+def stage_stalled(stagejob):
+    """Stop accounting subprocesses to the stage, as it stalled."""
+    if _active.get(stagejob.port) is stagejob:
+        del _active[stagejob.port]
+
+
+def stage_finished(stagejob, status):
+    """Log the usage of a finished stage."""
+    if _active.get(stagejob.port) is stagejob:
+        del _active[stagejob.port]
+    if stagejob.usage.processes:
+        log.debug("usage.stage_finished()",
+                  "Port '%s': %s stage %s used %s" %
+                      (stagejob.port.origin,
+                       "finished" if status else "failed", stagejob.name,
+                       stagejob.usage))
+
+
+def reaped(port, rusage):
+    """Account the usage of a reaped subprocess of port."""
+    from .port.port import Port
+
+    if not isinstance(port, Port) or rusage is None:
+        # NOTE: subprocesses fetching port attributes are not accounted for
+        return
+    stagejob = _active.get(port)
+    if stagejob is not None:
+        stagejob.usage.add(rusage)
+    if port not in _ports:
+        _ports[port] = Usage()
+    _ports[port].add(rusage)
+
+
+def get(port):
+    """The usage of port (or None if it ran no subprocesses)."""
+    return _ports.get(port)
+
+
+def top(count=10):
+    """The ports that used the most CPU time, with their usage."""
+    return sorted(_ports.items(), key=lambda x: -x[1].cpu)[:count]
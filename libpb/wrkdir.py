@@ -0,0 +1,185 @@
+"""
+The wrkdir module.  This module places the work directories (WRKDIR) of
+ports, that are expected to fit, on a memory backed file system (such as a
+tmpfs(5), see flags["tmpfs"]) within a budget (flags["tmpfs_budget"]), as
+extracting and building small ports is dominated by metadata I/O.
+
+The size of a port's work directory is predicted from the size of its
+distfiles.  A port is placed (by setting WRKDIRPREFIX for its make commands)
+when its Build stage starts, if the predicted size fits in the remaining
+budget (and in the free space of the file system), otherwise the port is
+built on disk.  When its Build, Install or Package stage finishes the work
+directory is measured (with du(1), off the event loop) and charged against
+the budget (if larger than predicted), and the budget is released once the
+port has been cleaned.  If the build of a placed port fails as the file
+system ran out of space (see exhausted()) the port is cleaned and built again
+on disk (see evict()).
+"""
+
+from __future__ import absolute_import
+
+import errno
+import functools
+import os
+import subprocess
+
+from libpb import buildlog, env, log
+
+__all__ = [
+        "evict", "exhausted", "prefix", "release", "stage_finished",
+        "stage_started", "start"
+    ]
+
+#: The size of a work directory relative to the size of the distfiles
+EXPANSION = 8
+
+#: The least predicted size (in bytes) of a work directory
+MINIMUM = 4 * 1024 * 1024
+
+_prefix = None  #: The WRKDIRPREFIX of placed ports (if placing)
+_budget = 0     #: The size (in bytes) available to placed ports
+_used = 0       #: The size (in bytes) charged to placed ports
+_ports = {}     #: The size charged to each placed port
+
+
+def start():
+    """Start placing work directories on flags["tmpfs"], within the budget
+    (by default, the size of the file system)."""
+    global _budget, _prefix
+
+    _prefix = env.flags["tmpfs"]
+    _budget = env.flags["tmpfs_budget"]
+    if not _budget:
+        stat = os.statvfs(env.flags["chroot"] + _prefix)
+        _budget = stat.f_blocks * stat.f_frsize
+    log.debug("wrkdir.start()", "Placing work directories on %s (%.1fMiB)" %
+                  (_prefix, _budget / 1048576.))
+
+
+def predict(port):
+    """The predicted size (in bytes) of the work directory of port."""
+    # NOTE: the port's priority is the size of its distfiles
+    return max(MINIMUM, EXPANSION * port.priority)
+
+
+def measure(port):
+    """Measure the work directory of a placed port, charging its size (if
+    larger) once measured."""
+    from .make import popen
+
+    # NOTE: du(1) is used as walking a large work directory would block the
+    # event loop
+    wrkdir = port.attr["wrkdir"][len(env.env.get("WRKDIRPREFIX", "")):]
+    args = ("du", "-sk", env.flags["chroot"] + _prefix + wrkdir)
+    with open(os.devnull, "w") as devnull:
+        du = popen(args, port.origin, subprocess.PIPE, subprocess.PIPE,
+                   devnull)
+    du.stdin.close()
+    du.connect(functools.partial(_measured, port))
+
+
+def _measured(port, du):
+    """Charge the measured size of the work directory of a placed port."""
+    global _used
+
+    output = du.stdout.read().split()
+    du.stdout.close()
+    if port not in _ports or not output or not output[0].isdigit():
+        # Released (i.e. cleaned) while measured, or not measured
+        return
+    size = int(output[0]) * 1024
+    if size > _ports[port]:
+        _used += size - _ports[port]
+        _ports[port] = size
+
+
+def prefix(port):
+    """The WRKDIRPREFIX of port, if it has been placed (otherwise None)."""
+    return _prefix if port in _ports else None
+
+
+def available():
+    """The free space (in bytes) of the file system of the placed ports."""
+    stat = os.statvfs(env.flags["chroot"] + _prefix)
+    return stat.f_bavail * stat.f_frsize
+
+
+def stage_started(stagejob):
+    """Place the port's work directory, when its build starts (and it fits
+    in the remaining budget and the file system)."""
+    from .stacks.build import Build
+    global _used
+
+    port = stagejob.port
+    if _prefix is None or not isinstance(stagejob, Build) or port in _ports:
+        return
+    size = predict(port)
+    if _used + size > _budget:
+        log.debug("wrkdir.stage_started()",
+                  "Port '%s': building on disk (%.1fMiB predicted)" %
+                      (port.origin, size / 1048576.))
+        return
+    # NOTE: placed ports may have grown since last measured
+    free = available()
+    if size > free:
+        log.debug("wrkdir.stage_started()",
+                  "Port '%s': building on disk (%.1fMiB predicted, %.1fMiB "
+                  "free)" % (port.origin, size / 1048576., free / 1048576.))
+        return
+    _ports[port] = size
+    _used += size
+    log.debug("wrkdir.stage_started()",
+              "Port '%s': building on %s (%.1fMiB predicted, %.1fMiB used)" %
+                  (port.origin, _prefix, size / 1048576., _used / 1048576.))
+
+
+def stage_finished(stagejob, _status):
+    """Measure the port's work directory, once its build, install or package
+    stage has finished."""
+    from .stacks.build import Build, Install, Package
+
+    port = stagejob.port
+    if port in _ports and isinstance(stagejob, (Build, Install, Package)):
+        measure(port)
+
+
+def exhausted(port):
+    """Indicate if the file system of a placed port (that failed to build) ran
+    out of space: if it is (nearly) full, or the end of the port's build log
+    reports so."""
+    if available() < MINIMUM:
+        return True
+    # NOTE: the space may have been freed since (e.g. ld(1) removes its output
+    # on failure)
+    recent = buildlog.read(port)
+    if recent is not None:
+        recent = recent[1]
+    else:
+        try:
+            with open(port.log_file, "r") as log_file:
+                log_file.seek(0, os.SEEK_END)
+                log_file.seek(max(0, log_file.tell() - buildlog.RECENT))
+                recent = log_file.read()
+        except IOError:
+            return False
+    return os.strerror(errno.ENOSPC) in recent
+
+
+def evict(port):
+    """Release the budget charged to port, as its (failed) build will be
+    retried on disk, returns if the port was placed."""
+    if port not in _ports:
+        return False
+    log.debug("wrkdir.evict()", "Port '%s': building again on disk "
+                  "(%.1fMiB free)" % (port.origin, available() / 1048576.))
+    release(port)
+    return True
+
+
+def release(port):
+    """Release the budget charged to port, once it has been cleaned."""
+    global _used
+
+    size = _ports.pop(port, None)
+    if size is not None:
+        _used -= size